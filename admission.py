@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS, REGISTRY, gauge_lines
+
+# Request kinds, most important first: interactive chat, then batch chat
+# (X-Request-Priority: batch), then ingest jobs (held while the job runs)
+PRIORITIES = {"chat": 0, "batch": 1, "ingest": 2}
+
+# Admission limits (overridable via environment variables)
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "16"))
+ADMISSION_KIND_LIMITS = os.environ.get("ADMISSION_KIND_LIMITS", "chat=16,batch=4,ingest=2")
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "15"))
+# Per-client token bucket shared by all admitted routes (0 = no rate limit)
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_CLIENTS = 10000
+
+
+class AdmissionRejected(Exception):
+    """Raised instead of queueing; `status` is 429 (rate limit) or 503 (overloaded)."""
+
+    def __init__(self, status: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def parse_kind_limits(spec: str) -> dict:
+    limits = {}
+    for entry in spec.split(","):
+        kind, sep, value = entry.strip().partition("=")
+        if not sep or kind not in PRIORITIES:
+            raise ValueError(f"Invalid ADMISSION_KIND_LIMITS entry '{entry}'. Use e.g. 'chat=16,batch=4,ingest=2'.")
+        limits[kind] = int(value)
+    return limits
+
+
+class Ticket:
+    """A granted slot; `release()` hands it to the next waiter and is safe to call twice."""
+
+    def __init__(self, controller, kind: str):
+        self.controller = controller
+        self.kind = kind
+        self.granted_at = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, kind: str, seq: int, future):
+        self.kind = kind
+        self.priority = PRIORITIES[kind]
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def rank(self):
+        return (self.priority, self.seq)
+
+
+class AdmissionController:
+    """
+    Decides, before any work starts, whether a request runs now, waits or is
+    turned away.
+
+    At most `max_concurrent` requests run at once, and at most the kind's
+    limit of one kind. Requests over the limits wait in one bounded queue
+    served by priority (chat before batch before ingest), then arrival. A
+    full queue sheds its least important waiter for a more important
+    newcomer, otherwise the newcomer gets a 503. So does a request still
+    waiting after `max_wait` seconds: failing fast beats letting every
+    request run into the upstream timeout. Clients also get a token bucket
+    of RATE_LIMIT_PER_MINUTE requests; past it they get a 429. Rejections
+    carry a Retry-After estimate.
+
+    All methods run on the event loop; no locking is needed.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, kind_limits: Optional[dict] = None,
+                 max_queue: Optional[int] = None, max_wait: Optional[float] = None,
+                 rate_per_minute: Optional[float] = None, burst: Optional[int] = None):
+        self.max_concurrent = max_concurrent or ADMISSION_MAX_CONCURRENT
+        self.kind_limits = kind_limits if kind_limits is not None else parse_kind_limits(ADMISSION_KIND_LIMITS)
+        self.max_queue = ADMISSION_MAX_QUEUE if max_queue is None else max_queue
+        self.max_wait = max_wait or ADMISSION_MAX_WAIT
+        self.rate = (RATE_LIMIT_PER_MINUTE if rate_per_minute is None else rate_per_minute) / 60.0
+        self.burst = burst or RATE_LIMIT_BURST
+
+        self.in_flight = {kind: 0 for kind in PRIORITIES}
+        self.total = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._buckets = OrderedDict()  # client -> (tokens, updated_at)
+        self._avg_hold = 1.0  # seconds a slot is held, smoothed; feeds Retry-After
+        REGISTRY.register_collector(self._collect_metrics)
+
+    # ------------------------
+    # Slots
+    # ------------------------
+
+    def _has_capacity(self, kind: str) -> bool:
+        return self.total < self.max_concurrent and self.in_flight[kind] < self.kind_limits.get(kind, self.max_concurrent)
+
+    def _grant(self, kind: str) -> Ticket:
+        self.total += 1
+        self.in_flight[kind] += 1
+        return Ticket(self, kind)
+
+    def _retry_after(self) -> int:
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._avg_hold * backlog / self.max_concurrent))
+
+    def _reject(self, kind: str, reason: str, status: int, detail: str, retry_after: int = None):
+        ADMISSION_REJECTED.inc(kind=kind, reason=reason)
+        return AdmissionRejected(status, detail, retry_after or self._retry_after())
+
+    def check_rate(self, kind: str, client: str):
+        """Counts a request against the client's rate limit; raises AdmissionRejected (429) past it."""
+        wait = self._take_token(client)
+        if wait:
+            raise self._reject(kind, "rate_limited", 429, "Rate limit exceeded", math.ceil(wait))
+
+    async def acquire(self, kind: str, client: Optional[str] = None) -> Ticket:
+        """
+        Waits for a slot of `kind`; raises AdmissionRejected when the request
+        should be turned away. Without a `client` no rate limit applies.
+        """
+        if client is not None:
+            self.check_rate(kind, client)
+
+        priority = PRIORITIES[kind]
+        # Queued requests of the same or higher priority go first
+        if self._has_capacity(kind) and not any(
+            w.priority <= priority and self._has_capacity(w.kind) for w in self._waiters
+        ):
+            ADMISSION_WAIT_SECONDS.observe(0.0, kind=kind)
+            return self._grant(kind)
+
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters, key=lambda w: w.rank, default=None)
+            if worst is None or worst.priority <= priority:
+                raise self._reject(kind, "queue_full", 503, "Server busy, try again later")
+            self._waiters.remove(worst)
+            worst.future.set_exception(
+                self._reject(worst.kind, "shed", 503, "Server busy, try again later")
+            )
+
+        waiter = _Waiter(kind, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            done, _ = await asyncio.wait({waiter.future}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not done:
+            self._waiters.remove(waiter)
+            raise self._reject(kind, "timeout", 503, "Server busy, timed out waiting for a slot")
+
+        ticket = waiter.future.result()
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - waiter.enqueued_at, kind=kind)
+        return ticket
+
+    def _abandon(self, waiter: _Waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+        elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+            # The slot was granted but nobody will use it
+            waiter.future.result().release()
+
+    def _release(self, ticket: Ticket):
+        self.total -= 1
+        self.in_flight[ticket.kind] -= 1
+        held = time.perf_counter() - ticket.granted_at
+        self._avg_hold += 0.1 * (held - self._avg_hold)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiters:
+            ready = [w for w in self._waiters if self._has_capacity(w.kind)]
+            if not ready:
+                return
+            waiter = min(ready, key=lambda w: w.rank)
+            self._waiters.remove(waiter)
+            waiter.future.set_result(self._grant(waiter.kind))
+
+    # ------------------------
+    # Per-client rate limit
+    # ------------------------
+
+    def _take_token(self, client: str) -> float:
+        """Takes one token from the client's bucket; returns 0, or the seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(client, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= 1.0:
+            tokens -= 1.0
+        else:
+            wait = (1.0 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > RATE_LIMIT_CLIENTS:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def _collect_metrics(self):
+        depth = {kind: 0 for kind in PRIORITIES}
+        for waiter in self._waiters:
+            depth[waiter.kind] += 1
+        lines = gauge_lines("admission_queue_depth", "Requests waiting for a slot by kind.", depth, "kind")
+        lines += gauge_lines("admission_in_flight", "Admitted requests currently running by kind.", self.in_flight, "kind")
+        return lines
@@ -0,0 +1,157 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+# Answer cache configuration (overridable via environment variables)
+DEFAULT_ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+DEFAULT_ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+DEFAULT_ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_REPLAY_RE = re.compile(r"\S+\s*|\s+")
+
+
+def normalize_question(question: str) -> str:
+    return _WHITESPACE_RE.sub(" ", question).strip().lower().rstrip("?!. ")
+
+
+def replay_chunks(answer: str):
+    """Splits a cached answer into word-sized pieces so it can be re-streamed."""
+    for match in _REPLAY_RE.finditer(answer):
+        yield match.group(0)
+
+
+class _Entry:
+    __slots__ = ("answer", "embedding", "scope", "created_at")
+
+    def __init__(self, answer, embedding, scope, created_at):
+        self.answer = answer
+        self.embedding = embedding
+        self.scope = scope
+        self.created_at = created_at
+
+
+class AnswerCache:
+    """
+    Two-tier answer cache: an exact LRU keyed on (normalized question, scope)
+    and a semantic tier that matches question embeddings by cosine similarity.
+
+    `scope` identifies the provider/model that produced the answer; entries are
+    never shared across scopes. Entries expire after `ttl` seconds and the
+    least recently used entry is evicted once `max_size` is reached.
+    """
+
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        similarity_threshold: Optional[float] = None,
+    ):
+        self.max_size = max_size or DEFAULT_ANSWER_CACHE_SIZE
+        self.ttl = DEFAULT_ANSWER_CACHE_TTL if ttl is None else ttl
+        self.similarity_threshold = (
+            DEFAULT_ANSWER_CACHE_SIMILARITY if similarity_threshold is None else similarity_threshold
+        )
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._matrix_keys = []
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(question: str, scope: str):
+        return (normalize_question(question), scope)
+
+    def get_exact(self, key) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry.answer
+
+    def get_semantic(self, embedding, scope: str) -> Optional[str]:
+        query = self._unit(embedding)
+        with self._lock:
+            if self._matrix is None:
+                self._rebuild_matrix()
+            if not self._matrix_keys:
+                self.misses += 1
+                return None
+
+            scores = self._matrix @ query
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.similarity_threshold:
+                    break
+                key = self._matrix_keys[index]
+                entry = self._entries.get(key)
+                if entry is None or entry.scope != scope:
+                    continue
+                if self._expired(entry):
+                    self._remove(key)
+                    continue
+                self._entries.move_to_end(key)
+                self.semantic_hits += 1
+                return entry.answer
+
+            self.misses += 1
+            return None
+
+    def put(self, key, embedding, answer: str):
+        entry = _Entry(answer, None if embedding is None else self._unit(embedding), key[1], time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._matrix_keys = []
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def _expired(self, entry) -> bool:
+        return self.ttl > 0 and time.monotonic() - entry.created_at > self.ttl
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    def _rebuild_matrix(self):
+        keys = [key for key, entry in self._entries.items() if entry.embedding is not None]
+        self._matrix_keys = keys
+        if keys:
+            self._matrix = np.vstack([self._entries[key].embedding for key in keys])
+        else:
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
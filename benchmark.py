@@ -0,0 +1,424 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from config import CHUNKS_FILE
+
+# Offline benchmark suite. Usage:
+#   python benchmark.py all --output bench.json
+#   python benchmark.py chat --concurrency 1,8,32 --ttft-ms 150
+# Chat benchmarks run server.py against mock_llm.py, so no GPU is needed.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONCURRENCY = "1,4,16"
+
+
+def summarize(samples) -> dict:
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url: str, process, timeout: float = 300.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process serving {url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+
+def _load_chunks(chunks_file, limit=None):
+    from records import iter_records, resolve_input
+
+    documents = []
+    for record in iter_records(resolve_input(chunks_file)):
+        documents.append(record)
+        if limit and len(documents) >= limit:
+            break
+    return documents
+
+
+def _sample_questions(documents, count, seed=0):
+    """Deterministic pseudo-questions: the opening words of random chunks."""
+    rng = random.Random(seed)
+    questions = []
+    for document in rng.choices(documents, k=count) if documents else []:
+        words = document.get("text", "").split()
+        start = rng.randrange(max(1, len(words) - 8))
+        questions.append(" ".join(words[start:start + 8]) or "What is Khalti?")
+    return questions or ["What is Khalti?"] * count
+
+
+# ------------------------
+# Ingestion and search
+# ------------------------
+
+def bench_ingest(documents, store_path, backend, embedding_model, batch_size=None):
+    from vector_store import VectorStore
+
+    texts = [document.get("text", "") for document in documents]
+
+    started = time.perf_counter()
+    embedding_model.embed_batch(texts)
+    embed_seconds = time.perf_counter() - started
+
+    store = VectorStore(path=store_path, backend=backend)
+    started = time.perf_counter()
+    added = store.add_documents(documents, embedding_model, batch_size=batch_size)
+    ingest_seconds = time.perf_counter() - started
+
+    return store, {
+        "backend": backend,
+        "chunks": len(documents),
+        "added": added,
+        "embed_seconds": round(embed_seconds, 3),
+        "embed_chunks_per_second": round(len(texts) / embed_seconds, 2) if embed_seconds else None,
+        "ingest_seconds": round(ingest_seconds, 3),
+        "ingest_chunks_per_second": round(added / ingest_seconds, 2) if ingest_seconds else None,
+    }
+
+
+def bench_search(store, embedding_model, questions, n_results=8, modes=("dense", "hybrid")):
+    """
+    Per-query latency of the embedding call and of the index lookup (given a
+    precomputed embedding), plus amortized latency of one batched lookup.
+    """
+    embeddings = embedding_model.embed_batch(questions)
+
+    embed_latencies = []
+    for question in questions:
+        started = time.perf_counter()
+        embedding_model.embed_batch([question])
+        embed_latencies.append(time.perf_counter() - started)
+
+    results = {"queries": len(questions), "n_results": n_results, "embed": summarize(embed_latencies)}
+    for mode in modes:
+        # Warm caches (mmap pages, BM25 term arrays) before timing
+        store.search(questions[0], embedding_model, n_results=n_results, query_embedding=embeddings[0], mode=mode)
+
+        latencies = []
+        for question, embedding in zip(questions, embeddings):
+            started = time.perf_counter()
+            store.search(question, embedding_model, n_results=n_results, query_embedding=embedding, mode=mode)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        store.search_batch(questions, embedding_model, n_results=n_results, query_embeddings=embeddings, mode=mode)
+        batch_seconds = time.perf_counter() - started
+
+        results[mode] = {
+            **summarize(latencies),
+            "batch_per_query_ms": round(batch_seconds / len(questions) * 1000, 3),
+        }
+    return results
+
+
+# ------------------------
+# End-to-end chat load
+# ------------------------
+
+class _Rejected(Exception):
+    """Turned away by admission control (429 rate limited, 503 overloaded); counted apart from errors."""
+
+    def __init__(self, status):
+        super().__init__(f"rejected with {status}")
+        self.status = status
+
+
+async def _http_request(client, url, question):
+    started = time.perf_counter()
+    first = None
+    async with client.stream("POST", url, json={"messages": [{"role": "user", "content": question}]}) as response:
+        if response.status_code in (429, 503):
+            raise _Rejected(response.status_code)
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            if first is None and chunk:
+                first = time.perf_counter()
+    end = time.perf_counter()
+    return (first or end) - started, end - started
+
+
+async def _ws_request(websocket, request_id, question):
+    started = time.perf_counter()
+    first = None
+    await websocket.send(json.dumps({"id": request_id, "question": question}))
+    while True:
+        frame = json.loads(await websocket.recv())
+        if frame.get("type") == "token" and first is None:
+            first = time.perf_counter()
+        elif frame.get("type") == "error":
+            if frame.get("status") in (429, 503):
+                raise _Rejected(frame["status"])
+            raise RuntimeError(frame.get("detail"))
+        elif frame.get("type") == "done":
+            break
+    end = time.perf_counter()
+    return (first or end) - started, end - started
+
+
+async def _run_load(worker_factory, concurrency, questions):
+    """Runs `questions` through `concurrency` workers, each answering one question at a time."""
+    queue = asyncio.Queue()
+    for item in enumerate(questions):
+        queue.put_nowait(item)
+    ttfts, totals, errors = [], [], []
+    rejected = {429: 0, 503: 0}
+
+    async def worker():
+        async with worker_factory() as request:
+            while not queue.empty():
+                i, question = queue.get_nowait()
+                try:
+                    ttft, total = await request(i, question)
+                    ttfts.append(ttft)
+                    totals.append(total)
+                except _Rejected as e:
+                    rejected[e.status] += 1
+                except Exception as e:
+                    errors.append(str(e))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": len(questions),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "rate_limited": rejected[429],
+        "overloaded": rejected[503],
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(totals) / elapsed, 2) if elapsed else None,
+        "ttft": summarize(ttfts),
+        "total": summarize(totals),
+    }
+
+
+class _HttpWorker:
+    def __init__(self, base_url):
+        self.url = f"{base_url}/api/chat"
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(300.0))
+        return lambda i, question: _http_request(self.client, self.url, question)
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+
+class _WsWorker:
+    def __init__(self, base_url):
+        self.url = base_url.replace("http://", "ws://") + "/ws/chat"
+        self.connection = None
+
+    async def __aenter__(self):
+        import websockets
+
+        self.connection = await websockets.connect(self.url, max_size=None)
+        return lambda i, question: _ws_request(self.connection, f"q{i}", question)
+
+    async def __aexit__(self, *exc):
+        await self.connection.close()
+
+
+def bench_chat(workdir, questions, concurrency_levels, provider="ollama", backend="chroma",
+               ttft_ms=200.0, tokens_per_second=50.0, tokens=64):
+    """
+    Starts mock_llm.py and server.py (cwd=`workdir`, so it serves the index
+    built there) as subprocesses and drives /api/chat and /ws/chat at each
+    concurrency level. The answer cache is disabled so every request generates.
+    """
+    mock_port, server_port = _free_port(), _free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    server_url = f"http://127.0.0.1:{server_port}"
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_DIR + os.pathsep + env.get("PYTHONPATH", ""),
+        "LLM_PROVIDER": provider,
+        "OLLAMA_API_URL": mock_url,
+        "OLLAMA_MODEL": "mock:q4_K_M",
+        "VLLM_API_URL": f"{mock_url}/v1/chat/completions",
+        "VLLM_MODEL": "mock",
+        "VECTOR_BACKEND": backend,
+        "ANSWER_CACHE_ENABLED": "false",
+        "LLM_MAX_TOKENS": str(tokens),
+        # One client drives all the load: no per-client rate limit, and enough
+        # admission slots that the concurrency level is what gets measured
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "ADMISSION_MAX_CONCURRENT": str(max(concurrency_levels)),
+        "ADMISSION_KIND_LIMITS": f"chat={max(concurrency_levels)},batch=4,ingest=2",
+    })
+
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(REPO_DIR, "mock_llm.py"), "--port", str(mock_port),
+        "--ttft-ms", str(ttft_ms), "--tokens-per-second", str(tokens_per_second), "--tokens", str(tokens),
+    ], env=env)
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning",
+    ], cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+
+    try:
+        _wait_http(f"{mock_url}/api/tags", mock)
+        _wait_http(f"{server_url}/api/cache/stats", server)
+
+        results = {
+            "provider": provider,
+            "mock": {"ttft_ms": ttft_ms, "tokens_per_second": tokens_per_second, "tokens": tokens},
+            "http": [],
+            "websocket": [],
+        }
+        for concurrency in concurrency_levels:
+            print(f"Chat load: concurrency={concurrency}")
+            results["http"].append(asyncio.run(
+                _run_load(lambda: _HttpWorker(server_url), concurrency, questions)
+            ))
+            results["websocket"].append(asyncio.run(
+                _run_load(lambda: _WsWorker(server_url), concurrency, questions)
+            ))
+        results["mock_stats"] = httpx.get(f"{mock_url}/mock/stats").json()
+        return results
+    finally:
+        for process in (server, mock):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# ------------------------
+# Entry point
+# ------------------------
+
+def compare(results, baseline, path=""):
+    """Prints numeric fields that changed by more than 5% against a baseline run."""
+    if isinstance(results, dict) and isinstance(baseline, dict):
+        for key, value in results.items():
+            if key in baseline and key != "meta":
+                compare(value, baseline[key], f"{path}.{key}" if path else key)
+    elif isinstance(results, list) and isinstance(baseline, list):
+        for i, (value, old) in enumerate(zip(results, baseline)):
+            compare(value, old, f"{path}[{i}]")
+    elif isinstance(results, (int, float)) and isinstance(baseline, (int, float)) and not isinstance(results, bool):
+        if baseline and abs(results - baseline) / abs(baseline) > 0.05:
+            print(f"{path}: {baseline} -> {results} ({(results - baseline) / abs(baseline):+.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline performance benchmarks")
+    parser.add_argument("suite", nargs="?", default="all", choices=["all", "ingest", "search", "chat"])
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--chunks", default=CHUNKS_FILE if os.path.exists(CHUNKS_FILE) else "chunks.json")
+    parser.add_argument("--limit", type=int, help="Use at most this many chunks")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "numpy"])
+    parser.add_argument("--workdir", help="Directory for the benchmark index (default: temporary)")
+    parser.add_argument("--queries", type=int, default=200, help="Search queries / chat requests per level")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, help="Comma-separated chat concurrency levels")
+    parser.add_argument("--provider", default="ollama", choices=["ollama", "vllm"])
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    documents = _load_chunks(args.chunks, args.limit)
+    questions = _sample_questions(documents, args.queries, args.seed)
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "suite": args.suite,
+            "chunks_file": args.chunks,
+            "workdir": workdir,
+            "seed": args.seed,
+        }
+    }
+
+    if args.suite in ("all", "ingest", "search"):
+        from embeddings import EmbeddingModel
+        from vector_store import DEFAULT_PATHS
+
+        embedding_model = EmbeddingModel()
+        embedding_model.warmup()
+        store_path = os.path.join(workdir, DEFAULT_PATHS[args.backend])
+
+        print(f"Ingesting {len(documents)} chunks into {store_path}...")
+        store, results["ingest"] = bench_ingest(documents, store_path, args.backend, embedding_model)
+        if args.suite in ("all", "search"):
+            print(f"Running {len(questions)} search queries...")
+            results["search"] = bench_search(store, embedding_model, questions)
+        embedding_model.close()
+
+    if args.suite in ("all", "chat"):
+        levels = [int(level) for level in args.concurrency.split(",") if level]
+        results["chat"] = bench_chat(
+            workdir, questions, levels, provider=args.provider, backend=args.backend,
+            ttft_ms=args.ttft_ms, tokens_per_second=args.tokens_per_second, tokens=args.tokens,
+        )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
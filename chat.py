@@ -1,10 +1,18 @@
-import json
+import asyncio
 import logging
 import os
-from typing import Generator, Optional
+from typing import AsyncGenerator, Generator, Optional
 
 import requests
 
+from answer_cache import AnswerCache, replay_chunks
+from context_builder import build_context, count_prompt_tokens
+from llm_client import AsyncLLMClient
+from llm_router import DEFAULT_LLM_ENDPOINTS, Endpoint, LLMRouter, parse_endpoints
+from metrics import IN_FLIGHT, LLM_ERRORS, RequestTimer
+from sessions import Session, SessionStore, create_session_store
+from streaming import NDJSONDecoder, SSEDecoder, aiter_decoded, iter_decoded, loads
+
 # Default API endpoints and models (overridable via environment variables)
 DEFAULT_VLLM_API_URL = os.environ.get("VLLM_API_URL", "http://localhost:8000/v1/chat/completions")
 DEFAULT_VLLM_MODEL = os.environ.get("VLLM_MODEL", "meta-llama/Meta-Llama-3-8B-Instruct")
@@ -14,6 +22,22 @@ DEFAULT_OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3:8b-instruct-q4_K_M
 
 DEFAULT_LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "ollama").lower()
 
+# Retrieval candidates fetched before context packing, and the generation limit
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "8"))
+# Concurrent generations for query_batch
+BATCH_MAX_IN_FLIGHT = int(os.environ.get("BATCH_MAX_IN_FLIGHT", "16"))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "512"))
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Conversation history: turns beyond SESSION_HISTORY_TOKENS are folded into a
+# summary, keeping the last SESSION_KEEP_TURNS exchanges verbatim. Ollama's
+# returned context array is reused while it stays under
+# SESSION_OLLAMA_CONTEXT_TOKENS (keep it below the model's num_ctx).
+SESSION_HISTORY_TOKENS = int(os.environ.get("SESSION_HISTORY_TOKENS", "1500"))
+SESSION_KEEP_TURNS = int(os.environ.get("SESSION_KEEP_TURNS", "2"))
+SESSION_OLLAMA_CONTEXT_TOKENS = int(os.environ.get("SESSION_OLLAMA_CONTEXT_TOKENS", "3072"))
+
 SYSTEM_PROMPT = """You are a helpful AI assistant.
 
 Your goal is to answer the user's question using the provided CONTEXT.
@@ -25,6 +49,15 @@ Rules:
 4. Tone: Be helpful, professional, and concise.
 """
 
+SUMMARY_PROMPT = """Summarize the conversation below in a few sentences. Keep the facts, names and numbers \
+the user may refer back to. Reply with the summary only.
+
+{conversation}
+
+Summary:"""
+
+SOURCES_HEADING = "\n\n**Sources:**\n"
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -38,6 +71,10 @@ class ChatEngine:
         ollama_model: Optional[str] = None,
         vllm_api_url: Optional[str] = None,
         vllm_model: Optional[str] = None,
+        async_client: Optional[AsyncLLMClient] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        session_store: Optional[SessionStore] = None,
+        llm_endpoints: Optional[str] = None,
     ):
         self.vector_store = vector_store
         self.embedding_model = embedding_model
@@ -51,11 +88,42 @@ class ChatEngine:
         if self.llm_provider not in ["ollama", "vllm"]:
             raise ValueError(f"Unsupported LLM_PROVIDER '{self.llm_provider}'. Use 'ollama' or 'vllm'.")
 
+        # Keep-alive pools: a requests.Session for the sync paths, httpx for the async ones
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.async_client = async_client or AsyncLLMClient()
+
+        # Every generation goes through the router: the LLM_ENDPOINTS list when
+        # set (both providers may be mixed), else the single endpoint above
+        endpoints = parse_endpoints(
+            DEFAULT_LLM_ENDPOINTS if llm_endpoints is None else llm_endpoints,
+            {"ollama": self.ollama_model, "vllm": self.vllm_model},
+        )
+        if not endpoints:
+            if self.llm_provider == "ollama":
+                endpoints = [Endpoint("ollama", self.ollama_api_url, self.ollama_model)]
+            else:
+                endpoints = [Endpoint("vllm", self.vllm_api_url, self.vllm_model)]
+        for endpoint in endpoints:
+            if endpoint.provider == "ollama":
+                self._validate_ollama_model(endpoint.model)
+        self.router = LLMRouter(endpoints, self.async_client)
+
+        # Answer cache, dropped whenever the knowledge base changes
+        self.answer_cache = answer_cache or (AnswerCache() if ANSWER_CACHE_ENABLED else None)
+        if self.answer_cache and hasattr(vector_store, "add_change_listener"):
+            vector_store.add_change_listener(self.answer_cache.invalidate)
+
+        # Server-side conversation state, see aquery_stream(session=...)
+        self.sessions = session_store or create_session_store()
+        self._background = set()
+
         LOGGER.info(
-            "ChatEngine initialized with provider=%s, ollama_model=%s, vllm_model=%s",
+            "ChatEngine initialized with provider=%s, ollama_model=%s, vllm_model=%s, endpoints=%s",
             self.llm_provider,
             self.ollama_model,
             self.vllm_model,
+            [e.name for e in endpoints],
         )
 
     def _validate_ollama_model(self, model_name: str) -> str:
@@ -80,182 +148,672 @@ class ChatEngine:
         return model_name
 
     def _get_sources(self, results):
-        sources = set()
+        pages = {}
         if results and results.get("metadatas"):
             for meta in results["metadatas"][0]:
                 if meta and "source" in meta:
-                    sources.add(meta["source"])
-        return sorted(sources)
-
-    def _build_messages(self, context, question):
-        return [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": f"Context:\n{context}\n\nQuestion:\n{question}",
-            },
-        ]
+                    source_pages = pages.setdefault(meta["source"], set())
+                    if meta.get("page") is not None:
+                        source_pages.add(meta["page"])
+
+        # PDF chunks carry a page number: cite "manual.pdf (p. 3, 7)"
+        sources = []
+        for source in sorted(pages):
+            if pages[source]:
+                sources.append(f"{source} (p. {', '.join(str(p) for p in sorted(pages[source]))})")
+            else:
+                sources.append(source)
+        return sources
+
+    def _build_messages(self, context, question, session: Optional[Session] = None):
+        # The system prompt always comes first and earlier turns are replayed
+        # unchanged, so vLLM's prefix cache only prefills the newest turn
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if session is not None:
+            if session.summary:
+                messages.append({"role": "user", "content": f"Summary of our conversation so far:\n{session.summary}"})
+                messages.append({"role": "assistant", "content": "Understood."})
+            messages.extend(session.turns)
+        messages.append({
+            "role": "user",
+            "content": f"Context:\n{context}\n\nQuestion:\n{question}",
+        })
+        return messages
 
     def _build_prompt(self, context: str, question: str) -> str:
         return f"{SYSTEM_PROMPT}\n\nContext:\n{context}\n\nQuestion:\n{question}\n\nAnswer:"
 
-    def _query_vllm(self, messages):
+    def _build_session_prompt(self, context: str, question: str, session: Session, model: str):
+        """
+        Returns (prompt, context_tokens) for an Ollama turn. With the context
+        array of the previous turn (from the same model) only the new turn is
+        sent; otherwise the summary and earlier turns are replayed as text once.
+        """
+        turn = f"Context:\n{context}\n\nQuestion:\n{question}\n\nAnswer:"
+        if session.ollama_context and session.ollama_model == model:
+            return turn, session.ollama_context
+        history = self._transcript(session)
+        if history:
+            return f"{SYSTEM_PROMPT}\n\nConversation so far:\n{history}\n\n{turn}", None
+        return f"{SYSTEM_PROMPT}\n\n{turn}", None
+
+    def _transcript(self, session: Session, turns=None) -> str:
+        lines = [f"Summary: {session.summary}"] if session.summary else []
+        for turn in session.turns if turns is None else turns:
+            speaker = "User" if turn["role"] == "user" else "Assistant"
+            lines.append(f"{speaker}: {turn['content']}")
+        return "\n".join(lines)
+
+    def _vllm_payload(self, messages, stream: bool = False, model: Optional[str] = None) -> dict:
         payload = {
-            "model": self.vllm_model,
+            "model": model or self.vllm_model,
             "messages": messages,
             "temperature": 0.3,
             "top_p": 0.9,
-            "max_tokens": 512,
+            "max_tokens": LLM_MAX_TOKENS,
         }
-        res = requests.post(
-            self.vllm_api_url,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=120,
-        )
-        res.raise_for_status()
-        return res.json()["choices"][0]["message"]["content"]
+        if stream:
+            payload["stream"] = True
+            # Token counts arrive in a last chunk with empty "choices"
+            payload["stream_options"] = {"include_usage": True}
+        return payload
 
-    def _query_ollama(self, prompt: str) -> str:
+    def _ollama_payload(self, prompt: str, stream: bool = False, context=None, model: Optional[str] = None) -> dict:
         payload = {
-            "model": self.ollama_model,
+            "model": model or self.ollama_model,
             "prompt": prompt,
-            "stream": False,
+            "stream": stream,
+            "options": {"num_predict": LLM_MAX_TOKENS},
         }
-        res = requests.post(
-            f"{self.ollama_api_url}/api/generate",
-            headers={"Content-Type": "application/json"},
+        if context:
+            payload["context"] = context
+        return payload
+
+    def _payload(self, endpoint: Endpoint, context: str, question: str, stream: bool = False,
+                 session: Optional[Session] = None) -> dict:
+        """Request body for one answer in `endpoint`'s wire format."""
+        if endpoint.provider == "ollama":
+            if session is None:
+                return self._ollama_payload(self._build_prompt(context, question), stream, model=endpoint.model)
+            prompt, context_tokens = self._build_session_prompt(context, question, session, endpoint.model)
+            return self._ollama_payload(prompt, stream, context_tokens, endpoint.model)
+        return self._vllm_payload(self._build_messages(context, question, session), stream, endpoint.model)
+
+    def _text_payload(self, endpoint: Endpoint, prompt: str) -> dict:
+        if endpoint.provider == "ollama":
+            return self._ollama_payload(prompt, model=endpoint.model)
+        return self._vllm_payload([{"role": "user", "content": prompt}], model=endpoint.model)
+
+    def _generate_url(self, endpoint: Endpoint) -> str:
+        return f"{endpoint.url}/api/generate" if endpoint.provider == "ollama" else endpoint.url
+
+    def _response_text(self, endpoint: Endpoint, data: dict) -> str:
+        if endpoint.provider == "ollama":
+            return data.get("response", "")
+        return data["choices"][0]["message"]["content"]
+
+    def _query_endpoint(self, endpoint: Endpoint, payload: dict) -> str:
+        res = self.session.post(
+            self._generate_url(endpoint),
             json=payload,
             timeout=120,
         )
         res.raise_for_status()
-        data = res.json()
-        return data.get("response", "")
-
-    def query(self, user_question):
-        results = self.vector_store.search(
-            user_question, self.embedding_model, n_results=5
-        )
+        return self._response_text(endpoint, res.json())
+
+    def _cache_scope(self) -> str:
+        # Answers are shared across endpoints only when they all serve the same models
+        return "+".join(sorted({f"{e.provider}:{e.model}" for e in self.router.endpoints}))
+
+    def _prepare(self, user_question, timer: Optional[RequestTimer] = None, session: Optional[Session] = None):
+        """
+        Looks the question up in the answer cache and, on a miss, runs retrieval
+        with the same question embedding. Returns
+        (cache_key, query_embedding, cached_answer, results, context_text).
+        Stage timings are recorded on `timer` when given.
+
+        Follow-ups in a session skip the answer cache, since their answer
+        depends on earlier turns, and retrieve with the previous question
+        prepended so "what about fees?" still finds the right pages.
+        """
+        timer = timer or RequestTimer(self.llm_provider)
+        if session is not None and session.turns:
+            follow_up = f"{session.last_question()}\n{user_question}"
+            with timer.stage("embed"):
+                query_embedding = self.embedding_model.embed_query(follow_up)
+            results, context_text = self._retrieve(follow_up, query_embedding, timer)
+            return None, query_embedding, None, results, context_text
+
+        cache_key = None
+        if self.answer_cache:
+            cache_key = self.answer_cache.make_key(user_question, self._cache_scope())
+            cached = self.answer_cache.get_exact(cache_key)
+            if cached is not None:
+                timer.cached = True
+                return cache_key, None, cached, None, None
+
+        with timer.stage("embed"):
+            query_embedding = self.embedding_model.embed_query(user_question)
+        if self.answer_cache:
+            cached = self.answer_cache.get_semantic(query_embedding, self._cache_scope())
+            if cached is not None:
+                timer.cached = True
+                return cache_key, query_embedding, cached, None, None
+
+        results, context_text = self._retrieve(user_question, query_embedding, timer)
+        return cache_key, query_embedding, None, results, context_text
+
+    def _store_answer(self, cache_key, query_embedding, answer: str):
+        if self.answer_cache and cache_key is not None:
+            self.answer_cache.put(cache_key, query_embedding, answer)
+
+    def _retrieve(self, user_question, query_embedding=None, timer: Optional[RequestTimer] = None):
+        timer = timer or RequestTimer(self.llm_provider)
+        with timer.stage("search"):
+            results = self.vector_store.search(
+                user_question, self.embedding_model, n_results=CONTEXT_CANDIDATES, query_embedding=query_embedding
+            )
+        with timer.stage("context"):
+            return self._pack(results)
 
-        context_text = ""
-        if results and results.get("documents"):
-            context_text = "\n\n".join(results["documents"][0])
+    def _pack(self, results):
+        # Token-budgeted packing; `results` is narrowed to the passages actually sent
+        context_text, results = build_context(results, count_prompt_tokens)
 
         if not context_text:
             context_text = "No context available."
 
-        messages = self._build_messages(context_text, user_question)
+        return results, context_text
+
+    def _format_sources(self, results) -> str:
+        return self.sources_text(self._get_sources(results))
+
+    @staticmethod
+    def sources_text(sources) -> str:
+        if not sources:
+            return ""
+        return SOURCES_HEADING + "\n".join(f"- {s}" for s in sources)
+
+    @staticmethod
+    def _split_sources(answer: str):
+        """Splits a stored answer back into (text, sources)."""
+        text, _, listed = answer.partition(SOURCES_HEADING)
+        return text, [line[2:] for line in listed.splitlines() if line.startswith("- ")]
+
+    @classmethod
+    def event_text(cls, event: str, data) -> str:
+        """Plain-text rendering of one aquery_events event, as the text stream has always looked."""
+        if event == "token":
+            return data
+        if event == "sources":
+            return cls.sources_text(data)
+        if event == "error":
+            return f"\n{data}"
+        return ""
+
+    @staticmethod
+    def _usage(final: dict) -> Optional[dict]:
+        """Token counts from a stream's closing message, in the OpenAI field names."""
+        usage = final.get("usage")
+        if usage:
+            return {key: usage.get(key, 0) for key in ("prompt_tokens", "completion_tokens", "total_tokens")}
+        if "eval_count" in final:
+            prompt_tokens = final.get("prompt_eval_count", 0)
+            return {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": final["eval_count"],
+                "total_tokens": prompt_tokens + final["eval_count"],
+            }
+        return None
 
-        try:
-            if self.llm_provider == "ollama":
-                prompt = self._build_prompt(context_text, user_question)
-                response_text = self._query_ollama(prompt)
-            else:
-                response_text = self._query_vllm(messages)
+    def query(self, user_question):
+        timer = RequestTimer(self.llm_provider)
+        cache_key, query_embedding, cached, results, context_text = self._prepare(user_question, timer)
+        if cached is not None:
+            timer.finish()
+            return cached
 
-            sources = self._get_sources(results)
-            if sources:
-                response_text += "\n\n**Sources:**\n" + "\n".join(f"- {s}" for s in sources)
+        try:
+            response_text = self.router.call(
+                lambda endpoint: self._query_endpoint(endpoint, self._payload(endpoint, context_text, user_question))
+            )
 
-            return response_text
+            answer = response_text + self._format_sources(results)
+            self._store_answer(cache_key, query_embedding, answer)
+            return answer
 
         except Exception as e:
             LOGGER.exception("Error during query with provider=%s", self.llm_provider)
+            LLM_ERRORS.inc(provider=self.llm_provider)
             provider_label = "Ollama" if self.llm_provider == "ollama" else "vLLM"
             return f"Error communicating with {provider_label}: {str(e)}"
-
-    def _stream_vllm(self, messages) -> Generator[str, None, None]:
-        payload = {
-            "model": self.vllm_model,
-            "messages": messages,
-            "temperature": 0.3,
-            "top_p": 0.9,
-            "max_tokens": 512,
-            "stream": True,
-        }
-
-        with requests.post(
-            self.vllm_api_url,
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(payload),
+        finally:
+            timer.finish()
+
+    def _stream_endpoint(self, endpoint: Endpoint, payload: dict) -> Generator[str, None, None]:
+        if endpoint.provider == "ollama":
+            return self._stream_ollama(self._generate_url(endpoint), payload)
+        return self._stream_vllm(endpoint.url, payload)
+
+    # Upstream bodies are decoded incrementally from raw bytes: vLLM sends
+    # Server-Sent Events, Ollama newline-delimited JSON. A parsed message
+    # goes through _vllm_delta/_ollama_delta, which return its text, or
+    # None once the stream is over.
+
+    def _vllm_delta(self, event: bytes, final: Optional[dict] = None) -> Optional[str]:
+        if event == b"[DONE]":
+            return None
+        chunk = loads(event)
+        if chunk.get("usage") and final is not None:
+            final["usage"] = chunk["usage"]
+        choices = chunk.get("choices")
+        if not choices:
+            return ""
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def _ollama_delta(self, data: dict, final: Optional[dict] = None) -> Optional[str]:
+        if data.get("done"):
+            if final is not None:
+                final.update(data)
+            return None
+        return data.get("response") or ""
+
+    def _stream_vllm(self, url: str, payload: dict) -> Generator[str, None, None]:
+        with self.session.post(
+            url,
+            json=payload,
             stream=True,
             timeout=120,
         ) as r:
-            for line in r.iter_lines():
-                if not line:
-                    continue
-
-                decoded = line.decode("utf-8").replace("data: ", "")
-                if decoded == "[DONE]":
-                    break
-
-                chunk = json.loads(decoded)
-                delta = chunk["choices"][0]["delta"]
-
-                if "content" in delta:
-                    yield delta["content"]
-
-    def _stream_ollama(self, prompt: str) -> Generator[str, None, None]:
-        payload = {
-            "model": self.ollama_model,
-            "prompt": prompt,
-            "stream": True,
-        }
+            r.raise_for_status()
+            for event in iter_decoded(r.iter_content(chunk_size=None), SSEDecoder()):
+                chunk = self._vllm_delta(event)
+                if chunk is None:
+                    return
+                if chunk:
+                    yield chunk
 
-        with requests.post(
-            f"{self.ollama_api_url}/api/generate",
-            headers={"Content-Type": "application/json"},
+    def _stream_ollama(self, url: str, payload: dict) -> Generator[str, None, None]:
+        with self.session.post(
+            url,
             json=payload,
             stream=True,
             timeout=120,
         ) as r:
-            for line in r.iter_lines():
-                if not line:
-                    continue
+            r.raise_for_status()
+            for message in iter_decoded(r.iter_content(chunk_size=None), NDJSONDecoder()):
+                chunk = self._ollama_delta(message)
+                if chunk is None:
+                    return
+                if chunk:
+                    yield chunk
 
-                decoded = line.decode("utf-8")
-                if decoded.startswith("data:"):
-                    decoded = decoded.replace("data: ", "")
-                try:
-                    data = json.loads(decoded)
-                except json.JSONDecodeError:
-                    LOGGER.warning("Failed to decode SSE chunk: %s", decoded)
-                    continue
+    def query_stream(self, user_question):
+        timer = RequestTimer(self.llm_provider)
+        cache_key, query_embedding, cached, results, context_text = self._prepare(user_question, timer)
+        if cached is not None:
+            yield from replay_chunks(cached)
+            timer.finish()
+            return
+
+        answer_parts = []
+        stream = self.router.call_stream(
+            lambda endpoint: self._stream_endpoint(
+                endpoint, self._payload(endpoint, context_text, user_question, stream=True)
+            )
+        )
+
+        try:
+            for chunk in stream:
+                timer.token()
+                answer_parts.append(chunk)
+                yield chunk
 
-                if data.get("done"):
-                    break
+            sources = self._format_sources(results)
+            if sources:
+                answer_parts.append(sources)
+                yield sources
+
+            self._store_answer(cache_key, query_embedding, "".join(answer_parts))
 
-                chunk = data.get("response")
+        except Exception as e:
+            LOGGER.exception("Error during streaming query with provider=%s", self.llm_provider)
+            LLM_ERRORS.inc(provider=self.llm_provider)
+            yield f"\nError communicating with {self.llm_provider}: {str(e)}"
+        finally:
+            stream.close()
+            timer.finish()
+
+    # ------------------------
+    # Async API (used by the FastAPI server)
+    # ------------------------
+
+    async def _aprepare(self, user_question, timer: Optional[RequestTimer] = None, session: Optional[Session] = None):
+        # Embedding and Chroma are CPU/disk bound, keep them off the event loop
+        return await asyncio.to_thread(self._prepare, user_question, timer, session)
+
+    async def _aquery_endpoint(self, endpoint: Endpoint, payload: dict) -> str:
+        data = await self.async_client.post_json(self._generate_url(endpoint), payload)
+        return self._response_text(endpoint, data)
+
+    async def _aquery_text(self, prompt: str) -> str:
+        """One-off, non-streamed generation for a plain prompt."""
+        return await self.router.request(
+            lambda endpoint: self._aquery_endpoint(endpoint, self._text_payload(endpoint, prompt))
+        )
+
+    async def _astream_endpoint(self, endpoint: Endpoint, payload: dict, final: Optional[dict] = None):
+        """
+        Streams one endpoint's answer. Once it completes, `final` holds the
+        endpoint, vLLM's "usage" or, for Ollama, the closing message with its
+        token counts and "context".
+        """
+        if endpoint.provider == "ollama":
+            stream = self._astream_ollama(self._generate_url(endpoint), payload, final)
+        else:
+            stream = self._astream_vllm(endpoint.url, payload, final)
+        try:
+            async for chunk in stream:
+                yield chunk
+            if final is not None:
+                final["endpoint"] = endpoint
+        finally:
+            await stream.aclose()
+
+    async def _astream_vllm(self, url: str, payload: dict, final: Optional[dict] = None) -> AsyncGenerator[str, None]:
+        events = aiter_decoded(self.async_client.stream_bytes(url, payload), SSEDecoder())
+        try:
+            async for event in events:
+                chunk = self._vllm_delta(event, final)
+                if chunk is None:
+                    return
                 if chunk:
                     yield chunk
+        finally:
+            await events.aclose()
 
-    def query_stream(self, user_question):
-        results = self.vector_store.search(
-            user_question, self.embedding_model, n_results=5
+    async def _astream_ollama(self, url: str, payload: dict, final: Optional[dict] = None) -> AsyncGenerator[str, None]:
+        """Streams response chunks; the closing message is copied into `final` when given."""
+        messages = aiter_decoded(self.async_client.stream_bytes(url, payload), NDJSONDecoder())
+        try:
+            async for message in messages:
+                chunk = self._ollama_delta(message, final)
+                if chunk is None:
+                    return
+                if chunk:
+                    yield chunk
+        finally:
+            await messages.aclose()
+
+    async def _agenerate(self, user_question, cache_key, query_embedding, results, context_text) -> str:
+        response_text = await self.router.request(
+            lambda endpoint: self._aquery_endpoint(endpoint, self._payload(endpoint, context_text, user_question))
         )
 
-        context_text = ""
-        if results and results.get("documents"):
-            context_text = "\n\n".join(results["documents"][0])
+        answer = response_text + self._format_sources(results)
+        self._store_answer(cache_key, query_embedding, answer)
+        return answer
 
-        if not context_text:
-            context_text = "No context available."
+    async def aquery(self, user_question):
+        timer = RequestTimer(self.llm_provider)
+        IN_FLIGHT.inc()
+        try:
+            cache_key, query_embedding, cached, results, context_text = await self._aprepare(user_question, timer)
+            if cached is not None:
+                return cached
 
-        messages = self._build_messages(context_text, user_question)
+            return await self._agenerate(user_question, cache_key, query_embedding, results, context_text)
 
+        except Exception as e:
+            LOGGER.exception("Error during query with provider=%s", self.llm_provider)
+            LLM_ERRORS.inc(provider=self.llm_provider)
+            provider_label = "Ollama" if self.llm_provider == "ollama" else "vLLM"
+            return f"Error communicating with {provider_label}: {str(e)}"
+        finally:
+            IN_FLIGHT.dec()
+            timer.finish()
+
+    async def aquery_stream(self, user_question, timings: Optional[dict] = None, session: Optional[Session] = None):
+        """
+        Streams the answer to `user_question` as text; sources and errors are
+        appended the way they always were. See `aquery_events`.
+        """
+        events = self.aquery_events(user_question, timings, session)
         try:
-            if self.llm_provider == "ollama":
-                prompt = self._build_prompt(context_text, user_question)
-                for chunk in self._stream_ollama(prompt):
+            async for event, data in events:
+                text = self.event_text(event, data)
+                if text:
+                    yield text
+        finally:
+            await events.aclose()
+
+    async def aquery_events(self, user_question, timings: Optional[dict] = None, session: Optional[Session] = None):
+        """
+        Streams the answer to `user_question` as (event, data) pairs:
+        ("token", text), ("sources", [source, ...]), ("usage", {token counts})
+        and ("error", message). When `timings` is a dict it is filled with
+        the request's stage timings once the stream ends.
+
+        With a `session` (see `self.sessions`) the question is answered as a
+        follow-up of the earlier turns and the exchange is recorded; turns of
+        one session run one at a time.
+        """
+        timer = RequestTimer(self.llm_provider)
+        IN_FLIGHT.inc()
+        answer = self._astream_answer(user_question, timer, session)
+        try:
+            if session is None:
+                async for chunk in answer:
                     yield chunk
             else:
-                for chunk in self._stream_vllm(messages):
-                    yield chunk
+                async with session.lock:
+                    async for chunk in answer:
+                        yield chunk
+        finally:
+            IN_FLIGHT.dec()
+            result = timer.finish()
+            if timings is not None:
+                timings.update(result)
+            # Closes the upstream LLM stream right away when the client went away
+            await answer.aclose()
+
+    async def _astream_answer(self, user_question, timer: RequestTimer, session: Optional[Session] = None):
+        cache_key, query_embedding, cached, results, context_text = await self._aprepare(user_question, timer, session)
+        if cached is not None:
+            text, sources = self._split_sources(cached)
+            if session is not None:
+                self._record_turn(session, user_question, text)
+            for chunk in replay_chunks(text):
+                yield "token", chunk
+            if sources:
+                yield "sources", sources
+            return
+
+        answer_parts = []
+        final = {}
+
+        # Only the stream that wins a hedge race runs to completion and fills `final`
+        stream = self.router.stream(
+            lambda endpoint: self._astream_endpoint(
+                endpoint, self._payload(endpoint, context_text, user_question, True, session), final
+            )
+        )
+
+        try:
+            async for chunk in stream:
+                timer.token()
+                answer_parts.append(chunk)
+                yield "token", chunk
+
+            if session is not None:
+                endpoint = final.get("endpoint")
+                ollama_model = endpoint.model if endpoint is not None and endpoint.provider == "ollama" else None
+                self._record_turn(session, user_question, "".join(answer_parts), final.get("context"), ollama_model)
 
             sources = self._get_sources(results)
             if sources:
-                yield "\n\n**Sources:**\n" + "\n".join(f"- {s}" for s in sources)
+                answer_parts.append(self.sources_text(sources))
+                yield "sources", sources
+
+            usage = self._usage(final)
+            if usage:
+                yield "usage", usage
+
+            self._store_answer(cache_key, query_embedding, "".join(answer_parts))
 
         except Exception as e:
             LOGGER.exception("Error during streaming query with provider=%s", self.llm_provider)
-            yield f"\nError communicating with {self.llm_provider}: {str(e)}"
+            LLM_ERRORS.inc(provider=self.llm_provider)
+            yield "error", f"Error communicating with {self.llm_provider}: {str(e)}"
+        finally:
+            await stream.aclose()
+
+    # ------------------------
+    # Sessions
+    # ------------------------
+
+    def _record_turn(self, session: Session, question: str, answer: str, ollama_context=None, ollama_model=None):
+        # Turns are stored without their retrieved context, which keeps the
+        # replayed history short; an oversized Ollama context is dropped and
+        # the history is replayed as text on the next turn instead
+        session.add_turn(question, answer)
+        if ollama_context and len(ollama_context) <= SESSION_OLLAMA_CONTEXT_TOKENS:
+            session.ollama_context = ollama_context
+            session.ollama_model = ollama_model
+        else:
+            session.ollama_context = None
+        self.sessions.put(session)
+
+        # Summarized after the answer has gone out; the next turn waits on the session lock
+        task = asyncio.create_task(self._compact_session(session))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _compact_session(self, session: Session):
+        """Folds the oldest turns into the summary once the history exceeds SESSION_HISTORY_TOKENS."""
+        async with session.lock:
+            keep = 2 * SESSION_KEEP_TURNS
+            if len(session.turns) <= keep:
+                return
+            texts = [turn["content"] for turn in session.turns]
+            if session.summary:
+                texts.append(session.summary)
+            if sum(await asyncio.to_thread(count_prompt_tokens, texts)) <= SESSION_HISTORY_TOKENS:
+                return
+
+            folded = session.turns[:len(session.turns) - keep]
+            try:
+                summary = await self._aquery_text(
+                    SUMMARY_PROMPT.format(conversation=self._transcript(session, folded))
+                )
+            except Exception as e:
+                LOGGER.warning("Summarizing session %s failed with provider=%s: %s", session.id, self.llm_provider, e)
+                return
+
+            session.summary = summary.strip()
+            session.turns = session.turns[len(folded):]
+            # The cached context still holds the folded turns verbatim
+            session.ollama_context = None
+            self.sessions.put(session)
+
+    # ------------------------
+    # Batch API
+    # ------------------------
+
+    def _prepare_batch(self, questions):
+        """
+        Batch version of `_prepare`: one embedding call and one multi-query
+        vector search for every question not answered from the cache.
+        """
+        prepared = [None] * len(questions)
+        pending = []
+
+        for i, question in enumerate(questions):
+            cache_key = None
+            if self.answer_cache:
+                cache_key = self.answer_cache.make_key(question, self._cache_scope())
+                cached = self.answer_cache.get_exact(cache_key)
+                if cached is not None:
+                    prepared[i] = (cache_key, None, cached, None, None)
+                    continue
+            pending.append((i, cache_key))
+
+        if not pending:
+            return prepared
+
+        embeddings = self.embedding_model.embed_batch([questions[i] for i, _ in pending])
+        to_search = []
+        for (i, cache_key), embedding in zip(pending, embeddings):
+            if self.answer_cache:
+                cached = self.answer_cache.get_semantic(embedding, self._cache_scope())
+                if cached is not None:
+                    prepared[i] = (cache_key, embedding, cached, None, None)
+                    continue
+            to_search.append((i, cache_key, embedding))
+
+        if to_search:
+            all_results = self.vector_store.search_batch(
+                [questions[i] for i, _, _ in to_search],
+                self.embedding_model,
+                n_results=CONTEXT_CANDIDATES,
+                query_embeddings=[embedding for _, _, embedding in to_search],
+            )
+            for (i, cache_key, embedding), results in zip(to_search, all_results):
+                packed, context_text = self._pack(results)
+                prepared[i] = (cache_key, embedding, None, packed, context_text)
+
+        return prepared
+
+    async def aquery_batch(self, questions, max_in_flight: Optional[int] = None):
+        """
+        Answers many questions with at most `max_in_flight` concurrent
+        generations, so vLLM can batch them. Yields
+        (index, answer, error) as each one completes, not in input order.
+        """
+        questions = list(questions)
+        prepared = await asyncio.to_thread(self._prepare_batch, questions)
+        slots = asyncio.Semaphore(max_in_flight or BATCH_MAX_IN_FLIGHT)
+
+        async def answer(i):
+            cache_key, query_embedding, cached, results, context_text = prepared[i]
+            if cached is not None:
+                return i, cached, None
+            async with slots:
+                try:
+                    text = await self._agenerate(questions[i], cache_key, query_embedding, results, context_text)
+                    return i, text, None
+                except Exception as e:
+                    LLM_ERRORS.inc(provider=self.llm_provider)
+                    LOGGER.warning("Batch question %d failed with provider=%s: %s", i, self.llm_provider, e)
+                    return i, None, str(e)
+
+        tasks = [asyncio.create_task(answer(i)) for i in range(len(questions))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def query_batch(self, questions, max_in_flight: Optional[int] = None):
+        """Blocking wrapper around `aquery_batch`; returns answers in input order."""
+        questions = list(questions)
+
+        async def run():
+            answers = [None] * len(questions)
+            try:
+                async for i, text, error in self.aquery_batch(questions, max_in_flight):
+                    answers[i] = text if error is None else f"Error communicating with {self.llm_provider}: {error}"
+            finally:
+                # The pooled client is bound to this temporary event loop
+                await self.async_client.aclose()
+            return answers
+
+        return asyncio.run(run())
+
+    async def aclose(self):
+        for task in list(self._background):
+            task.cancel()
+        await self.router.aclose()
+        await self.async_client.aclose()
+        self.session.close()
@@ -1,11 +1,21 @@
-import json
-import uuid
+from itertools import islice
+
+from config import OUTPUT_FILE, CHUNKS_FILE, CHUNK_MODE, CRAWL_STATE_FILE, DEDUP_ENABLED
+from records import RecordWriter, iter_records, resolve_input
+from utils import make_chunk_id
 
 def chunk_text(text, chunk_size=1000, overlap=200):
     """
     Splits text into chunks of approximately `chunk_size` characters,
     respecting sentence boundaries where possible.
     """
+    return [chunk for _, chunk in chunk_text_with_offsets(text, chunk_size, overlap)]
+
+def chunk_text_with_offsets(text, chunk_size=1000, overlap=200):
+    """
+    Same as `chunk_text`, but returns (offset, chunk) pairs where `offset` is
+    the position of the stripped chunk in `text`.
+    """
     chunks = []
     start = 0
     text_len = len(text)
@@ -25,9 +35,10 @@ def chunk_text(text, chunk_size=1000, overlap=200):
                 if last_period != -1:
                     end = last_period + 1
         
-        chunk = text[start:end].strip()
+        raw = text[start:end]
+        chunk = raw.strip()
         if chunk:
-            chunks.append(chunk)
+            chunks.append((start + len(raw) - len(raw.lstrip()), chunk))
         
         # If we reached the end, break
         if end == text_len:
@@ -48,8 +59,19 @@ def chunk_documents(documents):
     Takes a list of documents (dicts with 'text' and 'metadata')
     and returns a list of chunked records.
     """
-    all_chunks = []
-    
+    return list(iter_chunks(documents))
+
+def iter_chunks(documents, mode=None):
+    """
+    Generator version of `chunk_documents`; `documents` may be any iterable.
+    `mode` is "tokens" (embedding-tokenizer budget) or "chars" and defaults to
+    CHUNK_MODE. Chunk metadata carries the character offsets of the chunk in
+    its document ("start", "end") and, in token mode, its token count.
+    """
+    if (mode or CHUNK_MODE) == "tokens":
+        yield from _iter_token_chunks(documents)
+        return
+
     for doc in documents:
         text = doc.get("text", "")
         metadata = doc.get("metadata", {})
@@ -57,42 +79,114 @@ def chunk_documents(documents):
         if not text:
             continue
             
-        chunks = chunk_text(text)
+        source = _id_source(metadata)
+        chunks = chunk_text_with_offsets(text)
         
-        for chunk in chunks:
-            chunk_record = {
-                "id": str(uuid.uuid4()),
+        for offset, chunk in chunks:
+            yield {
+                "id": make_chunk_id(source, offset, chunk),
                 "text": chunk,
-                "metadata": metadata
+                "metadata": {**metadata, "start": offset, "end": offset + len(chunk)}
             }
-            all_chunks.append(chunk_record)
-            
-    return all_chunks
 
-def process_output_file(input_file="output.json", output_file="chunks.json"):
+def _iter_token_chunks(documents, batch_size=64):
+    from token_chunker import chunk_texts_tokens
+
+    documents = (doc for doc in documents if doc.get("text"))
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return
+
+        # One batched tokenizer call per group of documents
+        spans_per_doc = chunk_texts_tokens([doc["text"] for doc in batch])
+        for doc, spans in zip(batch, spans_per_doc):
+            text = doc["text"]
+            metadata = doc.get("metadata", {})
+            source = _id_source(metadata)
+            for start, end, tokens in spans:
+                chunk = text[start:end]
+                yield {
+                    "id": make_chunk_id(source, start, chunk),
+                    "text": chunk,
+                    "metadata": {**metadata, "start": start, "end": end, "tokens": tokens}
+                }
+
+def _id_source(metadata):
+    # Offsets of paged documents (PDFs) restart on every page, so the page is part of the id
+    source = metadata.get("source", "unknown")
+    page = metadata.get("page")
+    return source if page is None else f"{source}#page={page}"
+
+def iter_page_documents(records):
+    """Converts crawl records ({"url", "text", ...}) to the generic document format."""
+    for record in records:
+        yield {
+            "text": record.get("text", ""),
+            "metadata": {"source": record["url"]}
+        }
+
+def load_deduplicator(sources):
+    """
+    Loads the persisted near-duplicate index and forgets `sources` (pages about
+    to be chunked again) plus the pages the last crawl found removed, so
+    nothing is dropped as a copy of text that no longer exists. Unchanged
+    pages that were dropped against them earlier come back through
+    `filter_pages`.
+    """
+    from crawl_state import removed_urls
+    from dedup import Deduplicator
+
+    dedup = Deduplicator.load()
+    dedup.forget_sources(set(sources) | set(removed_urls(CRAWL_STATE_FILE)))
+    return dedup
+
+def process_output_file(input_file=OUTPUT_FILE, output_file=CHUNKS_FILE, dedup=None):
+    # Pages are read, chunked and written one record at a time
+    dedup = DEDUP_ENABLED if dedup is None else dedup
+    input_file = resolve_input(input_file)
     try:
-        with open(input_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        records = iter_records(input_file)
+        first = next(records, None)
     except FileNotFoundError:
         print(f"Error: {input_file} not found.")
         return
 
-    # Convert crawler format to generic document format
-    documents = []
-    for url, content in data.items():
-        documents.append({
-            "text": content.get("text", ""),
-            "metadata": {"source": url}
-        })
+    if first is None:
+        print(f"No pages found in {input_file}.")
+        return
+
+    deduplicator = None
+    if dedup:
+        # Cheap first pass over the URLs only
+        deduplicator = load_deduplicator(record["url"] for record in iter_records(input_file))
 
-    print(f"Processing {len(documents)} documents...")
-    all_chunks = chunk_documents(documents)
+    print(f"Processing documents from {input_file}...")
+    pages = 0
+    documents = iter_page_documents(_chain(first, records))
+    if deduplicator:
+        documents = deduplicator.filter_pages(documents)
+    with RecordWriter(output_file) as writer:
+        for doc in documents:
+            pages += 1
+            chunks = iter_chunks([doc])
+            if deduplicator:
+                chunks = deduplicator.filter_chunks(chunks)
+            for chunk in chunks:
+                writer.write(chunk)
 
-    # Save to chunks.json
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(all_chunks, f, indent=4, ensure_ascii=False)
+    print(f"Successfully created {writer.count} chunks from {pages} documents in {output_file}")
+    if deduplicator:
+        deduplicator.save()
+        stats = deduplicator.stats
+        print(
+            f"Near-duplicates dropped: {stats['pages_dropped']} pages, {stats['chunks_dropped']} chunks "
+            f"(see {deduplicator.audit_path})"
+        )
 
-    print(f"Successfully created {len(all_chunks)} chunks in {output_file}")
+def _chain(first, rest):
+    yield first
+    yield from rest
 
 if __name__ == "__main__":
     process_output_file()
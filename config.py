@@ -1,8 +1,36 @@
 START_URL = "https://khaltibyime.khalti.com/"
 MAX_PAGES = 100
 MAX_DEPTH = 3
-DELAY = 2
-OUTPUT_FILE = "output.json"
+# Concurrent crawl: worker pages sharing one browser
+CRAWL_WORKERS = 4
+# Per-host politeness (token bucket): sustained requests/second and burst size
+HOST_RATE_LIMIT = 2.0
+HOST_BURST = 4
+# Page load wait: "networkidle", "load", "domcontentloaded" or "selector"
+WAIT_STRATEGY = "domcontentloaded"
+WAIT_SELECTOR = None  # CSS selector used when WAIT_STRATEGY == "selector"
+POST_LOAD_WAIT_MS = 500  # Extra settle time after the wait condition
+# HTML extraction: "auto" (lxml when installed), "lxml" or "bs4"
+EXTRACT_ENGINE = "auto"
+# Processes extracting pages off the crawler's event loop (0 = extract inline)
+EXTRACT_PROCESSES = 2
+# Crawl output and chunks are JSON Lines (append .gz or .zst to compress);
+# legacy output.json / chunks.json are still read when the .jsonl file is missing
+OUTPUT_FILE = "output.jsonl"
+CHUNKS_FILE = "chunks.jsonl"
+# Chunking: "tokens" budgets chunks with the embedding tokenizer, "chars" is the legacy splitter
+CHUNK_MODE = "tokens"
+CHUNK_TOKENIZER = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_MAX_TOKENS = 254  # all-MiniLM-L6-v2 reads 256 tokens including [CLS]/[SEP]
+CHUNK_OVERLAP_TOKENS = 32
+CRAWL_STATE_FILE = "crawl_state.json"  # Per-URL validators and hashes for incremental crawls
+# Near-duplicate filtering between crawl output and chunks (MinHash over word shingles)
+DEDUP_ENABLED = True
+DEDUP_PAGE_THRESHOLD = 0.9  # Estimated Jaccard similarity at which a page is dropped
+DEDUP_CHUNK_THRESHOLD = 0.9  # ... and a chunk (lower values start merging tables that differ only in numbers)
+DEDUP_SHINGLE_SIZE = 5  # Words per shingle
+DEDUP_INDEX_FILE = "dedup_index.pkl"  # Signatures of kept pages/chunks, reused by incremental runs
+DEDUP_AUDIT_FILE = "dedup_audit.jsonl"  # One line per dropped page/chunk and what it duplicated
 BASE_DOMAIN = "khalti.com"  # Allow crawling subdomains and parent domain
 IGNORED_DOMAINS = [
     "google.com", "www.google.com", "play.google.com",
@@ -0,0 +1,139 @@
+import math
+import os
+
+# Context packing (overridable via environment variables)
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+DEFAULT_CONTEXT_MIN_SIMILARITY = float(os.environ.get("CONTEXT_MIN_SIMILARITY", "0.25"))
+# Tokenizer of the generation model used for prompt budgets, as a Hugging Face
+# repo with a tokenizer.json (e.g. "meta-llama/Meta-Llama-3-8B-Instruct"). Empty:
+# the embedding tokenizer, whose counts only approximate the LLM's and are
+# padded by PROMPT_TOKEN_MARGIN (0.15 = count 15% more tokens)
+PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "")
+PROMPT_TOKEN_MARGIN = float(os.environ.get("PROMPT_TOKEN_MARGIN", "0.15"))
+
+
+def count_prompt_tokens(texts):
+    """Token counts for a list of texts as the generation model sees them (see PROMPT_TOKENIZER)."""
+    from token_chunker import count_tokens, load_tokenizer
+
+    if PROMPT_TOKENIZER:
+        return count_tokens(texts, load_tokenizer(PROMPT_TOKENIZER))
+    return [math.ceil(count * (1.0 + PROMPT_TOKEN_MARGIN)) for count in count_tokens(texts)]
+
+
+def distance_to_similarity(distance: float) -> float:
+    # Chroma's default space is squared L2; on unit vectors d = 2 - 2 * cos
+    return 1.0 - distance / 2.0
+
+
+class _Passage:
+    __slots__ = ("source", "page", "start", "end", "text", "score", "metadata")
+
+    def __init__(self, source, start, end, text, score, metadata):
+        self.source = source
+        # Offsets of paged documents are relative to their page
+        self.page = metadata.get("page")
+        self.start = start
+        self.end = end
+        self.text = text
+        self.score = score
+        self.metadata = metadata
+
+
+def _merge_overlapping(passages):
+    """
+    Merges passages of the same source (and page) whose character ranges overlap or touch,
+    so overlapping chunks are sent once. Passages without offsets are only
+    de-duplicated by exact text.
+    """
+    merged = []
+    by_source = {}
+    seen_texts = set()
+
+    for passage in passages:
+        if passage.start is None:
+            if passage.text not in seen_texts:
+                seen_texts.add(passage.text)
+                merged.append(passage)
+            continue
+        by_source.setdefault((passage.source, passage.page), []).append(passage)
+
+    for source_passages in by_source.values():
+        source_passages.sort(key=lambda p: p.start)
+        current = source_passages[0]
+        for passage in source_passages[1:]:
+            if passage.start <= current.end:
+                if passage.end > current.end:
+                    current.text += passage.text[current.end - passage.start:]
+                    current.end = passage.end
+                current.score = max(current.score, passage.score)
+                # The cited span is the union of the merged ones (a copy: results stay untouched)
+                current.metadata = {**current.metadata, "start": current.start, "end": current.end}
+            else:
+                merged.append(current)
+                current = passage
+        merged.append(current)
+
+    return merged
+
+
+def build_context(results, count_tokens, token_budget=None, min_similarity=None):
+    """
+    Packs Chroma query results into a prompt context.
+
+    Drops results below `min_similarity`, merges overlapping chunks from the
+    same source, then takes passages by best score until `token_budget`
+    (counted with `count_tokens(list_of_texts) -> list_of_counts`, normally
+    `count_prompt_tokens`) is spent.
+    Packed passages are emitted in a stable (source, offset) order rather than
+    by score, so questions hitting the same chunks share a prompt prefix.
+
+    Returns (context_text, packed_results) where packed_results has the same
+    shape as a Chroma result ({"documents": [[...]], "metadatas": [[...]]}).
+    """
+    token_budget = token_budget or DEFAULT_CONTEXT_TOKEN_BUDGET
+    min_similarity = DEFAULT_CONTEXT_MIN_SIMILARITY if min_similarity is None else min_similarity
+
+    empty = {"documents": [[]], "metadatas": [[]]}
+    if not results or not results.get("documents") or not results["documents"][0]:
+        return "", empty
+
+    documents = results["documents"][0]
+    metadatas = (results.get("metadatas") or [[None] * len(documents)])[0]
+    distances = (results.get("distances") or [[None] * len(documents)])[0]
+
+    passages = []
+    for text, metadata, distance in zip(documents, metadatas, distances):
+        score = distance_to_similarity(distance) if distance is not None else 1.0
+        if score < min_similarity or not text:
+            continue
+        metadata = metadata or {}
+        passages.append(_Passage(
+            metadata.get("source", "unknown"),
+            metadata.get("start"),
+            metadata.get("end"),
+            text,
+            score,
+            metadata,
+        ))
+
+    if not passages:
+        return "", empty
+
+    passages = _merge_overlapping(passages)
+    passages.sort(key=lambda p: p.score, reverse=True)
+
+    packed = []
+    used = 0
+    for passage, tokens in zip(passages, count_tokens([p.text for p in passages])):
+        if used + tokens > token_budget:
+            continue
+        packed.append(passage)
+        used += tokens
+
+    packed.sort(key=lambda p: (p.source, p.page or 0, p.start or 0))
+    context_text = "\n\n".join(p.text for p in packed)
+    return context_text, {
+        "documents": [[p.text for p in packed]],
+        "metadatas": [[p.metadata for p in packed]],
+    }
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import time
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def removed_urls(path: str):
+    """URLs the last crawl recorded in `path` found removed."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("last_run", {}).get("removed", [])
+
+
+class CrawlState:
+    """
+    Per-URL state for incremental crawls, persisted as JSON.
+
+    Each entry keeps the HTTP validators (ETag / Last-Modified), the hash of the
+    extracted text, the outgoing links and the last crawl time. During a crawl
+    every URL is classified as added, changed, unchanged or removed; the result
+    of the last run is saved under "last_run".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages = {}
+        self.last_run = {}
+        self.added = set()
+        self.changed = set()
+        self.unchanged = set()
+        self.removed = set()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            self.pages = stored.get("pages", {})
+            self.last_run = stored.get("last_run", {})
+
+    def conditional_headers(self, url: str) -> dict:
+        # Only validators the server issued: a page without them is re-rendered
+        # and compared by content hash instead
+        entry = self.pages.get(url)
+        if not entry:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def links(self, url: str):
+        return self.pages.get(url, {}).get("links", [])
+
+    def mark_unchanged(self, url: str, validators: dict = None):
+        entry = self.pages[url]
+        entry.update({k: v for k, v in (validators or {}).items() if v})
+        entry["last_crawled"] = time.time()
+        self.unchanged.add(url)
+
+    def mark_failed(self, url: str):
+        # A failed render says nothing about the page, keep what we had
+        if url in self.pages:
+            self.unchanged.add(url)
+
+    def mark_gone(self, url: str):
+        if url in self.pages:
+            self.removed.add(url)
+
+    def record(self, url: str, text: str, links, validators: dict = None) -> str:
+        """Stores a rendered page and returns "added", "changed" or "unchanged"."""
+        digest = content_hash(text)
+        entry = self.pages.get(url)
+
+        if entry is None:
+            status = "added"
+        elif entry.get("content_hash") == digest:
+            status = "unchanged"
+        else:
+            status = "changed"
+
+        validators = validators or {}
+        self.pages[url] = {
+            "etag": validators.get("etag"),
+            "last_modified": validators.get("last_modified"),
+            "content_hash": digest,
+            "links": sorted(links),
+            "last_crawled": time.time(),
+        }
+        getattr(self, status).add(url)
+        return status
+
+    def finish(self, truncated: bool = False):
+        """
+        Closes a run. URLs that were not reached are treated as removed unless
+        the crawl stopped early at MAX_PAGES.
+        """
+        reached = self.added | self.changed | self.unchanged
+        if not truncated:
+            self.removed |= set(self.pages) - reached
+        for url in self.removed:
+            self.pages.pop(url, None)
+
+        self.last_run = {
+            "finished_at": time.time(),
+            "added": sorted(self.added),
+            "changed": sorted(self.changed),
+            "removed": sorted(self.removed),
+            "unchanged": len(self.unchanged),
+        }
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"pages": self.pages, "last_run": self.last_run}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -1,80 +1,252 @@
 from playwright.async_api import async_playwright
 from urllib.parse import urlparse
-import json
 import time
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+from crawl_state import CrawlState
 from extractor import extract_text_and_links
 from utils import normalize_url, is_internal
-from config import START_URL, MAX_PAGES, DELAY, OUTPUT_FILE, MAX_DEPTH, BASE_DOMAIN
+from config import (
+    START_URL, MAX_PAGES, OUTPUT_FILE, MAX_DEPTH, BASE_DOMAIN,
+    CRAWL_WORKERS, HOST_RATE_LIMIT, HOST_BURST,
+    WAIT_STRATEGY, WAIT_SELECTOR, POST_LOAD_WAIT_MS, CRAWL_STATE_FILE, EXTRACT_PROCESSES,
+)
 
 
-async def crawl(start_url: str):
+class HostRateLimiter:
+    """Per-host token bucket: `rate` requests/second with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._buckets = {}  # host -> (tokens, last_refill)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, url: str):
+        if self.rate <= 0:
+            return
+        host = urlparse(url).netloc
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+async def _load_page(page, url: str, wait_strategy: str, wait_selector):
+    """Navigates `page` to `url`; returns the main document's response (None if there was none)."""
+    if wait_strategy == "selector":
+        response = await page.goto(url, wait_until="domcontentloaded")
+        if wait_selector:
+            await page.wait_for_selector(wait_selector)
+    else:
+        response = await page.goto(url, wait_until=wait_strategy)
+
+    if POST_LOAD_WAIT_MS:
+        await page.wait_for_timeout(POST_LOAD_WAIT_MS)
+    return response
+
+
+def _validators(headers) -> dict:
+    return {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+    }
+
+
+async def _conditional_fetch(client, url: str, headers: dict):
+    """
+    Cheap HTTP check before rendering. Returns (status_code, validators);
+    status_code is None when the check itself failed. Only the status line
+    and headers are read; a 200 body is left for the browser to download.
+    """
+    try:
+        async with client.stream("GET", url, headers=headers) as res:
+            return res.status_code, _validators(res.headers)
+    except httpx.HTTPError as e:
+        print(f"Conditional fetch failed for {url}: {e}")
+        return None, {}
+
+
+def _extract_pool(processes: int):
+    if processes <= 0:
+        return None
+    # spawn: forked children would inherit Playwright's threads and pipes
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def crawl(
+    start_url: str,
+    workers: int = None,
+    wait_strategy: str = None,
+    wait_selector: str = None,
+    state: CrawlState = None,
+    on_page=None,
+    collect: bool = True,
+    extract_processes: int = None,
+):
+    """
+    Crawls from `start_url` and returns {url: {"text", "links"}}.
+
+    With a `state`, the crawl is incremental: each known URL gets a conditional
+    HTTP request first, and only pages that are new or whose extracted text
+    changed are rendered into the result. The state records the diff.
+    `on_page(url, page)` is called for every page added to the result; with
+    `collect=False` pages are only handed to `on_page` and not kept in memory.
+    HTML extraction runs in `extract_processes` worker processes (0 = inline
+    on the event loop).
+    """
     # Use BASE_DOMAIN from config if available, else derive from start_url
     try:
         base_domain = BASE_DOMAIN
     except NameError:
         base_domain = urlparse(start_url).netloc
-        
-    visited = set()
+
+    workers = max(1, workers or CRAWL_WORKERS)
+    wait_strategy = wait_strategy or WAIT_STRATEGY
+    wait_selector = wait_selector or WAIT_SELECTOR
+
+    start = normalize_url(start_url)
+    # Every URL ever enqueued, so duplicates are dropped at enqueue time
+    seen = {start}
     # Queue stores tuples of (url, depth)
-    queue = [(normalize_url(start_url), 0)]
+    queue = asyncio.Queue()
+    queue.put_nowait((start, 0))
+    limiter = HostRateLimiter(HOST_RATE_LIMIT, HOST_BURST)
     data = {}
+    dispatched = 0
+    truncated = False
+    http_client = httpx.AsyncClient(follow_redirects=True, timeout=15) if state is not None else None
+    extract_pool = _extract_pool(EXTRACT_PROCESSES if extract_processes is None else extract_processes)
+    loop = asyncio.get_running_loop()
 
-    async with async_playwright() as p:
-        try:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
+    def enqueue_links(links, depth):
+        # Only add new links if we haven't reached max depth
+        if depth < MAX_DEPTH:
+            for link in links:
+                if link not in seen and is_internal(link, base_domain):
+                    seen.add(link)
+                    queue.put_nowait((link, depth + 1))
+
+    async def visit(page, url, depth):
+        nonlocal dispatched, truncated
+        if dispatched >= MAX_PAGES:
+            truncated = True
+            return
+        dispatched += 1
+
+        await limiter.acquire(url)
 
-            while queue and len(visited) < MAX_PAGES:
-                url, depth = queue.pop(0)
+        validators = {}
+        # Without a server-issued ETag/Last-Modified (new URLs included) there is
+        # nothing to validate: render and let the content hash decide
+        headers = state.conditional_headers(url) if state is not None else {}
+        if headers:
+            status_code, validators = await _conditional_fetch(http_client, url, headers)
+            if status_code == 304 and url in state.pages:
+                print(f"Unchanged (Depth {depth}): {url}")
+                state.mark_unchanged(url, validators)
+                enqueue_links(state.links(url), depth)
+                return
+            if status_code in (404, 410):
+                print(f"Gone ({status_code}): {url}")
+                state.mark_gone(url)
+                return
+            await limiter.acquire(url)
 
-                if url in visited:
-                    continue
+        print(f"Visiting (Depth {depth}): {url}")
 
-                print(f"Visiting (Depth {depth}): {url}")
-                visited.add(url)
+        response = await _load_page(page, url, wait_strategy, wait_selector)
+        html = await page.content()
+        if state is not None and not headers and response is not None:
+            validators = _validators(response.headers)
 
-                try:
-                    await page.goto(url, wait_until="networkidle")
-                    await page.wait_for_timeout(2000)
+        if extract_pool is not None:
+            text, content_links, all_links = await loop.run_in_executor(
+                extract_pool, extract_text_and_links, html, url
+            )
+        else:
+            text, content_links, all_links = extract_text_and_links(html, url)
 
-                    html = await page.content()
-                    
-                    text, content_links, all_links = extract_text_and_links(html, url)
-                    
-                    # Always use all_links for crawling to ensure we don't miss pages accessible via nav/footer
-                    links = all_links
+        # Always use all_links for crawling to ensure we don't miss pages accessible via nav/footer
+        links = all_links
 
-                    data[url] = {
-                        "text": text,
-                        "links": sorted(links)
-                    }
+        if state is None or state.record(url, text, links, validators) != "unchanged":
+            page_data = {
+                "text": text,
+                "links": sorted(links)
+            }
+            if collect:
+                data[url] = page_data
+            if on_page:
+                on_page(url, page_data)
 
-                    # Only add new links if we haven't reached max depth
-                    if depth < MAX_DEPTH:
-                        for link in links:
-                            if is_internal(link, base_domain) and link not in visited:
-                                # Check if link is already in queue to avoid duplicates in queue (optional optimization)
-                                # But simple visited check is usually enough. 
-                                # We add it with depth + 1
-                                queue.append((link, depth + 1))
+        enqueue_links(links, depth)
 
-                except Exception as e:
-                    print(f"Error processing {url}: {e}")
+    async def worker(page):
+        while True:
+            url, depth = await queue.get()
+            # Any failure is confined to its URL: a dead worker would leave queue.join() waiting forever
+            try:
+                await visit(page, url, depth)
+            except Exception as e:
+                print(f"Error processing {url}: {e}")
+                if state is not None:
+                    state.mark_failed(url)
+            finally:
+                queue.task_done()
 
-                await asyncio.sleep(DELAY)
+    async with async_playwright() as p:
+        try:
+            browser = await p.chromium.launch(headless=True)
+            context = await browser.new_context()
+            pages = [await context.new_page() for _ in range(workers)]
+            tasks = [asyncio.create_task(worker(page)) for page in pages]
+
+            try:
+                await queue.join()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
             await browser.close()
         except Exception as e:
             print(f"Browser Launch Error: {e}")
+            truncated = True
+        finally:
+            if http_client is not None:
+                await http_client.aclose()
+            if extract_pool is not None:
+                extract_pool.shutdown(wait=False, cancel_futures=True)
+
+    if state is not None:
+        state.finish(truncated=truncated)
 
     return data
 
+
+async def crawl_incremental(start_url: str, state_file: str = None, **kwargs):
+    """
+    Runs an incremental crawl and persists the per-URL state. Returns
+    (changed_pages, state); `state.last_run` lists added/changed/removed URLs.
+    """
+    state = CrawlState(state_file or CRAWL_STATE_FILE)
+    data = await crawl(start_url, state=state, **kwargs)
+    state.save()
+    return data, state
+
 if __name__ == "__main__":
+    from records import RecordWriter
     print(f"Starting crawl of {START_URL}...")
-    data = asyncio.run(crawl(START_URL))
-    
-    print(f"Crawling complete. Saving to {OUTPUT_FILE}...")
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    print(f"Data saved to {OUTPUT_FILE}")
+    with RecordWriter(OUTPUT_FILE) as writer:
+        asyncio.run(crawl(START_URL, on_page=lambda url, page: writer.write({"url": url, **page}), collect=False))
+    print(f"Crawling complete. {writer.count} pages saved to {OUTPUT_FILE}")
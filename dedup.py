@@ -0,0 +1,299 @@
+import json
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (
+    DEDUP_INDEX_FILE, DEDUP_AUDIT_FILE, DEDUP_PAGE_THRESHOLD, DEDUP_CHUNK_THRESHOLD, DEDUP_SHINGLE_SIZE,
+)
+from lexical_index import tokenize
+
+_NUM_PERM = 128
+# Pages whose chunks may still be on their way to filter_chunks (token-mode
+# chunking batches 64 documents at a time)
+_RECENT_PAGES = 1024
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix64(values):
+    """splitmix64 finalizer; uint64 multiplication wraps, which is intended."""
+    values = (values ^ (values >> np.uint64(30))) * _MIX1
+    values = (values ^ (values >> np.uint64(27))) * _MIX2
+    return values ^ (values >> np.uint64(31))
+
+
+def _lsh_params(threshold: float, num_perm: int):
+    """
+    Picks (bands, rows) with bands * rows == num_perm whose LSH threshold
+    (1 / bands) ** (1 / rows) is the highest one still below `threshold`, so
+    true near-duplicates almost always collide; candidates are then verified
+    against the exact estimate.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1.0 / bands) ** (1.0 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+def _pack(document):
+    return zlib.compress(document.get("text", "").encode("utf-8")), document.get("metadata")
+
+
+def _unpack(packed):
+    text, metadata = packed
+    return {"text": zlib.decompress(text).decode("utf-8"), "metadata": metadata}
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures over word shingles, bucketed with LSH banding.
+
+    Entries are addressed by a key (page URL or chunk id) and remember their
+    source, so everything known about a page can be dropped before it is
+    processed again. Similarity is the MinHash estimate of the Jaccard
+    similarity of the two shingle sets.
+    """
+
+    def __init__(self, threshold: float, num_perm: int = _NUM_PERM, shingle_size: int = DEDUP_SHINGLE_SIZE, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        # One random 64-bit key per permutation: h_i(x) = mix(x ^ key_i)
+        rng = np.random.default_rng(seed)
+        self._keys = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64, endpoint=True)
+        self.bands, self.rows = _lsh_params(threshold, num_perm)
+        self.entries = {}  # key -> (source, signature)
+        self._by_source = {}  # source -> set of keys
+        self._buckets = [{} for _ in range(self.bands)]  # band -> {band bytes: set of keys}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def params(self):
+        return (self.threshold, self.num_perm, self.shingle_size, self.seed)
+
+    def signature(self, text: str):
+        words = tokenize(text)
+        if not words:
+            return None
+        k = self.shingle_size
+        if len(words) <= k:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        with np.errstate(over="ignore"):
+            return _mix64(hashes[:, None] ^ self._keys[None, :]).min(axis=0)
+
+    def _bands(self, signature):
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, signature[band * rows:(band + 1) * rows].tobytes()
+
+    def find(self, signature):
+        """Returns (key, similarity) of the closest entry at or above the threshold, or None."""
+        candidates = set()
+        for band, value in self._bands(signature):
+            candidates.update(self._buckets[band].get(value, ()))
+        best = None
+        for key in candidates:
+            similarity = float(np.mean(self.entries[key][1] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def add(self, key, source, signature):
+        if key in self.entries:
+            self.remove([key])
+        self.entries[key] = (source, signature)
+        self._by_source.setdefault(source, set()).add(key)
+        for band, value in self._bands(signature):
+            self._buckets[band].setdefault(value, set()).add(key)
+
+    def remove(self, keys):
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                continue
+            source, signature = entry
+            self._by_source.get(source, set()).discard(key)
+            for band, value in self._bands(signature):
+                bucket = self._buckets[band].get(value)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band][value]
+
+    def remove_sources(self, sources):
+        for source in sources:
+            self.remove(list(self._by_source.pop(source, ())))
+
+
+class Deduplicator:
+    """
+    Near-duplicate filter between crawling and chunk ingestion.
+
+    Pages whose text is a near-duplicate of an already kept page are dropped
+    before chunking; chunks that repeat a kept chunk (hero banners, promo
+    blocks, footer-like text) are dropped before they are written or embedded.
+    Both indexes persist in `path`, so incremental runs compare new pages
+    against everything kept before. Every drop is appended to `audit_path`
+    as {"kind", "id", "source", "duplicate_of", "similarity", "time"}.
+
+    A page that lost anything is remembered as depending on the sources it
+    was a copy of, with its text. When one of those sources is forgotten
+    (changed or removed), the page is re-admitted: `filter_pages` yields it
+    again after the current documents, so it is checked against what exists
+    now instead of staying out of the index for good.
+    """
+
+    def __init__(self, path: str = None, audit_path: str = None,
+                 page_threshold: float = None, chunk_threshold: float = None):
+        self.path = path or DEDUP_INDEX_FILE
+        self.audit_path = audit_path or DEDUP_AUDIT_FILE
+        self.pages = NearDuplicateIndex(DEDUP_PAGE_THRESHOLD if page_threshold is None else page_threshold)
+        self.chunks = NearDuplicateIndex(DEDUP_CHUNK_THRESHOLD if chunk_threshold is None else chunk_threshold)
+        self.stats = {"pages_kept": 0, "pages_dropped": 0, "chunks_kept": 0, "chunks_dropped": 0}
+        self._lock = threading.Lock()
+        self._audit = None
+        # source -> {"depends_on": set of kept sources, "document": page, zlib-compressed text}
+        self.dependents = {}
+        self._readmit = []
+        self._recent = OrderedDict()  # source -> page document, see _RECENT_PAGES
+
+    @classmethod
+    def load(cls, path: str = None, **kwargs):
+        dedup = cls(path, **kwargs)
+        if os.path.exists(dedup.path):
+            with open(dedup.path, "rb") as f:
+                state = pickle.load(f)
+            dedup.dependents = state.get("dependents", {})
+            dedup._readmit_sources([source for source, entry in dedup.dependents.items() if not entry["depends_on"]])
+            for index, name in ((dedup.pages, "pages"), (dedup.chunks, "chunks")):
+                stored = state.get(name, {})
+                # Signatures from other parameters are not comparable; start over,
+                # and give every page dropped against the old index another chance
+                if stored.get("params") != index.params:
+                    dedup._readmit_sources(list(dedup.dependents))
+                    continue
+                for key, (source, signature) in stored["entries"].items():
+                    index.add(key, source, signature)
+        return dedup
+
+    def forget_sources(self, sources):
+        """
+        Drops what is known about pages that are about to be re-processed or
+        were removed, and re-admits the pages that were dropped against them.
+        """
+        with self._lock:
+            sources = set(sources)
+            self.pages.remove_sources(sources)
+            self.chunks.remove_sources(sources)
+            for source in sources:
+                # Re-processed anyway, or gone
+                self.dependents.pop(source, None)
+            self._readmit_sources([
+                source for source, entry in self.dependents.items() if entry["depends_on"] & sources
+            ])
+
+    def _readmit_sources(self, sources):
+        for source in sources:
+            entry = self.dependents.pop(source)
+            if entry["document"] is not None:
+                self._readmit.append(_unpack(entry["document"]))
+
+    def _check(self, index, kind, key, source, text, document=None):
+        signature = index.signature(text)
+        if signature is None:
+            return True
+        with self._lock:
+            match = index.find(signature)
+            if match is not None and match[0] != key:
+                self.stats[f"{kind}s_dropped"] += 1
+                self._record(kind, key, source, *match)
+                self._add_dependent(source, index.entries[match[0]][0], document)
+                return False
+            index.add(key, source, signature)
+            self.stats[f"{kind}s_kept"] += 1
+            return True
+
+    def _add_dependent(self, source, kept_source, document):
+        entry = self.dependents.setdefault(source, {"depends_on": set(), "document": None})
+        entry["depends_on"].add(kept_source)
+        if entry["document"] is None and document is not None:
+            # Pages are only re-admitted whole: the diff-based upsert treats a
+            # source's missing chunks as stale
+            entry["document"] = _pack(document)
+
+    def filter_pages(self, documents):
+        """
+        Yields the documents that are not near-duplicates of a kept page,
+        then the re-admitted pages (see `forget_sources`) that still are not.
+        """
+        for document in self._with_readmitted(documents):
+            source = (document.get("metadata") or {}).get("source", "unknown")
+            if self._check(self.pages, "page", source, source, document.get("text", ""), document):
+                self._recent[source] = document
+                if len(self._recent) > _RECENT_PAGES:
+                    self._recent.popitem(last=False)
+                yield document
+
+    def _with_readmitted(self, documents):
+        yield from documents
+        while self._readmit:
+            yield self._readmit.pop(0)
+
+    def filter_chunks(self, chunks):
+        """Yields the chunks that are not near-duplicates of a kept chunk."""
+        for chunk in chunks:
+            source = (chunk.get("metadata") or {}).get("source", "unknown")
+            # The page is kept for re-admission; without it (pages not passed
+            # through filter_pages) only the dependency is recorded
+            if self._check(self.chunks, "chunk", chunk["id"], source, chunk.get("text", ""), self._recent.get(source)):
+                yield chunk
+
+    def _record(self, kind, key, source, duplicate_of, similarity):
+        if self._audit is None:
+            self._audit = open(self.audit_path, "a", encoding="utf-8")
+        self._audit.write(json.dumps({
+            "kind": kind,
+            "id": key,
+            "source": source,
+            "duplicate_of": duplicate_of,
+            "similarity": round(similarity, 4),
+            "time": time.time(),
+        }, ensure_ascii=False) + "\n")
+
+    def save(self):
+        with self._lock:
+            if self._audit is not None:
+                self._audit.close()
+                self._audit = None
+            state = {
+                name: {"params": index.params, "entries": index.entries}
+                for name, index in (("pages", self.pages), ("chunks", self.chunks))
+            }
+            # Re-admitted pages nobody consumed are re-admitted on the next load
+            for document in self._readmit:
+                source = (document.get("metadata") or {}).get("source", "unknown")
+                entry = self.dependents.setdefault(source, {"depends_on": set(), "document": None})
+                entry["document"] = _pack(document)
+            state["dependents"] = self.dependents
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
@@ -1,9 +1,118 @@
-from sentence_transformers import SentenceTransformer
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Batch size for SentenceTransformer.encode during ingestion (overridable via environment variables)
+DEFAULT_EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+# Number of encoder processes on CPU-only hosts (0 disables the pool, -1 uses every core)
+DEFAULT_EMBED_PROCESSES = int(os.environ.get("EMBED_PROCESSES", "0"))
+# Number of query embeddings kept in memory (0 disables the cache)
+DEFAULT_EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "4096"))
+
+LOGGER = logging.getLogger(__name__)
+
 
 class EmbeddingModel:
-    def __init__(self, model_name="all-MiniLM-L6-v2", model_type="sentence-transformers"):
+    def __init__(
+        self,
+        model_name="all-MiniLM-L6-v2",
+        model_type="sentence-transformers",
+        batch_size=None,
+        num_processes=None,
+        cache_size=None,
+    ):
+        # Imported here so importing this module does not pull in torch
+        from sentence_transformers import SentenceTransformer
+
         # We ignore model_type for now as we default to sentence-transformers
         self.model = SentenceTransformer(model_name)
+        self.batch_size = batch_size or DEFAULT_EMBED_BATCH_SIZE
+        self.num_processes = DEFAULT_EMBED_PROCESSES if num_processes is None else num_processes
+        self._pool = None
+        self.cache_size = DEFAULT_EMBED_CACHE_SIZE if cache_size is None else cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
     def embed(self, text):
         return self.model.encode(text).tolist()
+
+    def embed_query(self, text):
+        """
+        Returns a read-only float32 embedding for a query, served from a bounded
+        LRU cache keyed on the text hash. The array can be passed to Chroma as is.
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+
+        embedding = np.asarray(
+            self.model.encode(text, normalize_embeddings=True, convert_to_numpy=True),
+            dtype=np.float32,
+        )
+        embedding.flags.writeable = False
+
+        if self.cache_size:
+            with self._cache_lock:
+                self._cache[key] = embedding
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return embedding
+
+    def warmup(self):
+        """Runs one throwaway encode so the first real request skips lazy init."""
+        self.model.encode(["warmup"], batch_size=1, show_progress_bar=False)
+
+    def embed_batch(self, texts, batch_size=None):
+        """
+        Encodes a list of texts in batches and returns an (n, dim) float32
+        array of L2-normalized embeddings.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        batch_size = batch_size or self.batch_size
+        pool = self._get_pool()
+        if pool is not None:
+            embeddings = self.model.encode(
+                texts,
+                pool=pool,
+                batch_size=batch_size,
+                normalize_embeddings=True,
+            )
+        else:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def _get_pool(self):
+        """Starts the multi-process pool lazily; only used on CPU-only hosts."""
+        if self._pool is not None or not self.num_processes:
+            return self._pool
+        if str(self.model.device).startswith("cuda"):
+            return None
+
+        processes = os.cpu_count() if self.num_processes < 0 else self.num_processes
+        if processes < 2:
+            return None
+
+        LOGGER.info("Starting embedding pool with %d CPU processes", processes)
+        self._pool = self.model.start_multi_process_pool(["cpu"] * processes)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self.model.stop_multi_process_pool(self._pool)
+            self._pool = None
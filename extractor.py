@@ -3,9 +3,134 @@ from urllib.parse import urljoin
 import re
 
 from utils import normalize_url
+from config import EXTRACT_ENGINE
 
+try:
+    from lxml import etree
+except ImportError:  # optional fast path
+    etree = None
 
-def extract_text_and_links(html: str, current_url: str):
+_ONCLICK_RE = re.compile(r"(?:location\.href|window\.location)\s*=\s*['\"](.*?)['\"]")
+_SKIPPED_SCHEMES = ("mailto:", "tel:", "javascript:")
+_NOISE_TAGS = frozenset(["script", "style", "noscript"])
+_BOILERPLATE_TAGS = frozenset(["nav", "footer", "header"])
+_BOILERPLATE_CLASSES = frozenset(["finaxio-builder-header", "finaxio-builder-footer"])
+_BOILERPLATE_ROLES = frozenset(["navigation", "banner", "contentinfo"])
+
+
+def extract_text_and_links(html: str, current_url: str, engine: str = None):
+    """
+    Returns (text, content_links, all_links) for one page.
+
+    `all_links` covers the whole page (used for crawling), `content_links` and
+    `text` leave out nav/header/footer and theme header/footer blocks.
+    `engine` is "lxml" (single pass over the tree), "bs4" or "auto" (lxml when
+    installed); defaults to EXTRACT_ENGINE.
+    """
+    engine = (engine or EXTRACT_ENGINE).lower()
+    if engine == "auto":
+        engine = "lxml" if etree is not None else "bs4"
+    if engine == "lxml":
+        return _extract_lxml(html, current_url)
+    return _extract_bs4(html, current_url)
+
+
+# ------------------------
+# lxml: one traversal
+# ------------------------
+
+# Parsing UTF-8 bytes rather than str: lxml rejects str input carrying an XML encoding declaration
+_HTML_PARSER = (
+    etree.HTMLParser(encoding="utf-8", remove_comments=True, remove_pis=True) if etree is not None else None
+)
+
+
+def _is_boilerplate(tag, attrib):
+    if tag in _BOILERPLATE_TAGS:
+        return True
+    if attrib.get("role") in _BOILERPLATE_ROLES:
+        return True
+    classes = attrib.get("class")
+    return bool(classes) and not _BOILERPLATE_CLASSES.isdisjoint(classes.split())
+
+
+def _element_links(tag, attrib, current_url):
+    """Yields the links carried by one element's attributes."""
+    if tag == "a":
+        href = attrib.get("href")
+        if href is not None:
+            href = href.strip().strip("`").strip()
+            if not href.startswith(_SKIPPED_SCHEMES):
+                yield normalize_url(urljoin(current_url, href))
+
+    onclick = attrib.get("onclick")
+    if onclick is not None:
+        match = _ONCLICK_RE.search(onclick)
+        if match:
+            yield normalize_url(urljoin(current_url, match.group(1)))
+
+    for attr in ("data-href", "data-url"):
+        value = attrib.get(attr)
+        if value is not None:
+            yield normalize_url(urljoin(current_url, value))
+
+
+def _extract_lxml(html: str, current_url: str):
+    if not html or not html.strip():
+        return "", [], []
+    root = etree.fromstring(html.encode("utf-8"), _HTML_PARSER)
+    if root is None:
+        return "", [], []
+
+    all_links = set()
+    content_links = set()
+    strings = []
+
+    # Explicit stack instead of recursion: deeply nested page builders can
+    # exceed Python's recursion limit. Entries are (element, in_boilerplate)
+    # or (text, in_boilerplate) for tails, which belong to the parent.
+    stack = [(root, False)]
+    while stack:
+        node, boilerplate = stack.pop()
+
+        if isinstance(node, str):
+            if not boilerplate:
+                text = node.strip()
+                if text:
+                    strings.append(text)
+            continue
+
+        tag = node.tag
+        if not isinstance(tag, str) or tag in _NOISE_TAGS:
+            continue
+
+        attrib = node.attrib
+        boilerplate = boilerplate or _is_boilerplate(tag, attrib)
+
+        if attrib:
+            for link in _element_links(tag, attrib, current_url):
+                all_links.add(link)
+                if not boilerplate:
+                    content_links.add(link)
+
+        if node.text and not boilerplate:
+            text = node.text.strip()
+            if text:
+                strings.append(text)
+
+        for child in reversed(node):
+            if child.tail:
+                stack.append((child.tail, boilerplate))
+            stack.append((child, boilerplate))
+
+    return "\n".join(strings), sorted(content_links), sorted(all_links)
+
+
+# ------------------------
+# BeautifulSoup fallback
+# ------------------------
+
+def _extract_bs4(html: str, current_url: str):
     soup = BeautifulSoup(html, "html.parser")
 
     # ------------------------
@@ -29,11 +154,11 @@ def extract_text_and_links(html: str, current_url: str):
         tag.decompose()
 
     # Remove Elementor/Theme specific header/footers and roles
-    for class_name in ["finaxio-builder-header", "finaxio-builder-footer"]:
+    for class_name in _BOILERPLATE_CLASSES:
         for tag in soup.find_all(class_=class_name):
             tag.decompose()
 
-    for role in ["navigation", "banner", "contentinfo"]:
+    for role in _BOILERPLATE_ROLES:
         for tag in soup.find_all(attrs={"role": role}):
             tag.decompose()
 
@@ -57,16 +182,13 @@ def _extract_links_from_soup(soup, current_url, links_set):
     # <a href="">
     for a in soup.find_all("a", href=True):
         href = a["href"].strip().strip("`").strip()
-        if href.startswith(("mailto:", "tel:", "javascript:")):
+        if href.startswith(_SKIPPED_SCHEMES):
             continue
         links_set.add(normalize_url(urljoin(current_url, href)))
 
     # onclick="location.href='...'"
     for tag in soup.find_all(onclick=True):
-        match = re.search(
-            r"(?:location\.href|window\.location)\s*=\s*['\"](.*?)['\"]",
-            tag["onclick"]
-        )
+        match = _ONCLICK_RE.search(tag["onclick"])
         if match:
             links_set.add(normalize_url(urljoin(current_url, match.group(1))))
 
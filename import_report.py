@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+# `python -X importtime` writes one line per imported module to stderr:
+#   import time: self [us] | cumulative | imported package
+_PREFIX = "import time:"
+
+
+def parse_importtime(lines):
+    """Parses -X importtime lines into (module, self_us, cumulative_us, depth) tuples."""
+    entries = []
+    for line in lines:
+        if not line.startswith(_PREFIX):
+            continue
+        fields = line[len(_PREFIX):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return entries
+
+
+def format_report(entries, wall_seconds=None, top=20):
+    """Top-level imports (depth 0) by cumulative time, largest first."""
+    roots = sorted((e for e in entries if e[3] == 0), key=lambda e: e[2], reverse=True)
+    total_us = sum(e[2] for e in roots)
+    lines = ["", "Startup import report", f"{'cumulative':>12} {'self':>10}  module"]
+    for name, self_us, cumulative_us, _ in roots[:top]:
+        lines.append(f"{cumulative_us / 1000:>10.1f}ms {self_us / 1000:>8.1f}ms  {name}")
+    lines.append(f"{len(entries)} modules imported, {total_us / 1000:.1f}ms in imports")
+    if wall_seconds is not None:
+        lines.append(f"Wall time: {wall_seconds:.2f}s")
+    return "\n".join(lines)
+
+
+def run_with_report(script, argv, top=20):
+    """
+    Re-runs `script argv` under `-X importtime` and prints the slowest
+    top-level imports once it exits. stdin/stdout pass through, so
+    interactive commands still work; other stderr output is forwarded.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime", script, *argv],
+        stderr=subprocess.PIPE,
+        text=True,
+        env=dict(os.environ, PYTHONUNBUFFERED="1"),
+    )
+    importtime_lines = []
+    for line in process.stderr:
+        if line.startswith(_PREFIX):
+            importtime_lines.append(line)
+        else:
+            sys.stderr.write(line)
+    returncode = process.wait()
+    wall_seconds = time.perf_counter() - started
+
+    print(format_report(parse_importtime(importtime_lines), wall_seconds, top), file=sys.stderr)
+    return returncode
@@ -1,24 +1,70 @@
-import json
+import os
 from vector_store import VectorStore
 from embeddings import EmbeddingModel
+from config import CRAWL_STATE_FILE, CHUNKS_FILE
+from records import iter_records, resolve_input
+from crawl_state import removed_urls
 
-def ingest_existing_chunks(chunks_file="chunks.json"):
-    print(f"Loading chunks from {chunks_file}...")
-    try:
-        with open(chunks_file, "r", encoding="utf-8") as f:
-            chunks = json.load(f)
-    except FileNotFoundError:
+def _removed_sources_from_state(state_file=CRAWL_STATE_FILE):
+    """URLs the last incremental crawl found removed."""
+    return removed_urls(state_file)
+
+def ingest_existing_chunks(chunks_file=CHUNKS_FILE, prune=False, incremental=False):
+    chunks_file = resolve_input(chunks_file)
+    if not os.path.exists(chunks_file):
         print(f"{chunks_file} not found.")
         return
 
-    print(f"Found {len(chunks)} chunks. Ingesting into Vector Store...")
+    # Chunks are streamed record by record into the batched upsert
+    print(f"Streaming chunks from {chunks_file} into Vector Store...")
+    chunks = iter_records(chunks_file)
     
     embedding_model = EmbeddingModel()
     vector_store = VectorStore()
     
-    # Add documents
-    vector_store.add_documents(chunks, embedding_model)
-    print("Ingestion complete.")
+    # Upsert: unchanged chunks are skipped without embedding
+    removed_sources = _removed_sources_from_state() if incremental else None
+    stats = vector_store.upsert_documents(
+        chunks, embedding_model, removed_sources=removed_sources, prune=prune
+    )
+    print(f"Ingestion complete. Added {stats['added']}, skipped {stats['skipped']}, removed {stats['removed']} chunks.")
+    return stats
+
+def ingest_pdfs(directory, processes=None):
+    """
+    Extracts, chunks and embeds every PDF under `directory` in one streaming
+    pass: pages come out of a process pool, go through the chunker in batches
+    and into the batched upsert, so memory is bounded by a batch of pages.
+    Each chunk keeps its PDF (path relative to `directory`) and page number.
+    """
+    from chunker import iter_chunks
+    from pdf_loader import find_pdfs, iter_pdf_documents
+
+    files = find_pdfs(directory)
+    if not files:
+        print(f"No PDF files found in {directory}.")
+        return
+
+    print(f"Ingesting {len(files)} PDF files from {directory}...")
+    embedding_model = EmbeddingModel()
+    vector_store = VectorStore()
+
+    pages = 0
+
+    def counted(documents):
+        nonlocal pages
+        for document in documents:
+            pages += 1
+            yield document
+
+    stats = vector_store.upsert_documents(
+        iter_chunks(counted(iter_pdf_documents(files, processes))), embedding_model
+    )
+    print(
+        f"PDF ingestion complete. {pages} pages: added {stats['added']}, "
+        f"skipped {stats['skipped']}, removed {stats['removed']} chunks."
+    )
+    return stats
 
 if __name__ == "__main__":
-    ingest_existing_chunks()
\ No newline at end of file
+    ingest_existing_chunks()
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from admission import AdmissionRejected
+from chunker import chunk_documents, iter_chunks, load_deduplicator
+from config import DEDUP_ENABLED
+from metrics import INGEST_CHUNKS_EMBEDDED, INGEST_PAGES_CRAWLED, INGEST_JOBS_FINISHED
+
+# Ingest job limits (overridable via environment variables)
+INGEST_MAX_RUNNING = int(os.environ.get("INGEST_MAX_RUNNING", "1"))
+INGEST_MAX_QUEUED = int(os.environ.get("INGEST_MAX_QUEUED", "8"))
+INGEST_JOB_HISTORY = int(os.environ.get("INGEST_JOB_HISTORY", "100"))
+# Embedding worker processes for ingest jobs (0 embeds in a thread of the server process)
+INGEST_EMBED_PROCESSES = int(os.environ.get("INGEST_EMBED_PROCESSES", "1"))
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+# ------------------------
+# Embedding worker process
+# ------------------------
+
+_worker_model = None
+
+
+def _init_embed_worker():
+    global _worker_model
+    from embeddings import EmbeddingModel
+    _worker_model = EmbeddingModel()
+
+
+def _embed_in_worker(texts):
+    return _worker_model.embed_batch(texts)
+
+
+class _JobEmbedder:
+    """Duck-types EmbeddingModel.embed_batch for VectorStore, adding progress and cancellation."""
+
+    def __init__(self, job, executor=None, embedding_model=None):
+        self.job = job
+        self.executor = executor
+        self.embedding_model = embedding_model
+
+    def embed_batch(self, texts, batch_size=None):
+        self.job.check_cancelled()
+        if self.executor is not None:
+            embeddings = self.executor.submit(_embed_in_worker, list(texts)).result()
+        else:
+            embeddings = self.embedding_model.embed_batch(texts, batch_size=batch_size)
+        self.job.chunks_embedded += len(texts)
+        INGEST_CHUNKS_EMBEDDED.inc(len(texts))
+        return embeddings
+
+
+class IngestJob:
+    def __init__(self, url: str, kind: str = "url", path: str = None, delete_after: bool = False):
+        self.id = uuid.uuid4().hex
+        self.url = url  # crawl start URL, or the source name of a PDF
+        self.kind = kind  # "url" or "pdf"
+        self.path = path
+        self.delete_after = delete_after
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.pages_crawled = 0
+        self.chunks_total = 0
+        self.chunks_processed = 0
+        self.chunks_embedded = 0
+        self.result = None
+        self.error = None
+        self.task = None
+        self._cancel_event = threading.Event()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def to_dict(self) -> dict:
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "url": self.url,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "pages_crawled": self.pages_crawled,
+            "chunks_total": self.chunks_total,
+            "chunks_processed": self.chunks_processed,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_per_second": round(self.chunks_processed / elapsed, 2) if elapsed else 0.0,
+            "elapsed_seconds": round(elapsed, 2),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class IngestJobManager:
+    """
+    Runs crawl -> chunk -> embed -> store (or PDF pages -> chunk -> embed ->
+    store) as background jobs.
+
+    At most `max_running` jobs run at once and `max_queued` wait; further
+    submissions raise QueueFull. Embedding runs in a separate process pool and
+    Chroma writes run in a worker thread, so the event loop keeps serving chat.
+    With an `admission` controller, a job also holds an "ingest" slot while it
+    runs (not while it is queued), so ingest work counts against the limits
+    it shares with chat.
+    """
+
+    def __init__(self, vector_store, embedding_model, crawl_fn, max_running=None, max_queued=None, admission=None):
+        self.vector_store = vector_store
+        self.embedding_model = embedding_model
+        self.crawl_fn = crawl_fn
+        self.max_running = max_running or INGEST_MAX_RUNNING
+        self.max_queued = INGEST_MAX_QUEUED if max_queued is None else max_queued
+        self._slots = asyncio.Semaphore(self.max_running)
+        self.admission = admission
+        self._jobs = OrderedDict()
+        self._executor = None
+        self._dedup_lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None and INGEST_EMBED_PROCESSES > 0:
+            # spawn: forked children must not inherit torch/CUDA state
+            self._executor = ProcessPoolExecutor(
+                max_workers=INGEST_EMBED_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_embed_worker,
+            )
+        return self._executor
+
+    def submit(self, url: str) -> IngestJob:
+        return self._submit(IngestJob(url))
+
+    def submit_pdf(self, path: str, source: str, delete_after: bool = False) -> IngestJob:
+        """Queues ingestion of one PDF; its chunks are cited as `source` with page numbers."""
+        return self._submit(IngestJob(source, kind="pdf", path=path, delete_after=delete_after))
+
+    def _submit(self, job: IngestJob) -> IngestJob:
+        pending = sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+        if pending >= self.max_running + self.max_queued:
+            raise QueueFull(f"{pending} ingest jobs already pending")
+
+        self._jobs[job.id] = job
+        self._trim_history()
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        return [job.to_dict() for job in reversed(self._jobs.values())]
+
+    def status_counts(self) -> dict:
+        counts = {"queued": 0, "running": 0}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def cancel(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status in ("queued", "running"):
+            job._cancel_event.set()
+            job.task.cancel()
+        return job
+
+    async def _admit(self):
+        if self.admission is None:
+            return None
+        # A background job can wait out a busy server instead of failing
+        while True:
+            try:
+                return await self.admission.acquire("ingest")
+            except AdmissionRejected as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def _run(self, job: IngestJob):
+        ticket = None
+        try:
+            async with self._slots:
+                ticket = await self._admit()
+                job.status = "running"
+                job.started_at = time.time()
+                if job.kind == "pdf":
+                    job.result = await self._ingest_pdf(job)
+                else:
+                    job.result = await self._ingest(job)
+                job.status = "completed"
+        except (asyncio.CancelledError, JobCancelled):
+            job.status = "cancelled"
+        except Exception as e:
+            LOGGER.exception("Ingest job %s failed", job.id)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            if ticket is not None:
+                ticket.release()
+            job.finished_at = time.time()
+            INGEST_JOBS_FINISHED.inc(status=job.status)
+            if job.delete_after and job.path and os.path.exists(job.path):
+                os.remove(job.path)
+
+    async def _ingest(self, job: IngestJob) -> dict:
+        def on_page(url, page):
+            job.pages_crawled += 1
+            INGEST_PAGES_CRAWLED.inc()
+
+        crawled_data = await self.crawl_fn(job.url, on_page=on_page)
+        job.check_cancelled()
+
+        documents = [
+            {"text": content.get("text", ""), "metadata": {"source": page_url}}
+            for page_url, content in crawled_data.items()
+        ]
+        chunks = await asyncio.to_thread(self._chunk, documents)
+        job.chunks_total = len(chunks)
+        return await self._write(job, chunks)
+
+    def _chunk(self, documents):
+        if not DEDUP_ENABLED:
+            return chunk_documents(documents)
+        # One job at a time reads and rewrites the shared near-duplicate index
+        with self._dedup_lock:
+            dedup = load_deduplicator(doc["metadata"]["source"] for doc in documents)
+            chunks = list(dedup.filter_chunks(iter_chunks(dedup.filter_pages(documents))))
+            dedup.save()
+        return chunks
+
+    async def _ingest_pdf(self, job: IngestJob) -> dict:
+        from pdf_loader import iter_pdf_documents
+
+        def pages():
+            for document in iter_pdf_documents([(job.path, job.url)]):
+                job.pages_crawled += 1
+                INGEST_PAGES_CRAWLED.inc()
+                yield document
+
+        # Pages are extracted, chunked and embedded as the writer thread pulls them
+        return await self._write(job, iter_chunks(pages()))
+
+    async def _write(self, job: IngestJob, chunks) -> dict:
+        def on_batch(processed, added):
+            job.chunks_processed = processed
+            job.check_cancelled()
+
+        embedder = _JobEmbedder(job, self._get_executor(), self.embedding_model)
+        writer = asyncio.ensure_future(asyncio.to_thread(
+            self.vector_store.upsert_documents, chunks, embedder, progress=on_batch
+        ))
+        try:
+            return await asyncio.shield(writer)
+        except asyncio.CancelledError:
+            # The thread stops at its next batch; hold the slot until it does
+            await asyncio.gather(writer, return_exceptions=True)
+            raise
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at]
+        for job_id in finished[: max(0, len(self._jobs) - INGEST_JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    async def shutdown(self):
+        for job in list(self._jobs.values()):
+            if job.status in ("queued", "running"):
+                self.cancel(job.id)
+        tasks = [job.task for job in self._jobs.values() if job.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,190 @@
+import os
+import pickle
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+# Keep amounts like "1,000" or "0.5" and hyphenated names as single terms
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,\-][a-z0-9]+)*")
+
+
+def tokenize(text: str):
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Compact in-process inverted index with BM25 scoring.
+
+    Documents are addressed by their Chroma id. Postings are stored per term as
+    parallel arrays of (document slot, term frequency). Removing a document
+    leaves a tombstone that is dropped when the index is compacted on save.
+    """
+
+    def __init__(self, path: str = None, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = []  # slot -> id (None when removed)
+        self.doc_lengths = array("I")
+        self.slots = {}  # id -> slot
+        self.postings = {}  # term -> (array("I") slots, array("I") tfs)
+        self.total_length = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._cache = {}  # term -> (np slots, np tfs), rebuilt after writes
+
+    def __len__(self):
+        return len(self.slots)
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            index = cls(path, **kwargs)
+            index.doc_ids = state["doc_ids"]
+            index.doc_lengths = state["doc_lengths"]
+            index.postings = state["postings"]
+            index.total_length = state["total_length"]
+            index.slots = {doc_id: slot for slot, doc_id in enumerate(index.doc_ids) if doc_id is not None}
+            return index
+        return cls(path, **kwargs)
+
+    def add(self, ids, texts):
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id in self.slots:
+                    self._remove_one(doc_id)
+                terms = Counter(tokenize(text))
+                slot = len(self.doc_ids)
+                self.doc_ids.append(doc_id)
+                length = sum(terms.values())
+                self.doc_lengths.append(length)
+                self.total_length += length
+                self.slots[doc_id] = slot
+                for term, tf in terms.items():
+                    entry = self.postings.get(term)
+                    if entry is None:
+                        entry = self.postings[term] = (array("I"), array("I"))
+                    entry[0].append(slot)
+                    entry[1].append(tf)
+            self._dirty = True
+            self._cache.clear()
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self.slots:
+                    self._remove_one(doc_id)
+            self._dirty = True
+            self._cache.clear()
+
+    def _remove_one(self, doc_id):
+        slot = self.slots.pop(doc_id)
+        self.doc_ids[slot] = None
+        self.total_length -= self.doc_lengths[slot]
+
+    def search(self, query: str, n_results: int = 10):
+        """Returns [(doc_id, score)] for the best `n_results` BM25 matches."""
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self.slots)
+            if not n_docs or not terms:
+                return []
+
+            avg_length = self.total_length / n_docs
+            lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32).astype(np.float32)
+            norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+
+            for term in terms:
+                slots, tfs = self._term_arrays(term)
+                if slots is None:
+                    continue
+                df = len(slots)
+                idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                scores[slots] += idf * tfs * (self.k1 + 1) / (tfs + norm[slots])
+
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > n_results:
+                top = np.argpartition(scores[candidates], -n_results)[-n_results:]
+                candidates = candidates[top]
+            ranked = candidates[np.argsort(scores[candidates])[::-1]]
+            return [
+                (self.doc_ids[slot], float(scores[slot]))
+                for slot in ranked
+                if self.doc_ids[slot] is not None
+            ]
+
+    def _term_arrays(self, term):
+        cached = self._cache.get(term)
+        if cached is not None:
+            return cached
+        entry = self.postings.get(term)
+        if entry is None:
+            return None, None
+        slots = np.frombuffer(entry[0], dtype=np.uint32)
+        tfs = np.frombuffer(entry[1], dtype=np.uint32).astype(np.float32)
+        # Tombstoned slots keep postings until compaction; mask them out
+        alive = np.fromiter((self.doc_ids[s] is not None for s in slots), dtype=bool, count=len(slots))
+        cached = (slots[alive], tfs[alive])
+        self._cache[term] = cached
+        return cached
+
+    def compact(self):
+        """Drops tombstones and renumbers slots."""
+        with self._lock:
+            remap = {}
+            doc_ids = []
+            doc_lengths = array("I")
+            for slot, doc_id in enumerate(self.doc_ids):
+                if doc_id is not None:
+                    remap[slot] = len(doc_ids)
+                    doc_ids.append(doc_id)
+                    doc_lengths.append(self.doc_lengths[slot])
+
+            postings = {}
+            for term, (slots, tfs) in self.postings.items():
+                new_slots, new_tfs = array("I"), array("I")
+                for slot, tf in zip(slots, tfs):
+                    if slot in remap:
+                        new_slots.append(remap[slot])
+                        new_tfs.append(tf)
+                if new_slots:
+                    postings[term] = (new_slots, new_tfs)
+
+            self.doc_ids = doc_ids
+            self.doc_lengths = doc_lengths
+            self.postings = postings
+            self.slots = {doc_id: slot for slot, doc_id in enumerate(doc_ids)}
+            self._cache.clear()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self.path:
+                return
+            if len(self.doc_ids) > 1.2 * len(self.slots):
+                self.compact()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump({
+                    "doc_ids": self.doc_ids,
+                    "doc_lengths": self.doc_lengths,
+                    "postings": self.postings,
+                    "total_length": self.total_length,
+                }, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+def reciprocal_rank_fusion(rankings, k: int = 60):
+    """Fuses several ranked id lists; returns ids ordered by sum of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from typing import AsyncGenerator, Optional
+
+import httpx
+
+# Connection pool and per-phase timeouts (overridable via environment variables)
+DEFAULT_LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "512"))
+DEFAULT_LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "64"))
+DEFAULT_LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "30"))
+DEFAULT_LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+DEFAULT_LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+DEFAULT_LLM_WRITE_TIMEOUT = float(os.environ.get("LLM_WRITE_TIMEOUT", "10"))
+DEFAULT_LLM_POOL_TIMEOUT = float(os.environ.get("LLM_POOL_TIMEOUT", "30"))
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncLLMClient:
+    """
+    Shared keep-alive HTTP/1.1 connection pool for LLM providers.
+
+    The underlying httpx.AsyncClient is created lazily so it binds to the
+    running event loop (e.g. the one uvicorn starts), not the importing one.
+    """
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        write_timeout: Optional[float] = None,
+        pool_timeout: Optional[float] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or DEFAULT_LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections or DEFAULT_LLM_MAX_KEEPALIVE,
+            keepalive_expiry=keepalive_expiry or DEFAULT_LLM_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout or DEFAULT_LLM_CONNECT_TIMEOUT,
+            read=read_timeout or DEFAULT_LLM_READ_TIMEOUT,
+            write=write_timeout or DEFAULT_LLM_WRITE_TIMEOUT,
+            pool=pool_timeout or DEFAULT_LLM_POOL_TIMEOUT,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeout,
+                http1=True,
+                http2=False,
+                headers={"Content-Type": "application/json"},
+            )
+        return self._client
+
+    async def post_json(self, url: str, payload: dict) -> dict:
+        res = await self.client.post(url, content=json.dumps(payload))
+        res.raise_for_status()
+        return res.json()
+
+    async def get_json(self, url: str, timeout: Optional[float] = None) -> dict:
+        res = await self.client.get(url, timeout=timeout or self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+    async def stream_bytes(self, url: str, payload: dict) -> AsyncGenerator[bytes, None]:
+        """
+        Yields response body chunks as they arrive, for the incremental
+        decoders in streaming.py; closing the generator aborts the request.
+        """
+        async with self.client.stream("POST", url, content=json.dumps(payload)) as res:
+            res.raise_for_status()
+            async for chunk in res.aiter_bytes():
+                yield chunk
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, List, Optional
+
+from metrics import LLM_ENDPOINT_FAILURES, LLM_HEDGES, REGISTRY, gauge_lines
+
+# Endpoint list, e.g. "ollama=http://gpu1:11434,vllm=http://gpu2:8000/v1/chat/completions;meta-llama/Meta-Llama-3-8B-Instruct"
+# (an optional ";model" overrides the provider's default model). Empty: the single
+# LLM_PROVIDER endpoint.
+DEFAULT_LLM_ENDPOINTS = os.environ.get("LLM_ENDPOINTS", "")
+LLM_HEALTH_INTERVAL = float(os.environ.get("LLM_HEALTH_INTERVAL", "10"))
+LLM_HEALTH_TIMEOUT = float(os.environ.get("LLM_HEALTH_TIMEOUT", "2"))
+# Consecutive failures that open an endpoint's breaker, and how long it stays open
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_OPEN_SECONDS = float(os.environ.get("LLM_BREAKER_OPEN_SECONDS", "30"))
+# Endpoints tried per request when one fails before producing output
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "2"))
+# Hedging: when the first token takes longer than this percentile of recent
+# time-to-first-token, a second endpoint is asked too (0 = disabled)
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+LOGGER = logging.getLogger(__name__)
+
+_TTFT_WINDOW = 256
+
+# Live routers, read by one scrape-time collector; a router that is closed or
+# garbage collected drops out instead of leaving a stale collector behind
+_ROUTERS = weakref.WeakSet()
+
+
+class NoEndpointAvailable(RuntimeError):
+    pass
+
+
+class Endpoint:
+    """One LLM server and its routing state."""
+
+    def __init__(self, provider: str, url: str, model: str):
+        self.provider = provider
+        self.url = url.rstrip("/")
+        self.model = model
+        self.name = f"{provider}:{self.url}"
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.state = "closed"  # circuit breaker: closed, open or half_open
+        self.open_until = 0.0
+
+    @property
+    def health_url(self) -> str:
+        if self.provider == "ollama":
+            return f"{self.url}/api/tags"
+        base = self.url
+        if base.endswith("/chat/completions"):
+            base = base[: -len("/chat/completions")]
+        return f"{base}/models"
+
+    def available(self, now: float) -> bool:
+        if not self.healthy:
+            return False
+        # An open breaker lets one trial request through once it has cooled down
+        return self.state == "closed" or (self.state == "open" and now >= self.open_until)
+
+    def __repr__(self):
+        return f"Endpoint({self.name!r}, model={self.model!r})"
+
+
+def parse_endpoints(spec: str, default_models: dict) -> List[Endpoint]:
+    endpoints = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        provider, sep, rest = entry.partition("=")
+        provider = provider.strip().lower()
+        if not sep or provider not in default_models:
+            raise ValueError(f"Invalid LLM_ENDPOINTS entry '{entry}'. Use 'ollama=URL' or 'vllm=URL[;model]'.")
+        url, _, model = rest.partition(";")
+        endpoints.append(Endpoint(provider, url.strip(), model.strip() or default_models[provider]))
+    return endpoints
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """Client errors (4xx other than 429) are the request's fault, not the endpoint's."""
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status is None or status >= 500 or status == 429
+
+
+class _Attempt:
+    """One endpoint serving a streamed request; `first` resolves with its first chunk."""
+
+    def __init__(self, endpoint: Endpoint, stream):
+        self.endpoint = endpoint
+        self.stream = stream
+        self.first = asyncio.ensure_future(stream.__anext__())
+        self.released = False
+
+
+class LLMRouter:
+    """
+    Spreads LLM requests over several Ollama and vLLM endpoints.
+
+    Requests go to the available endpoint with the fewest outstanding
+    requests. A background task polls each endpoint's health URL (Ollama
+    /api/tags, vLLM /v1/models), and every endpoint has a circuit breaker
+    that opens after LLM_BREAKER_FAILURES consecutive failures and lets one
+    trial request through after LLM_BREAKER_OPEN_SECONDS. A request that
+    fails before producing output is retried on another endpoint. Streams can
+    be hedged: see `stream`.
+
+    The router does not know the providers' wire formats; callers pass a
+    function that runs the request against a given Endpoint.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], client, hedge_percentile: Optional[float] = None):
+        if not endpoints:
+            raise ValueError("LLMRouter needs at least one endpoint")
+        self.endpoints = endpoints
+        self.client = client
+        self.hedge_percentile = LLM_HEDGE_PERCENTILE if hedge_percentile is None else hedge_percentile
+        self._ttfts = deque(maxlen=_TTFT_WINDOW)
+        self._lock = threading.Lock()
+        self._health_task = None
+        _ROUTERS.add(self)
+
+    # ------------------------
+    # Endpoint selection and breakers
+    # ------------------------
+
+    def _acquire(self, exclude=()) -> Endpoint:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                raise NoEndpointAvailable("No LLM endpoint left to try")
+            available = [e for e in candidates if e.available(now)]
+            # Everything looks down: still try the least loaded rather than failing outright
+            endpoint = min(available or candidates, key=lambda e: (e.outstanding, random.random()))
+            if endpoint.state == "open":
+                endpoint.state = "half_open"
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint: Endpoint, error: Optional[BaseException] = None, counted: bool = True):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if not counted:
+                # Abandoned (client gone, lost a hedge race): says nothing about the endpoint
+                if endpoint.state == "half_open":
+                    endpoint.state = "open"
+                return
+            if error is None or not is_endpoint_failure(error):
+                endpoint.failures = 0
+                endpoint.state = "closed"
+                return
+            endpoint.failures += 1
+            LLM_ENDPOINT_FAILURES.inc(endpoint=endpoint.name)
+            if endpoint.state == "half_open" or endpoint.failures >= LLM_BREAKER_FAILURES:
+                if endpoint.state != "open":
+                    LOGGER.warning("Opening circuit breaker for %s after: %s", endpoint.name, error)
+                endpoint.state = "open"
+                endpoint.open_until = time.monotonic() + LLM_BREAKER_OPEN_SECONDS
+
+    def _can_retry(self, error: BaseException, tried) -> bool:
+        return is_endpoint_failure(error) and len(tried) < min(LLM_MAX_ATTEMPTS, len(self.endpoints))
+
+    # ------------------------
+    # Health checks
+    # ------------------------
+
+    def _ensure_health_checks(self):
+        # Started on first use so the task binds to the serving event loop
+        if len(self.endpoints) > 1 and LLM_HEALTH_INTERVAL > 0 and (
+            self._health_task is None or self._health_task.done()
+        ):
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(e) for e in self.endpoints))
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+    async def _check(self, endpoint: Endpoint):
+        try:
+            await self.client.get_json(endpoint.health_url, timeout=LLM_HEALTH_TIMEOUT)
+            healthy = True
+        except Exception as e:
+            healthy = False
+            if endpoint.healthy:
+                LOGGER.warning("LLM endpoint %s failed its health check: %s", endpoint.name, e)
+        if healthy and not endpoint.healthy:
+            LOGGER.info("LLM endpoint %s is healthy again", endpoint.name)
+        endpoint.healthy = healthy
+
+    # ------------------------
+    # Requests
+    # ------------------------
+
+    def call(self, request: Callable):
+        """Blocking `request(endpoint)` with failover, for the sync code paths."""
+        tried = []
+        while True:
+            endpoint = self._acquire(tried)
+            tried.append(endpoint)
+            try:
+                result = request(endpoint)
+            except Exception as e:
+                self._release(endpoint, e)
+                if self._can_retry(e, tried):
+                    LOGGER.warning("LLM request to %s failed, retrying elsewhere: %s", endpoint.name, e)
+                    continue
+                raise
+            self._release(endpoint)
+            return result
+
+    def call_stream(self, open_stream: Callable):
+        """Blocking streamed request; fails over only while nothing has been yielded yet."""
+        tried = []
+        while True:
+            endpoint = self._acquire(tried)
+            tried.append(endpoint)
+            started = False
+            stream = open_stream(endpoint)
+            try:
+                for chunk in stream:
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                stream.close()
+                self._release(endpoint, counted=False)
+                raise
+            except Exception as e:
+                self._release(endpoint, e)
+                if not started and self._can_retry(e, tried):
+                    LOGGER.warning("LLM stream from %s failed, retrying elsewhere: %s", endpoint.name, e)
+                    continue
+                raise
+            self._release(endpoint)
+            return
+
+    async def request(self, request: Callable):
+        """Awaits `request(endpoint)` with failover."""
+        self._ensure_health_checks()
+        tried = []
+        while True:
+            endpoint = self._acquire(tried)
+            tried.append(endpoint)
+            try:
+                result = await request(endpoint)
+            except asyncio.CancelledError:
+                self._release(endpoint, counted=False)
+                raise
+            except Exception as e:
+                self._release(endpoint, e)
+                if self._can_retry(e, tried):
+                    LOGGER.warning("LLM request to %s failed, retrying elsewhere: %s", endpoint.name, e)
+                    continue
+                raise
+            self._release(endpoint)
+            return result
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile <= 0 or len(self.endpoints) < 2 or len(self._ttfts) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._ttfts)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
+
+    async def stream(self, open_stream: Callable):
+        """
+        Yields the chunks of `open_stream(endpoint)`, an async generator.
+
+        An endpoint that fails before its first chunk is replaced by another.
+        With hedging enabled, a second endpoint is asked as well once the first
+        chunk is later than the LLM_HEDGE_PERCENTILE of recent first-chunk
+        times; whichever answers first is streamed and the other is closed,
+        which aborts its upstream request.
+        """
+        self._ensure_health_checks()
+        started = time.perf_counter()
+        hedge_delay = self._hedge_delay()
+        attempts = []
+        tried = []
+        hedged = False
+
+        def launch():
+            endpoint = self._acquire(tried)
+            tried.append(endpoint)
+            attempts.append(_Attempt(endpoint, open_stream(endpoint)))
+
+        async def drop(attempt, error=None, counted=True):
+            attempts.remove(attempt)
+            if not attempt.first.done():
+                attempt.first.cancel()
+            await asyncio.gather(attempt.first, return_exceptions=True)
+            await attempt.stream.aclose()
+            if not attempt.released:
+                attempt.released = True
+                self._release(attempt.endpoint, error, counted)
+
+        winner = None
+        launch()
+        try:
+            while winner is None:
+                timeout = None
+                if hedge_delay is not None and not hedged:
+                    timeout = max(0.0, started + hedge_delay - time.perf_counter())
+                done, _ = await asyncio.wait(
+                    [a.first for a in attempts], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    if len(tried) < len(self.endpoints):
+                        launch()
+                    continue
+
+                for attempt in [a for a in attempts if a.first in done]:
+                    error = attempt.first.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner = attempt
+                        break
+                    await drop(attempt, error)
+                    if not attempts:
+                        if not self._can_retry(error, tried):
+                            raise error
+                        LOGGER.warning("LLM stream from %s failed, retrying elsewhere: %s", attempt.endpoint.name, error)
+                        launch()
+
+            for attempt in list(attempts):
+                if attempt is not winner:
+                    await drop(attempt, counted=False)
+            if hedged:
+                LLM_HEDGES.inc(winner="hedge" if winner.endpoint is not tried[0] else "primary")
+
+            if isinstance(winner.first.exception(), StopAsyncIteration):
+                winner.released = True
+                self._release(winner.endpoint)
+                return
+            self._ttfts.append(time.perf_counter() - started)
+            yield winner.first.result()
+            async for chunk in winner.stream:
+                yield chunk
+            winner.released = True
+            self._release(winner.endpoint)
+        except (asyncio.CancelledError, GeneratorExit):
+            for attempt in list(attempts):
+                await drop(attempt, counted=False)
+            raise
+        except Exception as e:
+            for attempt in list(attempts):
+                await drop(attempt, e)
+            raise
+
+    async def aclose(self):
+        _ROUTERS.discard(self)
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+
+def _collect_metrics():
+    # Routers sharing an endpoint report it once: summed load, available if any router can use it
+    now = time.monotonic()
+    outstanding, available = {}, {}
+    for router in list(_ROUTERS):
+        for e in router.endpoints:
+            outstanding[e.name] = outstanding.get(e.name, 0) + e.outstanding
+            available[e.name] = max(available.get(e.name, 0), int(e.available(now)))
+    lines = gauge_lines(
+        "llm_endpoint_outstanding_requests", "Requests in flight per LLM endpoint.", outstanding, "endpoint",
+    )
+    lines += gauge_lines(
+        "llm_endpoint_available", "1 when the endpoint is healthy and its breaker lets requests through.",
+        available, "endpoint",
+    )
+    return lines
+
+
+REGISTRY.register_collector(_collect_metrics)
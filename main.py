@@ -3,30 +3,56 @@ import sys
 import os
 import asyncio
 import json
+import time
 from dotenv import load_dotenv
 from config import START_URL, OUTPUT_FILE
-from chat import ChatEngine
-from vector_store import VectorStore
-from embeddings import EmbeddingModel
+
+# Heavy modules (embeddings -> torch, chromadb, playwright) are
+# imported inside the command that needs them, so crawl/chunk start fast.
 
 # Load environment variables
 load_dotenv()
 
-def run_crawler():
+def run_crawler(incremental=False):
+    writer = None
     try:
-        from crawler import crawl
+        from crawler import crawl, crawl_incremental
         print(f"Starting crawl of {START_URL}...")
-        data = asyncio.run(crawl(START_URL))
-        
-        print(f"Crawling complete. Saving to {OUTPUT_FILE}...")
-        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-        print(f"Data saved to {OUTPUT_FILE}")
+        from records import RecordWriter, is_jsonl
+        writer = RecordWriter(OUTPUT_FILE) if is_jsonl(OUTPUT_FILE) else None
+        # JSONL output is written as pages finish instead of being held in memory
+        kwargs = {"on_page": lambda url, page: writer.write({"url": url, **page}), "collect": False} if writer else {}
+
+        if incremental:
+            # Only new or changed pages are written, so chunk/ingest skip the rest
+            data, state = asyncio.run(crawl_incremental(START_URL, **kwargs))
+            run = state.last_run
+            print(
+                f"Incremental crawl: {len(run['added'])} added, {len(run['changed'])} changed, "
+                f"{len(run['removed'])} removed, {run['unchanged']} unchanged."
+            )
+            for url in run["removed"]:
+                print(f"Removed: {url}")
+        else:
+            data = asyncio.run(crawl(START_URL, **kwargs))
+
+        if writer:
+            writer.close()
+            print(f"Crawling complete. {writer.count} pages saved to {OUTPUT_FILE}")
+        else:
+            print(f"Crawling complete. Saving to {OUTPUT_FILE}...")
+            with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4, ensure_ascii=False)
+            print(f"Data saved to {OUTPUT_FILE}")
         
     except ImportError:
         print("crawler module not found.")
     except Exception as e:  
         print(f"Crawling failed: {e}")
+    finally:
+        # A failed crawl keeps the previous output instead of a partial one
+        if writer:
+            writer.abort()
 
 def chat_loop(model_name=None):
     # Get LLM provider from environment or default to ollama
@@ -46,6 +72,10 @@ def chat_loop(model_name=None):
         print(f"Initializing Chat Engine with provider: {llm_provider}...")
     
     try:
+        from chat import ChatEngine
+        from vector_store import VectorStore
+        from embeddings import EmbeddingModel
+
         embedding_model = EmbeddingModel()
         vector_store = VectorStore()
         chat_engine = ChatEngine(
@@ -74,8 +104,56 @@ def chat_loop(model_name=None):
         except Exception as e:
             print(f"An error occurred: {e}")
 
+def run_batch(input_file, output_file, max_in_flight=None):
+    from records import RecordWriter, iter_records
+
+    try:
+        records = list(iter_records(input_file))
+    except FileNotFoundError:
+        print(f"{input_file} not found.")
+        return
+
+    # Lines may be {"id": ..., "question": ...} objects or bare strings
+    records = [r if isinstance(r, dict) else {"question": r} for r in records]
+    questions = [r.get("question") or r.get("content") or "" for r in records]
+    print(f"Answering {len(questions)} questions from {input_file}...")
+
+    try:
+        from chat import ChatEngine
+        from vector_store import VectorStore
+        from embeddings import EmbeddingModel
+
+        embedding_model = EmbeddingModel()
+        vector_store = VectorStore()
+        chat_engine = ChatEngine(vector_store, embedding_model)
+    except Exception as e:
+        print(f"Initialization failed: {e}")
+        return
+
+    async def run():
+        started = time.perf_counter()
+        with RecordWriter(output_file) as writer:
+            try:
+                # Answers are written as they complete, not in input order
+                async for i, answer, error in chat_engine.aquery_batch(questions, max_in_flight):
+                    writer.write({
+                        "id": records[i].get("id", i),
+                        "question": questions[i],
+                        "answer": answer,
+                        "error": error,
+                    })
+                    if writer.count % 10 == 0:
+                        print(f"{writer.count}/{len(questions)} answered")
+            finally:
+                await chat_engine.aclose()
+        elapsed = time.perf_counter() - started
+        print(f"Wrote {writer.count} answers to {output_file} in {elapsed:.1f}s")
+
+    asyncio.run(run())
+
 def main():
     parser = argparse.ArgumentParser(description="AI Chatbot CLI")
+    parser.add_argument("--import-times", action="store_true", help="Run the command under -X importtime and print the slowest imports afterwards")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     # Chat command
@@ -83,33 +161,58 @@ def main():
     chat_parser.add_argument("--model", default=None, help="Ollama LLM model to use (default: from OLLAMA_MODEL env var). WARNING: Use quantized models like llama3:8b-instruct-q4_K_M for RTX 3060")
 
     # Ingest command
-    ingest_parser = subparsers.add_parser("ingest", help="Ingest chunks from chunks.json")
+    ingest_parser = subparsers.add_parser("ingest", help="Ingest chunks from chunks.jsonl (or legacy chunks.json)")
+    ingest_parser.add_argument("--prune", action="store_true", help="Treat the chunks file as the whole corpus and delete chunks of sources not in it")
+    ingest_parser.add_argument("--incremental", action="store_true", help="Also delete chunks of pages the last incremental crawl found removed")
 
     # Crawl command
     crawl_parser = subparsers.add_parser("crawl", help="Crawl the website defined in config.py")
+    crawl_parser.add_argument("--incremental", action="store_true", help="Only emit pages that are new or changed since the last incremental crawl (state in crawl_state.json)")
 
     # Chunk command
-    chunk_parser = subparsers.add_parser("chunk", help="Chunk the crawled data into chunks.json")
+    chunk_parser = subparsers.add_parser("chunk", help="Chunk the crawled data into chunks.jsonl")
+    chunk_parser.add_argument("--no-dedup", action="store_true", help="Keep near-duplicate pages and chunks (see DEDUP_* in config.py)")
+
+    # PDF ingest command
+    pdf_parser = subparsers.add_parser("ingest-pdf", help="Extract, chunk and ingest every PDF under a directory")
+    pdf_parser.add_argument("directory", help="Directory searched recursively for .pdf files")
+    pdf_parser.add_argument("--processes", type=int, default=None, help="PDF extraction processes (default: PDF_PROCESSES)")
+
+    # Batch command
+    batch_parser = subparsers.add_parser("batch", help="Answer a JSONL file of questions concurrently")
+    batch_parser.add_argument("--input", required=True, help="Questions file (.jsonl), one {\"id\", \"question\"} per line")
+    batch_parser.add_argument("--output", required=True, help="Answers file (.jsonl)")
+    batch_parser.add_argument("--max-in-flight", type=int, default=None, help="Concurrent LLM generations (default: BATCH_MAX_IN_FLIGHT)")
 
     args = parser.parse_args()
 
+    if args.import_times:
+        from import_report import run_with_report
+        argv = [arg for arg in sys.argv[1:] if arg != "--import-times"]
+        sys.exit(run_with_report(os.path.abspath(__file__), argv))
+
     if args.command == "chat":
         chat_loop(args.model)
+    elif args.command == "batch":
+        run_batch(args.input, args.output, args.max_in_flight)
     elif args.command == "crawl":
-        run_crawler()
+        run_crawler(args.incremental)
     elif args.command == "chunk":
         try:
             from chunker import process_output_file
-            process_output_file()
+            process_output_file(dedup=False if args.no_dedup else None)
         except ImportError:
             print("chunker module not found.")
     elif args.command == "ingest":
         try:
             from ingest_chunks import ingest_existing_chunks
-            ingest_existing_chunks()
+            ingest_existing_chunks(prune=args.prune, incremental=args.incremental)
         except ImportError:
             print("ingest_chunks module not found.")
             print("Please ensure ingest_chunks.py exists.")
+    elif args.command == "ingest-pdf":
+        from ingest_chunks import ingest_pdfs
+        ingest_pdfs(args.directory, args.processes)
     else:
         parser.print_help()
 
@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, shared by the timing histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.label_names, key, ("le", bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Minimal Prometheus text-format registry. Collectors are callables run at
+    scrape time that return extra exposition lines, so state that already
+    lives elsewhere (cache stats, ingest jobs) costs nothing on the hot path.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_seconds", "Time spent per chat pipeline stage.", ("stage",)
+)
+TTFT_SECONDS = REGISTRY.histogram(
+    "chat_time_to_first_token_seconds", "Time from request start to the first streamed token.", ("provider",)
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "chat_tokens_per_second", "Streamed chunks per second after the first token.", ("provider",), RATE_BUCKETS
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "chat_request_seconds", "Total chat request time.", ("provider", "cached")
+)
+LLM_ERRORS = REGISTRY.counter(
+    "llm_errors_total", "Failed LLM requests.", ("provider",)
+)
+IN_FLIGHT = REGISTRY.gauge(
+    "chat_in_flight_requests", "Chat requests currently being answered."
+)
+LLM_HEDGES = REGISTRY.counter(
+    "llm_hedged_requests_total", "Second requests fired because the first token was late, by which one answered.", ("winner",)
+)
+LLM_ENDPOINT_FAILURES = REGISTRY.counter(
+    "llm_endpoint_failures_total", "Failed requests per LLM endpoint.", ("endpoint",)
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "admission_wait_seconds", "Time requests waited in the admission queue before being let in.", ("kind",)
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "admission_rejected_total", "Requests turned away by admission control.", ("kind", "reason")
+)
+INGEST_PAGES_CRAWLED = REGISTRY.counter(
+    "ingest_pages_crawled_total", "Pages crawled by ingest jobs."
+)
+INGEST_CHUNKS_EMBEDDED = REGISTRY.counter(
+    "ingest_chunks_embedded_total", "Chunks embedded by ingest jobs."
+)
+INGEST_JOBS_FINISHED = REGISTRY.counter(
+    "ingest_jobs_finished_total", "Ingest jobs that stopped, by final status.", ("status",)
+)
+
+
+def gauge_lines(name, help_text, values, label=None):
+    """Exposition lines for a gauge computed at scrape time: `values` maps label value -> number."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for key, value in values.items():
+        labels = _format_labels((label,), (key,)) if label else ""
+        lines.append(f"{name}{labels} {value}")
+    return lines
+
+
+class RequestTimer:
+    """
+    Per-request stage timings. Stage durations are recorded in a plain dict
+    (for an optional client-side trailer) and observed into the histograms.
+    The token loop only calls `token()`, which is a counter increment after
+    the first call.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+        self.cached = False
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[f"{name}_ms"] = round(elapsed * 1000, 2)
+            STAGE_SECONDS.observe(elapsed, stage=name)
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens += 1
+
+    def finish(self) -> dict:
+        end = time.perf_counter()
+        total = end - self.started
+        self.timings["total_ms"] = round(total * 1000, 2)
+        REQUEST_SECONDS.observe(total, provider=self.provider, cached=str(self.cached).lower())
+
+        if self.first_token_at is not None and not self.cached:
+            ttft = self.first_token_at - self.started
+            self.timings["ttft_ms"] = round(ttft * 1000, 2)
+            TTFT_SECONDS.observe(ttft, provider=self.provider)
+            generation = end - self.first_token_at
+            if generation > 0 and self.tokens > 1:
+                rate = (self.tokens - 1) / generation
+                self.timings["tokens_per_second"] = round(rate, 2)
+                TOKENS_PER_SECOND.observe(rate, provider=self.provider)
+        self.timings["tokens"] = self.tokens
+        self.timings["cached"] = self.cached
+        return self.timings
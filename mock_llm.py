@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# Stand-in for Ollama and vLLM used by benchmark.py. It streams synthetic
+# tokens with a fixed time to first token and token rate, so chat benchmarks
+# measure this repo's overhead and not a GPU.
+
+DEFAULT_TTFT_MS = 200.0
+DEFAULT_TOKENS_PER_SECOND = 50.0
+DEFAULT_TOKENS = 64
+
+
+def create_app(ttft_ms=DEFAULT_TTFT_MS, tokens_per_second=DEFAULT_TOKENS_PER_SECOND,
+               tokens=DEFAULT_TOKENS, jitter=0.0, seed=0):
+    """
+    Builds the mock server app.
+
+    Every response waits `ttft_ms` before the first token and then emits
+    `tokens` tokens at `tokens_per_second`. `jitter` (0..1) randomly scales
+    each delay by +/- that fraction; the RNG is seeded so runs repeat.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def delay(seconds):
+        if jitter:
+            seconds *= 1.0 + rng.uniform(-jitter, jitter)
+        return asyncio.sleep(max(0.0, seconds))
+
+    def limit(requested):
+        return min(tokens, requested) if requested else tokens
+
+    async def token_stream(count):
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await delay(ttft_ms / 1000.0)
+            for i in range(count):
+                if i:
+                    await delay(1.0 / tokens_per_second)
+                yield f"tok{i} "
+        finally:
+            stats["in_flight"] -= 1
+
+    async def full_text(count):
+        return "".join([t async for t in token_stream(count)])
+
+    @app.post("/api/generate")
+    async def ollama_generate(request: Request):
+        body = await request.json()
+        count = limit((body.get("options") or {}).get("num_predict"))
+        model = body.get("model", "mock")
+
+        if not body.get("stream", True):
+            text = await full_text(count)
+            return {"model": model, "response": text, "done": True, "eval_count": count, "context": [1, 2, 3]}
+
+        async def ndjson():
+            started = time.perf_counter()
+            async for token in token_stream(count):
+                yield json.dumps({"model": model, "response": token, "done": False}) + "\n"
+            yield json.dumps({
+                "model": model,
+                "response": "",
+                "done": True,
+                "eval_count": count,
+                "total_duration": int((time.perf_counter() - started) * 1e9),
+                "context": [1, 2, 3],
+            }) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    @app.post("/v1/chat/completions")
+    async def vllm_chat(request: Request):
+        body = await request.json()
+        count = limit(body.get("max_tokens"))
+        model = body.get("model", "mock")
+
+        if not body.get("stream"):
+            text = await full_text(count)
+            return {
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length"}],
+                "usage": {"completion_tokens": count},
+            }
+
+        async def sse():
+            async for token in token_stream(count):
+                chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": token}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = {"prompt_tokens": 0, "completion_tokens": count, "total_tokens": count}
+                yield f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    @app.get("/api/tags")
+    async def ollama_tags():
+        return {"models": [{"name": "mock:q4_K_M"}]}
+
+    @app.get("/v1/models")
+    async def vllm_models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return stats
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock Ollama / vLLM streaming server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--ttft-ms", type=float, default=DEFAULT_TTFT_MS)
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_TOKENS_PER_SECOND)
+    parser.add_argument("--tokens", type=int, default=DEFAULT_TOKENS)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app(args.ttft_ms, args.tokens_per_second, args.tokens, args.jitter, args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
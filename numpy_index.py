@@ -0,0 +1,375 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+
+import numpy as np
+
+# Share of tombstoned rows at which flush() rewrites the index without them
+DEFAULT_COMPACT_FRACTION = float(os.environ.get("VECTOR_INDEX_COMPACT_FRACTION", "0.25"))
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"
+OFFSETS_FILE = "offsets.i64"
+RECORDS_FILE = "records.jsonl"
+DELETED_FILE = "deleted.u8"
+
+# Layout written before generations existed; converted on first open
+_LEGACY_FILES = ("vectors.npy", "offsets.npy", "records.jsonl")
+
+_COPY_ROWS = 65536
+
+
+class NumpyCollection:
+    """
+    Flat float32 vector index that mirrors the subset of the Chroma
+    Collection API used by VectorStore (add/upsert/get/delete/query/count).
+
+    Layout inside `path`:
+        CURRENT            name of the live generation directory
+        gen-NNNNNN/
+            manifest.json  {"dim", "rows", "records_bytes"}
+            vectors.f32    (rows, dim) float32 matrix, opened with mmap
+            offsets.i64    byte offset of each row in records.jsonl, opened with mmap
+            records.jsonl  one {"id", "document", "metadata"} line per row, opened with mmap
+            deleted.u8     one tombstone byte per row, opened with mmap
+
+    Opening is O(1): nothing is read until a query touches it, and processes
+    forked from one parent share the mapped pages. Records are sliced out of
+    the mapping, so there is no shared file position for forked workers or
+    threads to race on. Search is one matrix-vector (or matrix-matrix for
+    batches) product plus argpartition. Vectors are expected to be unit
+    length (EmbeddingModel normalizes), and distances are squared L2 like
+    Chroma's default space.
+
+    Writes never load the corpus: new rows are appended to the files and the
+    manifest is replaced after them, so a crash mid-write leaves the previous
+    rows intact. Deletes (and the old row of an update) set a tombstone byte.
+    `flush()` compacts once DEFAULT_COMPACT_FRACTION of the rows are
+    tombstones, writing the live rows to a new generation and switching
+    CURRENT to it. Mapped files are never replaced or truncated, which
+    Windows does not allow.
+    """
+
+    def __init__(self, path: str, compact_fraction: float = None):
+        self.path = path
+        self.compact_fraction = DEFAULT_COMPACT_FRACTION if compact_fraction is None else compact_fraction
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._records = b""
+        self._vectors = self._offsets = self._deleted = None
+        self._row_of = None  # id -> live row, built lazily for id lookups
+        self._by_source = None  # metadata "source" -> set of live rows, built once per load
+        self._generation = self._current_generation()
+        self._open()
+
+    # ------------------------
+    # Storage
+    # ------------------------
+
+    def _file(self, name, generation=None):
+        return os.path.join(self.path, generation or self._generation, name)
+
+    def _current_generation(self):
+        current = os.path.join(self.path, CURRENT_FILE)
+        if os.path.exists(current):
+            with open(current, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        generation = "gen-000000"
+        os.makedirs(os.path.join(self.path, generation), exist_ok=True)
+        if all(os.path.exists(os.path.join(self.path, name)) for name in _LEGACY_FILES):
+            self._convert_legacy(generation)
+        else:
+            self._write_manifest({"dim": 0, "rows": 0, "records_bytes": 0}, generation)
+        self._set_current(generation)
+        return generation
+
+    def _convert_legacy(self, generation):
+        vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        rows = len(offsets)
+        dim = vectors.shape[1] if rows else 0
+        with open(self._file(VECTORS_FILE, generation), "wb") as f:
+            for start in range(0, rows, _COPY_ROWS):
+                f.write(np.ascontiguousarray(vectors[start:start + _COPY_ROWS], dtype=np.float32).tobytes())
+        with open(self._file(OFFSETS_FILE, generation), "wb") as f:
+            f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        with open(self._file(DELETED_FILE, generation), "wb") as f:
+            f.write(bytes(rows))
+        shutil.copyfile(os.path.join(self.path, "records.jsonl"), self._file(RECORDS_FILE, generation))
+        records_bytes = os.path.getsize(self._file(RECORDS_FILE, generation))
+        del vectors, offsets
+        self._write_manifest({"dim": dim, "rows": rows, "records_bytes": records_bytes}, generation)
+        for name in _LEGACY_FILES:
+            os.remove(os.path.join(self.path, name))
+
+    def _set_current(self, generation):
+        tmp_path = os.path.join(self.path, CURRENT_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(generation)
+        os.replace(tmp_path, os.path.join(self.path, CURRENT_FILE))
+
+    def _write_manifest(self, manifest, generation=None):
+        path = self._file(MANIFEST_FILE, generation)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _open(self):
+        self._close()
+        with open(self._file(MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self._manifest = json.load(f)
+        rows, dim = self._manifest["rows"], self._manifest["dim"]
+        if rows:
+            self._vectors = np.memmap(self._file(VECTORS_FILE), dtype=np.float32, mode="r", shape=(rows, dim))
+            self._offsets = np.memmap(self._file(OFFSETS_FILE), dtype=np.int64, mode="r", shape=(rows,))
+            # Writable: tombstones are set in place and seen by every process mapping the file
+            self._deleted = np.memmap(self._file(DELETED_FILE), dtype=np.uint8, mode="r+", shape=(rows,))
+            with open(self._file(RECORDS_FILE), "rb") as f:
+                self._records = mmap.mmap(f.fileno(), self._manifest["records_bytes"], access=mmap.ACCESS_READ)
+        else:
+            self._vectors = np.empty((0, dim), dtype=np.float32)
+            self._offsets = np.empty(0, dtype=np.int64)
+            self._deleted = np.empty(0, dtype=np.uint8)
+
+    def _close(self):
+        # Mappings must be closed before their files can be removed on Windows
+        for array in (self._vectors, self._offsets, self._deleted):
+            if isinstance(array, np.memmap):
+                if array.mode == "r+":
+                    array.flush()
+                array._mmap.close()
+        self._vectors = self._offsets = self._deleted = None
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        self._records = b""
+
+    def _read_record(self, row):
+        start = int(self._offsets[row])
+        end = int(self._offsets[row + 1]) if row + 1 < len(self._offsets) else self._manifest["records_bytes"]
+        return json.loads(self._records[start:end])
+
+    def _append(self, ids, documents, metadatas, vectors):
+        """Appends rows after the manifest's end (overwriting what a crashed write left there)."""
+        rows, records_bytes = self._manifest["rows"], self._manifest["records_bytes"]
+        dim = self._manifest["dim"] or vectors.shape[1]
+
+        offsets = np.empty(len(ids), dtype=np.int64)
+        lines = []
+        position = records_bytes
+        for i, (doc_id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+            line = json.dumps({"id": doc_id, "document": document, "metadata": metadata}, ensure_ascii=False)
+            line = line.encode("utf-8") + b"\n"
+            offsets[i] = position
+            position += len(line)
+            lines.append(line)
+
+        for name, at, data in (
+            (VECTORS_FILE, rows * dim * 4, np.ascontiguousarray(vectors, dtype=np.float32).tobytes()),
+            (OFFSETS_FILE, rows * 8, offsets.tobytes()),
+            (RECORDS_FILE, records_bytes, b"".join(lines)),
+            (DELETED_FILE, rows, bytes(len(ids))),
+        ):
+            path = self._file(name)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(at)
+                f.write(data)
+
+        self._write_manifest({"dim": dim, "rows": rows + len(ids), "records_bytes": position})
+        self._open()
+        return range(rows, rows + len(ids))
+
+    def _tombstone(self, rows):
+        for row in rows:
+            self._deleted[row] = 1
+            self._unindex_source(row)
+        if len(rows) and isinstance(self._deleted, np.memmap):
+            self._deleted.flush()
+
+    def flush(self):
+        with self._lock:
+            rows = self._manifest["rows"]
+            if rows and int(self._deleted.sum()) > rows * self.compact_fraction:
+                self._compact()
+
+    def _compact(self):
+        """Writes the live rows to a new generation, in blocks, and switches CURRENT to it."""
+        live = np.flatnonzero(self._deleted == 0)
+        generation = f"gen-{int(self._generation.split('-')[1]) + 1:06d}"
+        os.makedirs(os.path.join(self.path, generation), exist_ok=True)
+
+        offsets = np.empty(len(live), dtype=np.int64)
+        position = 0
+        with open(self._file(VECTORS_FILE, generation), "wb") as vectors_file, \
+                open(self._file(RECORDS_FILE, generation), "wb") as records_file:
+            for start in range(0, len(live), _COPY_ROWS):
+                block = live[start:start + _COPY_ROWS]
+                vectors_file.write(np.ascontiguousarray(self._vectors[block]).tobytes())
+                for i, row in enumerate(block, start):
+                    begin = int(self._offsets[row])
+                    end = int(self._offsets[row + 1]) if row + 1 < len(self._offsets) else self._manifest["records_bytes"]
+                    offsets[i] = position
+                    records_file.write(self._records[begin:end])
+                    position += end - begin
+        with open(self._file(OFFSETS_FILE, generation), "wb") as f:
+            f.write(offsets.tobytes())
+        with open(self._file(DELETED_FILE, generation), "wb") as f:
+            f.write(bytes(len(live)))
+        self._write_manifest({"dim": self._manifest["dim"], "rows": len(live), "records_bytes": position}, generation)
+
+        old = self._generation
+        self._set_current(generation)
+        self._close()
+        self._generation = generation
+        self._open()
+        self._row_of = None
+        self._by_source = None
+        # Another process may still map the old files; a later compaction retries
+        for name in os.listdir(self.path):
+            if name.startswith("gen-") and name != generation:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        return old
+
+    # ------------------------
+    # Collection API
+    # ------------------------
+
+    def count(self):
+        with self._lock:
+            return self._manifest["rows"] - int(self._deleted.sum())
+
+    def add(self, ids, documents, metadatas, embeddings):
+        self.upsert(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        with self._lock:
+            self._ensure_row_index()
+            # Last occurrence wins when an id repeats within one call
+            latest = {doc_id: i for i, doc_id in enumerate(ids)}
+            keep = sorted(latest.values())
+            if not keep:
+                return
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            replaced = [self._row_of[ids[i]] for i in keep if ids[i] in self._row_of]
+
+            # New rows go in before the old ones are tombstoned, so a crash in
+            # between leaves a duplicate (resolved on load), never a lost row
+            new_rows = self._append(
+                [ids[i] for i in keep], [documents[i] for i in keep], [metadatas[i] for i in keep], embeddings[keep]
+            )
+            self._tombstone(replaced)
+            for i, row in zip(keep, new_rows):
+                self._row_of[ids[i]] = row
+                if self._by_source is not None:
+                    self._by_source.setdefault(self._source_of(metadatas[i]), set()).add(row)
+
+    def delete(self, ids):
+        with self._lock:
+            self._ensure_row_index()
+            self._tombstone([self._row_of.pop(doc_id) for doc_id in ids if doc_id in self._row_of])
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        with self._lock:
+            rows = self._select_rows(ids, where)
+            if offset:
+                rows = rows[offset:]
+            if limit is not None:
+                rows = rows[:limit]
+            return self._rows_to_result(rows, include)
+
+    def query(self, query_embeddings, n_results=10, include=("documents", "metadatas", "distances")):
+        """Batch search: one row of results per query embedding."""
+        with self._lock:
+            result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+            deleted = np.asarray(self._deleted, dtype=bool)
+            alive = len(deleted) - int(deleted.sum())
+            if not alive:
+                for key in result:
+                    result[key] = [[] for _ in queries]
+                return result
+
+            scores = queries @ self._vectors.T
+            scores[:, deleted] = -np.inf
+            k = min(n_results, alive)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for query_scores, candidates in zip(scores, top):
+                ranked = candidates[np.argsort(-query_scores[candidates])]
+                row_result = self._rows_to_result(ranked.tolist(), include)
+                for key in ("ids", "documents", "metadatas"):
+                    result[key].append(row_result.get(key, []))
+                result["distances"].append([float(2.0 - 2.0 * query_scores[i]) for i in ranked])
+            return result
+
+    # ------------------------
+    # Helpers
+    # ------------------------
+
+    def _live_rows(self):
+        return np.flatnonzero(np.asarray(self._deleted) == 0).tolist()
+
+    def _ensure_row_index(self):
+        if self._row_of is None:
+            row_of = {}
+            duplicates = []
+            for row in self._live_rows():
+                doc_id = self._read_record(row)["id"]
+                if doc_id in row_of:
+                    # Left behind by a crash between appending an update and tombstoning the old row
+                    duplicates.append(row_of[doc_id])
+                row_of[doc_id] = row
+            self._row_of = row_of
+            self._tombstone(duplicates)
+
+    @staticmethod
+    def _source_of(metadata):
+        return (metadata or {}).get("source")
+
+    def _ensure_source_index(self):
+        if self._by_source is None:
+            self._by_source = {}
+            for row in self._live_rows():
+                self._by_source.setdefault(self._source_of(self._row(row)[2]), set()).add(row)
+
+    def _unindex_source(self, row):
+        if self._by_source is not None:
+            self._by_source.get(self._source_of(self._row(row)[2]), set()).discard(row)
+
+    def _select_rows(self, ids, where):
+        if ids is not None:
+            self._ensure_row_index()
+            rows = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+        elif where and "source" in where:
+            # Per-source lookups (upsert_documents) would otherwise parse every record each time
+            self._ensure_source_index()
+            rows = sorted(self._by_source.get(where["source"], ()))
+        else:
+            rows = self._live_rows()
+
+        if where:
+            rows = [
+                row for row in rows
+                if all((self._row(row)[2] or {}).get(key) == value for key, value in where.items())
+            ]
+        return rows
+
+    def _row(self, row):
+        """Returns (id, document, metadata) of a row."""
+        record = self._read_record(row)
+        return record["id"], record["document"], record["metadata"]
+
+    def _vector(self, row):
+        return np.array(self._vectors[row])
+
+    def _rows_to_result(self, rows, include):
+        records = [self._row(row) for row in rows]
+        result = {"ids": [record[0] for record in records]}
+        if "documents" in include:
+            result["documents"] = [record[1] for record in records]
+        if "metadatas" in include:
+            result["metadatas"] = [record[2] for record in records]
+        if "embeddings" in include:
+            result["embeddings"] = [self._vector(row) for row in rows]
+        return result
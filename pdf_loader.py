@@ -1,16 +1,115 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pypdf
 
+# PDF extraction (overridable via environment variables)
+PDF_PROCESSES = int(os.environ.get("PDF_PROCESSES", "2"))  # 0 extracts in the calling process
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "16"))
+
+
+def iter_pdf_pages(file_path, start=0, end=None):
+    """
+    Yields (page_number, text) for pages [start, end) of a PDF, numbered from 1.
+    pypdf parses pages on access, so only one page's content is held at a time.
+    """
+    reader = pypdf.PdfReader(file_path)
+    pages = reader.pages
+    end = len(pages) if end is None else min(end, len(pages))
+    for index in range(start, end):
+        try:
+            text = pages[index].extract_text() or ""
+        except Exception as e:
+            print(f"Error reading page {index + 1} of {file_path}: {e}")
+            text = ""
+        yield index + 1, text
+
+
 def load_pdf(file_path):
     """
     Extracts text from a PDF file.
     """
-    text = ""
     try:
-        reader = pypdf.PdfReader(file_path)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        return "".join(text + "\n" for _, text in iter_pdf_pages(file_path))
     except Exception as e:
         print(f"Error reading PDF {file_path}: {e}")
         return None
-        
-    return text
+
+
+def count_pages(file_path) -> int:
+    return len(pypdf.PdfReader(file_path).pages)
+
+
+def _page_documents(file_path, source, start, end):
+    """Documents for one page range; runs in a worker process."""
+    return [
+        {"text": text, "metadata": {"source": source, "page": page}}
+        for page, text in iter_pdf_pages(file_path, start, end)
+        if text.strip()
+    ]
+
+
+def _page_tasks(files, pages_per_task):
+    for file_path, source in files:
+        try:
+            total = count_pages(file_path)
+        except Exception as e:
+            print(f"Error reading PDF {file_path}: {e}")
+            continue
+        for start in range(0, total, pages_per_task):
+            yield file_path, source, start, start + pages_per_task
+
+
+def iter_pdf_documents(files, processes=None, pages_per_task=None):
+    """
+    Yields one {"text", "metadata": {"source", "page"}} document per non-empty
+    page of `files`, an iterable of (file_path, source) pairs.
+
+    Page ranges of `pages_per_task` pages are extracted across `processes`
+    worker processes. At most two ranges per worker are in flight, so memory
+    stays bounded however large the PDFs are. Documents come out in file and
+    page order.
+    """
+    processes = PDF_PROCESSES if processes is None else processes
+    pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
+    tasks = _page_tasks(files, pages_per_task)
+
+    if processes <= 0:
+        for task in tasks:
+            yield from _page_documents(*task)
+        return
+
+    # spawn: callers may already hold torch or a Playwright browser
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append((task, executor.submit(_page_documents, *task)))
+            while len(pending) >= 2 * processes:
+                yield from _task_result(*pending.popleft())
+        while pending:
+            yield from _task_result(*pending.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _task_result(task, future):
+    try:
+        return future.result()
+    except Exception as e:
+        file_path, _, start, end = task
+        print(f"Error reading pages {start + 1}-{end} of {file_path}: {e}")
+        return []
+
+
+def find_pdfs(directory):
+    """Returns (path, source) for every PDF under `directory`; source is the path relative to it."""
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if name.lower().endswith(".pdf"):
+                path = os.path.join(root, name)
+                files.append((path, os.path.relpath(path, directory)))
+    return sorted(files)
@@ -0,0 +1,108 @@
+import gzip
+import io
+import json
+import os
+
+
+def is_jsonl(path: str) -> bool:
+    return any(path.endswith(ext) for ext in (".jsonl", ".jsonl.gz", ".jsonl.zst"))
+
+
+def _open(path: str, mode: str, name: str = None):
+    """
+    Opens a text stream, compressing by the extension of `name` (defaults to
+    `path`): .gz via gzip, .zst via zstandard.
+    """
+    name = name or path
+    if name.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstandard is required for .zst files: pip install zstandard")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def resolve_input(path: str) -> str:
+    """
+    Returns `path` if it exists, otherwise its legacy .json counterpart
+    (e.g. output.json for output.jsonl) so old files stay readable.
+    """
+    if os.path.exists(path) or not is_jsonl(path):
+        return path
+    legacy = path[: path.index(".jsonl")] + ".json"
+    return legacy if os.path.exists(legacy) else path
+
+
+def iter_records(path: str):
+    """
+    Yields records one at a time from a JSONL file (optionally compressed).
+
+    Legacy .json files are still accepted: a list yields its items, and a crawl
+    dict {url: page} yields {"url": url, **page}. Those are loaded whole.
+    """
+    path = resolve_input(path)
+
+    if not is_jsonl(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            for url, page in data.items():
+                yield {"url": url, **page}
+        else:
+            yield from data
+        return
+
+    with _open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class RecordWriter:
+    """
+    Appends records to a JSONL file as they are produced; writes atomically on
+    close. Leaving a `with` block through an exception aborts instead, so a
+    failed run never replaces the previous file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._tmp_path = f"{path}.tmp"
+        self._file = _open(self._tmp_path, "w", name=path)
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False))
+        self._file.write("\n")
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Discards everything written so far and keeps the existing file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
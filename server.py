@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket
+from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional
 import asyncio
+import json
 import os
+import shutil
+import tempfile
 import uvicorn
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
@@ -16,19 +20,32 @@ load_dotenv()
 from chat import ChatEngine
 from vector_store import VectorStore
 from embeddings import EmbeddingModel
-from crawler import crawl
-from chunker import chunk_documents
 from config import OUTPUT_FILE
+from ws_chat import ChatSocketSession
+from ingest_jobs import IngestJobManager, QueueFull
+from metrics import REGISTRY, gauge_lines
+from admission import AdmissionController, AdmissionRejected
+from streaming import coalesce_tokens, encode_sse
+
+# Uploaded PDFs wait here until their ingest job has read them
+PDF_UPLOAD_DIR = os.getenv("PDF_UPLOAD_DIR", "uploads")
 
 # Global instances
 chat_engine = None
 vector_store = None
 embedding_model = None
+ingest_jobs = None
+admission = None
+
+async def crawl(start_url: str, **kwargs):
+    # Playwright is only needed once an ingest job actually runs
+    from crawler import crawl as run_crawl
+    return await run_crawl(start_url, **kwargs)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global chat_engine, vector_store, embedding_model
+    global chat_engine, vector_store, embedding_model, ingest_jobs, admission
     print("Initializing models...")
     
     # Get configuration from environment variables
@@ -49,12 +66,46 @@ async def lifespan(app: FastAPI):
         vllm_api_url=vllm_api_url,
         vllm_model=vllm_model
     )
+    admission = AdmissionController()
+    ingest_jobs = IngestJobManager(vector_store, embedding_model, crawl, admission=admission)
     print(f"Models initialized with provider: {llm_provider}")
+
+    # Warm up the encoder and the Chroma index so the first request is not slow
+    print("Warming up embedding model and vector store...")
+    await asyncio.to_thread(embedding_model.warmup)
+    await asyncio.to_thread(vector_store.warmup, embedding_model)
     yield
-    # Shutdown (if needed)
+    # Shutdown: stop ingest jobs and release pooled LLM connections
+    if ingest_jobs:
+        await ingest_jobs.shutdown()
+    if chat_engine:
+        await chat_engine.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
+
+def _collect_state_metrics():
+    # Read at scrape time from state the components already keep
+    lines = []
+    if chat_engine and chat_engine.answer_cache:
+        stats = chat_engine.answer_cache.stats()
+        lines += [
+            "# HELP answer_cache_lookups_total Answer cache lookups by result.",
+            "# TYPE answer_cache_lookups_total counter",
+            f'answer_cache_lookups_total{{result="exact_hit"}} {stats["exact_hits"]}',
+            f'answer_cache_lookups_total{{result="semantic_hit"}} {stats["semantic_hits"]}',
+            f'answer_cache_lookups_total{{result="miss"}} {stats["misses"]}',
+        ]
+        lines += gauge_lines("answer_cache_entries", "Answers currently cached.", {"": stats["size"]})
+    if ingest_jobs:
+        lines += gauge_lines("ingest_jobs", "Ingest jobs in history by status.", ingest_jobs.status_counts(), "status")
+    if chat_engine and hasattr(chat_engine.sessions, "__len__"):
+        lines += gauge_lines("chat_sessions", "Conversation sessions held in memory.", {"": len(chat_engine.sessions)})
+    return lines
+
+
+REGISTRY.register_collector(_collect_state_metrics)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins for dev
@@ -65,12 +116,42 @@ app.add_middleware(
 
 class ChatRequest(BaseModel):
     messages: List[dict]
+    session_id: Optional[str] = None
 
 class IngestUrlRequest(BaseModel):
     url: str
 
+def _message_text(message: dict) -> str:
+    text = message.get('content')
+    # Fallback for Vercel AI SDK 'parts' if present (multimodal)
+    if not text and 'parts' in message:
+        # parts is a list of {type: 'text', text: '...'}
+        text = "\n".join(p.get('text', '') for p in message['parts'] if p.get('type') == 'text')
+    return text
+
+def _client_key(connection) -> str:
+    return connection.client.host if connection.client else "unknown"
+
+async def _admit(kind: str, connection):
+    # Reject up front with Retry-After rather than letting requests pile up upstream
+    if not admission:
+        raise HTTPException(status_code=503, detail="Server not initialized")
+    try:
+        return await admission.acquire(kind, _client_key(connection))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+def _check_rate(kind: str, connection):
+    # Counts against the client's rate limit without taking a slot
+    if not admission:
+        return
+    try:
+        admission.check_rate(kind, _client_key(connection))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/api/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request, timings: bool = False, format: Optional[str] = None):
     global chat_engine
     if not chat_engine:
         raise HTTPException(status_code=503, detail="Chat engine not initialized")
@@ -81,81 +162,182 @@ async def chat(request: ChatRequest):
          raise HTTPException(status_code=400, detail="No messages provided")
          
     last_msg = request.messages[-1]
-    user_message = last_msg.get('content')
-    
-    if not user_message:
-        print(f"DEBUG: Message content missing. Keys found: {last_msg.keys()}")
-        # Fallback for Vercel AI SDK 'parts' if present (multimodal)
-        if 'parts' in last_msg:
-             # parts is a list of {type: 'text', text: '...'}
-             texts = [p.get('text', '') for p in last_msg['parts'] if p.get('type') == 'text']
-             user_message = "\n".join(texts)
+    user_message = _message_text(last_msg)
              
     if not user_message:
+         print(f"DEBUG: Message content missing. Keys found: {last_msg.keys()}")
          raise HTTPException(status_code=400, detail="Last message has no content")
 
-    # Stream the response
-    return StreamingResponse(chat_engine.query_stream(user_message), media_type="text/plain")
+    # ?format=sse (or Accept: text/event-stream) streams structured events
+    # instead of plain text; either way tokens are coalesced into fewer writes
+    if format is None:
+        format = "sse" if "text/event-stream" in http_request.headers.get("accept", "") else "text"
+    if format not in ("text", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'text' or 'sse'")
+
+    # Non-interactive callers mark themselves so interactive chat goes first
+    kind = "batch" if http_request.headers.get("x-request-priority", "").lower() == "batch" else "chat"
+    ticket = await _admit(kind, http_request)
+    try:
+        return _chat_response(request, user_message, ticket, format, timings)
+    except BaseException:
+        # Nothing will stream, so nothing else would release the slot
+        ticket.release()
+        raise
+
+def _chat_response(request: ChatRequest, user_message: str, ticket, format: str, timings: bool):
+    # Multi-turn: continue the server-side session, or start one from the
+    # history the client sent. The id comes back in X-Session-Id; later turns
+    # only need to send it with the new message.
+    session = None
+    headers = {}
+    if request.session_id or len(request.messages) > 1:
+        history = [{"role": m.get("role"), "content": _message_text(m)} for m in request.messages[:-1]]
+        session = chat_engine.sessions.get_or_create(request.session_id, history)
+        headers["X-Session-Id"] = session.id
+
+    # Stream the response; the admission slot is held until the stream ends
+    async def stream():
+        result = {} if timings else None
+        events = coalesce_tokens(chat_engine.aquery_events(user_message, timings=result, session=session))
+        try:
+            async for event, data in events:
+                text = chat_engine.event_text(event, data)
+                if text:
+                    yield text
+            if timings:
+                # Opt-in trailer: one final line with this request's stage timings
+                yield "\n\n[timings] " + json.dumps(result)
+        finally:
+            await events.aclose()
+            ticket.release()
+
+    async def stream_sse():
+        # Events: token {"text"}, sources {"sources"}, usage {token counts},
+        # error {"detail"}, then always done {"session_id"[, "timings"]}
+        result = {} if timings else None
+        events = coalesce_tokens(chat_engine.aquery_events(user_message, timings=result, session=session))
+        try:
+            async for event, data in events:
+                if event == "token":
+                    data = {"text": data}
+                elif event == "sources":
+                    data = {"sources": data}
+                elif event == "error":
+                    data = {"detail": data}
+                yield encode_sse(event, data)
+            done = {"session_id": session.id if session is not None else None}
+            if timings:
+                done["timings"] = result
+            yield encode_sse("done", done)
+        finally:
+            await events.aclose()
+            ticket.release()
+
+    # The background task covers a client that left before the body started
+    if format == "sse":
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        return StreamingResponse(
+            stream_sse(), media_type="text/event-stream", headers=headers, background=BackgroundTask(ticket.release)
+        )
+    return StreamingResponse(
+        stream(), media_type="text/plain", headers=headers, background=BackgroundTask(ticket.release)
+    )
+
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = chat_engine.sessions.get(session_id) if chat_engine else None
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    data = session.to_dict()
+    data["ollama_context_tokens"] = len(data.pop("ollama_context") or [])
+    return data
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not chat_engine or not chat_engine.sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"status": "deleted", "session_id": session_id}
 
 @app.websocket("/ws/chat")
 async def websocket_chat(websocket: WebSocket):
     await websocket.accept()
-    try:
-        while True:
-            data = await websocket.receive_text()
-            # Basic handling: query engine and send back response
-            # Note: This expects raw text. If client sends JSON, we might need to parse.
-            # But let's just try to support it.
-            if chat_engine:
-                 response_stream = chat_engine.query_stream(data)
-                 for chunk in response_stream:
-                     await websocket.send_text(chunk)
-            else:
-                 await websocket.send_text("Error: Chat engine not initialized")
-    except Exception as e:
-        print(f"WebSocket disconnected: {e}")
-
-@app.post("/api/ingest/url")
-async def ingest_url(request: IngestUrlRequest):
+    # JSON frames carry request ids so one socket can run several questions;
+    # plain-text frames keep the old raw-chunk behaviour.
+    await ChatSocketSession(websocket, chat_engine, admission, _client_key(websocket)).run()
+    print("WebSocket disconnected")
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    if not chat_engine or not chat_engine.answer_cache:
+        return {"enabled": False}
+    return {"enabled": True, **chat_engine.answer_cache.stats()}
+
+@app.post("/api/ingest/url", status_code=202)
+async def ingest_url(request: IngestUrlRequest, http_request: Request):
     url = request.url
     print(f"Received ingest request for: {url}")
-    
+
+    if not ingest_jobs:
+        raise HTTPException(status_code=503, detail="Ingest jobs not initialized")
+
+    # Crawl, chunk and embed run as a background job; poll /api/ingest/jobs/{id}.
+    # The job takes its "ingest" admission slot once it starts running.
+    _check_rate("ingest", http_request)
     try:
-        # 1. Crawl
-        # We need to run the async crawl function
-        # Since we are in an async route, we can await it directly
-        print("Starting crawl...")
-        crawled_data = await crawl(url)
-        print(f"Crawl complete. Found {len(crawled_data)} pages.")
-        
-        # 2. Chunk
-        print("Chunking data...")
-        documents = []
-        for page_url, content in crawled_data.items():
-            documents.append({
-                "text": content.get("text", ""),
-                "metadata": {"source": page_url}
-            })
-        
-        chunks = chunk_documents(documents)
-        print(f"Created {len(chunks)} chunks.")
-        
-        # 3. Ingest
-        global vector_store, embedding_model
-        if not vector_store or not embedding_model:
-             # Just in case
-             embedding_model = EmbeddingModel()
-             vector_store = VectorStore()
-        
-        print("Ingesting into Vector Store...")
-        vector_store.add_documents(chunks, embedding_model)
-        print("Ingestion complete.")
-        
-        return {"status": "success", "message": f"Successfully ingested {len(chunks)} chunks from {url}", "chunks": len(chunks)}
-        
-    except Exception as e:
-        print(f"Error during ingestion: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        job = ingest_jobs.submit(url)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {"status": job.status, "job_id": job.id, "url": url}
+
+@app.post("/api/ingest/pdf", status_code=202)
+async def ingest_pdf(http_request: Request, file: UploadFile = File(...)):
+    if not ingest_jobs:
+        raise HTTPException(status_code=503, detail="Ingest jobs not initialized")
+
+    source = os.path.basename(file.filename or "")
+    if not source.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only .pdf files are accepted")
+
+    _check_rate("ingest", http_request)
+    # Spooled to disk in chunks; the job extracts pages from the file
+    os.makedirs(PDF_UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=PDF_UPLOAD_DIR)
+    with os.fdopen(fd, "wb") as f:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+
+    try:
+        job = ingest_jobs.submit_pdf(path, source, delete_after=True)
+    except QueueFull as e:
+        os.remove(path)
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {"status": job.status, "job_id": job.id, "source": source}
+
+@app.get("/api/ingest/jobs")
+async def list_ingest_jobs():
+    if not ingest_jobs:
+        return []
+    return ingest_jobs.list()
+
+@app.get("/api/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = ingest_jobs.get(job_id) if ingest_jobs else None
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.delete("/api/ingest/jobs/{job_id}")
+async def cancel_ingest_job(job_id: str):
+    job = ingest_jobs.cancel(job_id) if ingest_jobs else None
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
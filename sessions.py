@@ -0,0 +1,169 @@
+import asyncio
+import importlib
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+
+# Conversation sessions (overridable via environment variables)
+DEFAULT_SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+DEFAULT_SESSION_MAX = int(os.environ.get("SESSION_MAX", "10000"))
+DEFAULT_SESSION_TTL = float(os.environ.get("SESSION_TTL", "3600"))
+
+
+class Session:
+    """
+    Per-conversation state kept on the server.
+
+    `turns` holds past {"role", "content"} messages without their retrieved
+    context, `summary` condenses turns that were folded away, and
+    `ollama_context` is the token array Ollama (`ollama_model`) returned for
+    the last turn, sent back so the next turn only prefills its own tokens.
+    """
+
+    def __init__(self, session_id: str = None, turns=None, summary: str = "", ollama_context=None,
+                 created_at: float = None, updated_at: float = None, ollama_model: str = None):
+        self.id = session_id or uuid.uuid4().hex
+        self.turns = list(turns or [])
+        self.summary = summary
+        self.ollama_context = ollama_context
+        self.ollama_model = ollama_model
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        self._lock = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # One turn at a time per conversation; created lazily so sessions stay picklable
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def add_turn(self, question: str, answer: str):
+        self.turns.append({"role": "user", "content": question})
+        self.turns.append({"role": "assistant", "content": answer})
+        self.updated_at = time.time()
+
+    def last_question(self) -> Optional[str]:
+        for turn in reversed(self.turns):
+            if turn["role"] == "user":
+                return turn["content"]
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "turns": self.turns,
+            "summary": self.summary,
+            "ollama_context": self.ollama_context,
+            "ollama_model": self.ollama_model,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        return cls(
+            data["id"],
+            data.get("turns"),
+            data.get("summary", ""),
+            data.get("ollama_context"),
+            data.get("created_at"),
+            data.get("updated_at"),
+            data.get("ollama_model"),
+        )
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**{("session_id" if k == "id" else k): v for k, v in state.items()})
+
+
+class SessionStore(ABC):
+    """
+    Session backend interface. Stores other than the in-memory one (Redis, a
+    database) implement get/put/delete, e.g. with Session.to_dict/from_dict,
+    and are selected with SESSION_BACKEND="package.module:ClassName". A store
+    missing one of them fails when it is constructed, not on first use.
+    """
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Session]:
+        ...
+
+    @abstractmethod
+    def put(self, session: Session):
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        ...
+
+    def get_or_create(self, session_id: str = None, history: List[dict] = None) -> Session:
+        """
+        Returns the stored session, or a new one. A new session is seeded with
+        `history` (client-side messages), so an expired session loses nothing
+        when the client still sends the whole conversation.
+        """
+        session = self.get(session_id) if session_id else None
+        if session is None:
+            turns = [
+                {"role": m["role"], "content": m["content"]}
+                for m in history or []
+                if m.get("role") in ("user", "assistant") and m.get("content")
+            ]
+            session = Session(session_id, turns)
+            self.put(session)
+        return session
+
+
+class InMemorySessionStore(SessionStore):
+    """LRU of at most `max_sessions` sessions; sessions idle for `ttl` seconds expire."""
+
+    def __init__(self, max_sessions: int = None, ttl: float = None):
+        self.max_sessions = max_sessions or DEFAULT_SESSION_MAX
+        self.ttl = DEFAULT_SESSION_TTL if ttl is None else ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self.ttl > 0 and time.time() - session.updated_at > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session: Session):
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+def create_session_store(backend: str = None) -> SessionStore:
+    backend = backend or DEFAULT_SESSION_BACKEND
+    if backend == "memory":
+        return InMemorySessionStore()
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"Unsupported SESSION_BACKEND '{backend}'. Use 'memory' or 'module:ClassName'.")
+    store_class = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(store_class, type) and issubclass(store_class, SessionStore)):
+        raise TypeError(f"SESSION_BACKEND '{backend}' is not a SessionStore subclass")
+    return store_class()
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:  # optional fast path
+    orjson = None
+
+# Token coalescing for streamed answers (overridable via environment variables):
+# tokens after the first are held up to STREAM_COALESCE_MS or until
+# STREAM_COALESCE_BYTES are buffered, then sent as one frame (0 and 0 = off)
+STREAM_COALESCE_MS = float(os.environ.get("STREAM_COALESCE_MS", "30"))
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", "512"))
+
+LOGGER = logging.getLogger(__name__)
+
+# json.loads also accepts bytes, so both parse raw lines without decoding first
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def dumps(data) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False)
+
+
+# ------------------------
+# Upstream: incremental SSE / NDJSON decoding
+# ------------------------
+
+class LineDecoder:
+    """Splits a byte stream into lines as bytes arrive; a trailing partial line waits for the next chunk."""
+
+    def __init__(self):
+        self._buffer = b""
+
+    def feed(self, data: bytes) -> list:
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b"\n")
+        self._buffer = lines.pop()
+        return lines
+
+    def flush(self) -> list:
+        rest, self._buffer = self._buffer, b""
+        return [rest] if rest else []
+
+
+class SSEDecoder:
+    """
+    Server-Sent Events decoder returning each event's data as bytes.
+
+    Follows the field rules of the spec: only "data:" lines are kept, with a
+    single optional space after the colon removed, several data lines of one
+    event are joined with newlines and a blank line ends the event. Content
+    that happens to contain "data: " is left alone.
+    """
+
+    def __init__(self):
+        self._lines = LineDecoder()
+        self._data = []
+
+    def feed(self, data: bytes) -> list:
+        return self._decode(self._lines.feed(data))
+
+    def flush(self) -> list:
+        events = self._decode(self._lines.flush())
+        if self._data:
+            events.append(b"\n".join(self._data))
+            self._data = []
+        return events
+
+    def _decode(self, lines) -> list:
+        events = []
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if self._data:
+                    events.append(b"\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+            # Comments (":") and event/id/retry fields carry nothing the LLM APIs use
+        return events
+
+
+class NDJSONDecoder:
+    """Newline-delimited JSON decoder; tolerates lines wrapped as SSE "data:" fields by proxies."""
+
+    def __init__(self):
+        self._lines = LineDecoder()
+
+    def feed(self, data: bytes) -> list:
+        return self._decode(self._lines.feed(data))
+
+    def flush(self) -> list:
+        return self._decode(self._lines.flush())
+
+    def _decode(self, lines) -> list:
+        objects = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith(b"data:"):
+                line = line[5:].lstrip()
+            if not line:
+                continue
+            try:
+                objects.append(loads(line))
+            except ValueError:
+                LOGGER.warning("Failed to decode stream line: %r", line[:200])
+        return objects
+
+
+def iter_decoded(chunks, decoder):
+    """Runs byte chunks through `decoder`, yielding each parsed item, including the unterminated last one."""
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_decoded(chunks, decoder):
+    """Async `iter_decoded`; closing it closes `chunks`, which aborts the upstream request."""
+    try:
+        async for chunk in chunks:
+            for item in decoder.feed(chunk):
+                yield item
+        for item in decoder.flush():
+            yield item
+    finally:
+        await chunks.aclose()
+
+
+# ------------------------
+# Downstream: SSE frames and token coalescing
+# ------------------------
+
+def encode_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
+async def coalesce_tokens(events, max_delay: float = None, max_bytes: int = None):
+    """
+    Merges consecutive ("token", text) pairs of an async (event, data) stream
+    into fewer, larger tokens. The first token goes out at once so
+    time-to-first-token does not change; later ones are held until
+    `max_delay` seconds pass or `max_bytes` are buffered. Any other event
+    flushes the held text first, so ordering is kept.
+
+    `events` is read by a separate task, so a slow LLM never delays a flush
+    that is due. Reading pauses while too much is buffered for a slow client.
+    """
+    max_delay = STREAM_COALESCE_MS / 1000.0 if max_delay is None else max_delay
+    max_bytes = STREAM_COALESCE_BYTES if max_bytes is None else max_bytes
+    if max_delay <= 0 and max_bytes <= 0:
+        async for item in events:
+            yield item
+        return
+
+    pending = []
+    state = {"bytes": 0, "done": False, "error": None}
+    ready = asyncio.Event()  # something is buffered
+    flush_now = asyncio.Event()  # buffered text should not wait any longer
+    drained = asyncio.Event()
+    high_water = max(4 * max_bytes, 4096)
+
+    async def produce():
+        try:
+            async for event, data in events:
+                pending.append((event, data))
+                if event == "token":
+                    state["bytes"] += len(data.encode("utf-8"))
+                    if max_bytes > 0 and state["bytes"] >= max_bytes:
+                        flush_now.set()
+                    if state["bytes"] >= high_water:
+                        drained.clear()
+                        await drained.wait()
+                else:
+                    flush_now.set()
+                ready.set()
+        except Exception as e:
+            state["error"] = e
+        finally:
+            state["done"] = True
+            flush_now.set()
+            ready.set()
+
+    producer = asyncio.create_task(produce())
+    first = True
+    try:
+        while True:
+            await ready.wait()
+            if not first and not flush_now.is_set() and max_delay > 0:
+                try:
+                    await asyncio.wait_for(flush_now.wait(), max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            ready.clear()
+            flush_now.clear()
+            batch = pending[:]
+            pending.clear()
+            state["bytes"] = 0
+            drained.set()
+
+            text = []
+            for event, data in batch:
+                if event == "token":
+                    text.append(data)
+                    continue
+                if text:
+                    first = False
+                    yield "token", "".join(text)
+                    text = []
+                yield event, data
+            if text:
+                first = False
+                yield "token", "".join(text)
+
+            if state["done"] and not pending:
+                break
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        if hasattr(events, "aclose"):
+            await events.aclose()
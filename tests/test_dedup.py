@@ -0,0 +1,67 @@
+from dedup import Deduplicator
+
+SHARED = " ".join(f"shared{i}" for i in range(60))
+
+
+def _page(source, text):
+    return {"text": text, "metadata": {"source": source}}
+
+
+def _chunk(source, key, text):
+    return {"id": key, "text": text, "metadata": {"source": source}}
+
+
+def _run(path, documents, chunks_by_source=None):
+    """One ingest run: forget the run's pages, then filter pages and their chunks."""
+    dedup = Deduplicator.load(str(path / "index.pkl"), audit_path=str(path / "audit.jsonl"))
+    dedup.forget_sources(doc["metadata"]["source"] for doc in documents)
+    pages = []
+    chunks = []
+    for doc in dedup.filter_pages(documents):
+        source = doc["metadata"]["source"]
+        pages.append(source)
+        for chunk in dedup.filter_chunks((chunks_by_source or {}).get(source, [])):
+            chunks.append(chunk["id"])
+    dedup.save()
+    return pages, chunks
+
+
+def test_page_dropped_against_changed_page_is_readmitted(tmp_path):
+    pages, _ = _run(tmp_path, [_page("A", SHARED), _page("B", SHARED)])
+    assert pages == ["A"]
+
+    # B is unchanged and not part of this run; A's new text no longer matches it
+    pages, _ = _run(tmp_path, [_page("A", "entirely different words " * 20)])
+    assert pages == ["A", "B"]
+
+    # Once kept, B stays kept
+    pages, _ = _run(tmp_path, [_page("C", "unrelated text " * 20)])
+    assert pages == ["C"]
+
+
+def test_page_still_duplicate_after_readmission_stays_dropped(tmp_path):
+    _run(tmp_path, [_page("A", SHARED), _page("B", SHARED)])
+    # A changed elsewhere but still carries the text B copied
+    pages, _ = _run(tmp_path, [_page("A", SHARED + " footer")])
+    assert pages == ["A"]
+
+    pages, _ = _run(tmp_path, [_page("A", "entirely different words " * 20)])
+    assert pages == ["A", "B"]
+
+
+def test_page_with_dropped_chunk_is_readmitted_whole(tmp_path):
+    own_a = "alpha only text " * 20
+    own_b = "beta only text " * 20
+    documents = [_page("A", own_a + SHARED), _page("B", own_b + SHARED)]
+    chunks = {
+        "A": [_chunk("A", "a1", own_a), _chunk("A", "a2", SHARED)],
+        "B": [_chunk("B", "b1", own_b), _chunk("B", "b2", SHARED)],
+    }
+    _, kept = _run(tmp_path, documents, chunks)
+    assert kept == ["a1", "a2", "b1"]
+
+    # A drops the shared block: B's copy of it is the only one left
+    chunks["A"] = [_chunk("A", "a1", own_a)]
+    pages, kept = _run(tmp_path, [_page("A", own_a)], chunks)
+    assert pages == ["A", "B"]
+    assert kept == ["a1", "b1", "b2"]
@@ -0,0 +1,27 @@
+import pytest
+
+from records import RecordWriter, iter_records
+
+
+def test_writer_replaces_file_on_success(tmp_path):
+    path = str(tmp_path / "pages.jsonl")
+    with RecordWriter(path) as writer:
+        writer.write({"url": "a"})
+        writer.write({"url": "b"})
+
+    assert [record["url"] for record in iter_records(path)] == ["a", "b"]
+    assert not (tmp_path / "pages.jsonl.tmp").exists()
+
+
+def test_writer_keeps_previous_file_when_run_fails(tmp_path):
+    path = str(tmp_path / "pages.jsonl")
+    with RecordWriter(path) as writer:
+        writer.write({"url": "old"})
+
+    with pytest.raises(RuntimeError):
+        with RecordWriter(path) as writer:
+            writer.write({"url": "partial"})
+            raise RuntimeError("crawl failed")
+
+    assert [record["url"] for record in iter_records(path)] == ["old"]
+    assert not (tmp_path / "pages.jsonl.tmp").exists()
@@ -0,0 +1,104 @@
+import re
+from functools import lru_cache
+
+from config import CHUNK_TOKENIZER, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+
+# Boundary strengths for cutting after a token
+_NONE, _SENTENCE, _LINE, _SECTION = 0, 1, 2, 3
+_SENTENCE_END = (".", "!", "?", ":", ";")
+# A short line without closing punctuation is treated as a heading
+_HEADING_MAX_CHARS = 80
+_HEADING_END_RE = re.compile(r"[.!?,;:]\s*$")
+
+_BATCH_SIZE = 64
+
+
+@lru_cache(maxsize=4)
+def load_tokenizer(name: str = CHUNK_TOKENIZER):
+    """Loads the fast (Rust) tokenizer of the embedding model, without the model itself."""
+    from tokenizers import Tokenizer
+    return Tokenizer.from_pretrained(name)
+
+
+def _boundary_strength(text: str, end: int, next_start: int) -> int:
+    gap = text[end:next_start]
+    if "\n" in gap:
+        if gap.count("\n") > 1:
+            return _SECTION
+        line_end = text.find("\n", next_start)
+        line = text[next_start:line_end if line_end != -1 else len(text)]
+        if len(line) <= _HEADING_MAX_CHARS and not _HEADING_END_RE.search(line):
+            return _SECTION
+        return _LINE
+    if gap and text[end - 1:end] in _SENTENCE_END:
+        return _SENTENCE
+    return _NONE
+
+
+def token_spans(text: str, offsets, max_tokens: int = CHUNK_MAX_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+    """
+    Splits one tokenized text into chunks of at most `max_tokens` tokens.
+
+    `offsets` are the (start, end) character offsets of each token. Cuts are
+    placed after the strongest boundary in the window (blank line / heading,
+    then line break, then sentence end), and consecutive chunks share about
+    `overlap` tokens. Runs in a single linear pass and yields
+    (char_start, char_end, token_count) without copying text.
+    """
+    n = len(offsets)
+    if n == 0:
+        return
+
+    # last[k][i]: index of the last token <= i that ends a boundary of strength >= k
+    last = {_SENTENCE: [-1] * n, _LINE: [-1] * n, _SECTION: [-1] * n}
+    for i in range(n):
+        next_start = offsets[i + 1][0] if i + 1 < n else len(text)
+        strength = _boundary_strength(text, offsets[i][1], next_start)
+        for k, positions in last.items():
+            positions[i] = i if strength >= k else (positions[i - 1] if i else -1)
+
+    overlap = min(overlap, max_tokens // 2)
+    min_tokens = max_tokens // 2
+    start = 0
+    while start < n:
+        window_end = min(start + max_tokens, n) - 1
+        cut = window_end
+        if window_end < n - 1:
+            for k in (_SECTION, _LINE, _SENTENCE):
+                candidate = last[k][window_end]
+                if candidate >= start + min_tokens - 1:
+                    cut = candidate
+                    break
+
+        yield offsets[start][0], offsets[cut][1], cut - start + 1
+
+        if cut == n - 1:
+            break
+        start = max(start + 1, cut + 1 - overlap)
+
+
+def chunk_text_tokens(text: str, tokenizer=None, max_tokens: int = CHUNK_MAX_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+    """Token-budgeted chunking of one text; returns (start, end, token_count) spans."""
+    tokenizer = tokenizer or load_tokenizer()
+    encoding = tokenizer.encode(text, add_special_tokens=False)
+    return list(token_spans(text, encoding.offsets, max_tokens, overlap))
+
+
+def chunk_texts_tokens(texts, tokenizer=None, max_tokens: int = CHUNK_MAX_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+    """
+    Batch version of `chunk_text_tokens`: tokenizes `texts` in parallel batches
+    (Rust side) and yields one list of spans per text, in order.
+    """
+    tokenizer = tokenizer or load_tokenizer()
+    texts = list(texts)
+    for i in range(0, len(texts), _BATCH_SIZE):
+        batch = texts[i:i + _BATCH_SIZE]
+        encodings = tokenizer.encode_batch(batch, add_special_tokens=False)
+        for text, encoding in zip(batch, encodings):
+            yield list(token_spans(text, encoding.offsets, max_tokens, overlap))
+
+
+def count_tokens(texts, tokenizer=None):
+    """Token counts for a list of texts, without special tokens."""
+    tokenizer = tokenizer or load_tokenizer()
+    return [len(encoding.ids) for encoding in tokenizer.encode_batch(list(texts), add_special_tokens=False)]
@@ -1,3 +1,4 @@
+import hashlib
 from urllib.parse import urlparse
 
 
@@ -7,3 +8,10 @@ def normalize_url(url: str) -> str:
 
 def is_internal(url: str, base_domain: str) -> bool:
     return urlparse(url).netloc.endswith(base_domain)
+
+
+def make_chunk_id(source: str, offset: int, text: str) -> str:
+    """Content-addressed chunk id: the same text at the same place always maps to the same id."""
+    text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    key = f"{source}\x00{offset}\x00{text_hash}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
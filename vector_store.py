@@ -1,32 +1,261 @@
-import chromadb
-from chromadb.config import Settings
 import os
+from itertools import islice
 
-class VectorStore:
-    def __init__(self, path="chroma_db"):
-        self.client = chromadb.PersistentClient(path=path)
-        self.collection = self.client.get_or_create_collection("chatbot_knowledge")
+import numpy as np
+
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from numpy_index import NumpyCollection
+from utils import make_chunk_id
+
+# Number of chunks embedded and written to Chroma per round trip
+DEFAULT_INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "256"))
+# "hybrid" fuses BM25 and dense results, "dense" queries Chroma only
+DEFAULT_SEARCH_MODE = os.environ.get("SEARCH_MODE", "hybrid").lower()
+LEXICAL_INDEX_FILE = "bm25_index.pkl"
+# "chroma" (default) or "numpy" for the flat memory-mapped index
+DEFAULT_VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma").lower()
+DEFAULT_PATHS = {"chroma": "chroma_db", "numpy": "vector_index"}
 
-    def add_documents(self, documents, embedding_model):
-        if not documents:
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
             return
-            
-        ids = [doc.get('id', str(i)) for i, doc in enumerate(documents)]
-        texts = [doc.get('text', '') for doc in documents]
-        metadatas = [doc.get('metadata', {'source': 'unknown'}) for doc in documents]
-        embeddings = [embedding_model.embed(text) for text in texts]
-        
-        self.collection.add(
-            ids=ids,
-            documents=texts,
-            metadatas=metadatas,
-            embeddings=embeddings
-        )
+        yield batch
+
+
+def _unpack(batch, offset):
+    ids, texts, metadatas = [], [], []
+    for i, doc in enumerate(batch):
+        text = doc.get('text', '')
+        metadata = doc.get('metadata') or {'source': 'unknown'}
+        ids.append(doc.get('id') or make_chunk_id(metadata.get('source', 'unknown'), offset + i, text))
+        texts.append(text)
+        metadatas.append(metadata)
+    return ids, texts, metadatas
+
+
+class VectorStore:
+    def __init__(self, path=None, backend=None):
+        self.backend = (backend or DEFAULT_VECTOR_BACKEND).lower()
+        if self.backend not in DEFAULT_PATHS:
+            raise ValueError(f"Unsupported VECTOR_BACKEND '{self.backend}'. Use 'chroma' or 'numpy'.")
+        path = path or DEFAULT_PATHS[self.backend]
+
+        if self.backend == "numpy":
+            # Same collection API, backed by a memory-mapped float32 matrix
+            self.client = None
+            self.collection = NumpyCollection(path)
+        else:
+            # Imported here: chromadb is slow to import and unused by the numpy backend
+            import chromadb
+            self.client = chromadb.PersistentClient(path=path)
+            self.collection = self.client.get_or_create_collection("chatbot_knowledge")
+        self._change_listeners = []
+
+        # BM25 index over the same chunks, persisted inside the index directory
+        self.lexical_index = BM25Index.load(os.path.join(path, LEXICAL_INDEX_FILE))
+        if not len(self.lexical_index) and self.collection.count():
+            self.rebuild_lexical_index()
+
+    def rebuild_lexical_index(self, page_size=1000):
+        """Rebuilds the BM25 index from the documents stored in Chroma."""
+        self.lexical_index = BM25Index(self.lexical_index.path)
+        offset = 0
+        while True:
+            page = self.collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            self.lexical_index.add(page["ids"], page["documents"])
+            offset += len(page["ids"])
+        self.lexical_index.save()
+
+    def _persist(self):
+        self.lexical_index.save()
+        if hasattr(self.collection, "flush"):
+            self.collection.flush()
+
+    def add_change_listener(self, callback):
+        """Registers a no-argument callback invoked after the collection changes."""
+        self._change_listeners.append(callback)
+
+    def _notify_change(self):
+        for callback in self._change_listeners:
+            callback()
+
+    def add_documents(self, documents, embedding_model, batch_size=None):
+        """
+        Embeds and stores documents in bounded batches. `documents` may be any
+        iterable (including a generator), so memory stays flat with corpus size.
+        Returns the number of documents written.
+        """
+        batch_size = batch_size or DEFAULT_INGEST_BATCH_SIZE
+        offset = 0
+
+        for batch in _batched(documents, batch_size):
+            ids, texts, metadatas = _unpack(batch, offset)
+            embeddings = embedding_model.embed_batch(texts)
+
+            self.collection.add(
+                ids=ids,
+                documents=texts,
+                metadatas=metadatas,
+                embeddings=embeddings
+            )
+            self.lexical_index.add(ids, texts)
+            offset += len(batch)
 
-    def search(self, query, embedding_model, n_results=3):
-        query_embedding = embedding_model.embed(query)
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results
+        if offset:
+            self._persist()
+            self._notify_change()
+        return offset
+
+    def upsert_documents(
+        self,
+        documents,
+        embedding_model,
+        batch_size=None,
+        removed_sources=None,
+        prune=False,
+        progress=None,
+    ):
+        """
+        Diff-based ingestion keyed on content-addressed chunk ids.
+
+        Chunks whose id is already stored are skipped without embedding. For
+        every source present in `documents`, stored chunks that are no longer
+        produced are deleted. Chunks of `removed_sources` are deleted too, and
+        with `prune=True` (documents are the whole corpus) so is every chunk
+        whose source is absent from `documents`.
+        `progress(processed, added)` is called after every batch.
+        Returns {"added": n, "skipped": n, "removed": n}.
+        """
+        batch_size = batch_size or DEFAULT_INGEST_BATCH_SIZE
+        stats = {"added": 0, "skipped": 0, "removed": 0}
+        ids_by_source = {}
+        offset = 0
+
+        for batch in _batched(documents, batch_size):
+            ids, texts, metadatas = _unpack(batch, offset)
+            offset += len(batch)
+            for chunk_id, metadata in zip(ids, metadatas):
+                ids_by_source.setdefault(metadata.get("source", "unknown"), set()).add(chunk_id)
+
+            existing = set(self.collection.get(ids=ids, include=[])["ids"])
+            new = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing]
+            stats["skipped"] += len(ids) - len(new)
+            if not new:
+                if progress:
+                    progress(offset, stats["added"])
+                continue
+
+            new_texts = [texts[i] for i in new]
+            self.collection.upsert(
+                ids=[ids[i] for i in new],
+                documents=new_texts,
+                metadatas=[metadatas[i] for i in new],
+                embeddings=embedding_model.embed_batch(new_texts)
+            )
+            self.lexical_index.add([ids[i] for i in new], new_texts)
+            stats["added"] += len(new)
+            if progress:
+                progress(offset, stats["added"])
+
+        stale = []
+        for source, keep in ids_by_source.items():
+            stored = self.collection.get(where={"source": source}, include=[])["ids"]
+            stale.extend(chunk_id for chunk_id in stored if chunk_id not in keep)
+
+        for source in removed_sources or []:
+            if source not in ids_by_source:
+                stale.extend(self.collection.get(where={"source": source}, include=[])["ids"])
+
+        if prune:
+            stored = self.collection.get(include=["metadatas"])
+            for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                if (metadata or {}).get("source", "unknown") not in ids_by_source:
+                    stale.append(chunk_id)
+
+        stale = list(dict.fromkeys(stale))
+        for batch in _batched(stale, batch_size):
+            self.collection.delete(ids=batch)
+        self.lexical_index.remove(stale)
+        stats["removed"] = len(stale)
+
+        if stats["added"] or stats["removed"]:
+            self._persist()
+            self._notify_change()
+        return stats
+
+    def search(self, query, embedding_model, n_results=3, query_embedding=None, mode=None):
+        if query_embedding is None:
+            query_embedding = embedding_model.embed_query(query)
+        return self.search_batch([query], embedding_model, n_results, [query_embedding], mode)[0]
+
+    def search_batch(self, queries, embedding_model, n_results=3, query_embeddings=None, mode=None):
+        """
+        Searches many queries with a single dense query call. Returns one
+        Chroma-shaped result per query, in order.
+        """
+        if query_embeddings is None:
+            query_embeddings = embedding_model.embed_batch(queries)
+        hybrid = (mode or DEFAULT_SEARCH_MODE) == "hybrid" and len(self.lexical_index)
+
+        dense = self.collection.query(
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32),
+            n_results=n_results * 2 if hybrid else n_results
         )
+
+        results = []
+        for i, query in enumerate(queries):
+            row = {key: [dense[key][i]] for key in ("ids", "documents", "metadatas", "distances")}
+            if hybrid:
+                row = self._fuse(query, query_embeddings[i], row, n_results)
+            results.append(row)
         return results
+
+    def _fuse(self, query, query_embedding, dense, n_results):
+        """
+        Reciprocal rank fusion of the dense and BM25 rankings. Returns a
+        Chroma-shaped result; lexical-only hits get their real vector distance
+        so downstream similarity filtering works the same for both.
+        """
+        lexical = self.lexical_index.search(query, n_results * 2)
+
+        dense_ids = dense["ids"][0]
+        fused = reciprocal_rank_fusion([dense_ids, [doc_id for doc_id, _ in lexical]])[:n_results]
+
+        found = {
+            doc_id: (document, metadata, distance)
+            for doc_id, document, metadata, distance in zip(
+                dense_ids, dense["documents"][0], dense["metadatas"][0], dense["distances"][0]
+            )
+        }
+        missing = [doc_id for doc_id in fused if doc_id not in found]
+        if missing:
+            extra = self.collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            for doc_id, document, metadata, embedding in zip(
+                extra["ids"], extra["documents"], extra["metadatas"], extra["embeddings"]
+            ):
+                # Chroma's default space is squared L2
+                diff = np.asarray(embedding, dtype=np.float32) - query_vector
+                found[doc_id] = (document, metadata, float(diff @ diff))
+
+        fused = [doc_id for doc_id in fused if doc_id in found]
+        return {
+            "ids": [fused],
+            "documents": [[found[doc_id][0] for doc_id in fused]],
+            "metadatas": [[found[doc_id][1] for doc_id in fused]],
+            "distances": [[found[doc_id][2] for doc_id in fused]],
+        }
+
+    def warmup(self, embedding_model):
+        """Runs one query so Chroma loads its index before the first request."""
+        if self.collection.count():
+            self.collection.query(
+                query_embeddings=[embedding_model.embed_query("warmup")],
+                n_results=1
+            )
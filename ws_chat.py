@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from admission import AdmissionRejected
+from streaming import coalesce_tokens
+
+# Per-connection limits (overridable via environment variables)
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "64"))
+WS_MAX_CONCURRENT = int(os.environ.get("WS_MAX_CONCURRENT", "4"))
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ChatSocketSession:
+    """
+    Runs one /ws/chat connection without blocking the event loop.
+
+    Protocol (JSON text frames):
+        client -> {"id": "q1", "question": "...", "timings": false, "session_id": "..."}
+        client -> {"type": "cancel", "id": "q1"}
+        server -> {"id": "q1", "type": "token", "content": "..."}
+        server -> {"id": "q1", "type": "done"}   (+ "timings": {...} when requested,
+                                                   "session_id" when one was given)
+        server -> {"id": "q1", "type": "error", "detail": "..."}   (+ "status" 429/503 and
+                                                                    "retry_after" when rejected
+                                                                    by admission control)
+
+    Plain-text frames are still accepted as a question; their answer is sent
+    back as raw text chunks like before, one question at a time.
+
+    All outgoing frames go through a bounded queue drained by a single sender
+    task, so a slow client pauses its own generations (and, through them, the
+    upstream LLM read) instead of buffering without limit. When the socket
+    closes, every running generation is cancelled, which aborts the upstream
+    request.
+    """
+
+    def __init__(self, websocket: WebSocket, chat_engine, admission=None, client: str = None):
+        self.websocket = websocket
+        self.chat_engine = chat_engine
+        self.admission = admission
+        self.client = client
+        self.outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.tasks = {}
+        self.legacy_lock = asyncio.Lock()
+        self.closed = False
+
+    async def run(self):
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            while True:
+                raw = await self.websocket.receive_text()
+                await self._dispatch(raw)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            LOGGER.warning("WebSocket receive failed: %s", e)
+        finally:
+            self.closed = True
+            await self._shutdown(sender)
+
+    async def _dispatch(self, raw: str):
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError:
+            message = None
+
+        if not isinstance(message, dict):
+            if len(self.tasks) >= WS_MAX_CONCURRENT:
+                await self.outbox.put("Error: Too many concurrent requests")
+                return
+            self._start(str(uuid.uuid4()), raw, legacy=True)
+            return
+
+        request_id = str(message.get("id") or uuid.uuid4())
+
+        if message.get("type") == "cancel":
+            task = self.tasks.get(request_id)
+            if task:
+                task.cancel()
+            return
+
+        question = message.get("question") or message.get("content")
+        if not question:
+            await self.outbox.put({"id": request_id, "type": "error", "detail": "Message has no question"})
+            return
+
+        if self.chat_engine is None:
+            await self.outbox.put({"id": request_id, "type": "error", "detail": "Chat engine not initialized"})
+            return
+
+        if request_id in self.tasks:
+            await self.outbox.put({"id": request_id, "type": "error", "detail": "Duplicate request id"})
+            return
+
+        if len(self.tasks) >= WS_MAX_CONCURRENT:
+            await self.outbox.put({"id": request_id, "type": "error", "detail": "Too many concurrent requests"})
+            return
+
+        # A session id makes the question a follow-up of that conversation
+        session = None
+        if message.get("session_id"):
+            session = self.chat_engine.sessions.get_or_create(str(message["session_id"]))
+
+        self._start(request_id, question, timings=bool(message.get("timings")), session=session)
+
+    def _start(self, request_id: str, question: str, legacy: bool = False, timings: bool = False, session=None):
+        task = asyncio.create_task(self._answer(request_id, question, legacy, timings, session))
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+
+    async def _answer(self, request_id: str, question: str, legacy: bool, timings: bool = False, session=None):
+        if not legacy:
+            await self._admitted_answer(request_id, question, legacy, timings, session)
+            return
+        # Raw-text clients cannot tell answers apart, so keep them sequential;
+        # the admission slot is only taken once it is this question's turn
+        async with self.legacy_lock:
+            await self._admitted_answer(request_id, question, legacy, timings, session)
+
+    async def _admitted_answer(self, request_id: str, question: str, legacy: bool, timings: bool, session):
+        # Questions over a socket share the chat slots and rate limit with /api/chat
+        ticket = None
+        if self.admission is not None:
+            try:
+                ticket = await self.admission.acquire("chat", self.client)
+            except AdmissionRejected as e:
+                if legacy:
+                    await self.outbox.put(f"Error: {e.detail}")
+                else:
+                    await self.outbox.put(
+                        {"id": request_id, "type": "error", "status": e.status, "detail": e.detail,
+                         "retry_after": e.retry_after}
+                    )
+                return
+        try:
+            await self._stream_answer(request_id, question, legacy, timings, session)
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    async def _stream_answer(self, request_id: str, question: str, legacy: bool, timings: bool, session):
+        if legacy:
+            if self.chat_engine is None:
+                await self.outbox.put("Error: Chat engine not initialized")
+                return
+            async for chunk in self.chat_engine.aquery_stream(question):
+                await self.outbox.put(chunk)
+            return
+
+        result = {} if timings else None
+        # Tokens are merged into fewer frames; sources and errors still arrive as token text
+        events = coalesce_tokens(self.chat_engine.aquery_events(question, timings=result, session=session))
+        try:
+            async for event, data in events:
+                text = self.chat_engine.event_text(event, data)
+                if text:
+                    await self.outbox.put({"id": request_id, "type": "token", "content": text})
+            done = {"id": request_id, "type": "done"}
+            if result is not None:
+                done["timings"] = result
+            if session is not None:
+                done["session_id"] = session.id
+            await self.outbox.put(done)
+        except asyncio.CancelledError:
+            # Cancelled by the client: tell it, unless the socket itself is gone
+            if not self.closed:
+                try:
+                    self.outbox.put_nowait({"id": request_id, "type": "done", "cancelled": True})
+                except asyncio.QueueFull:
+                    pass
+            raise
+        finally:
+            await events.aclose()
+
+    async def _send_loop(self):
+        while True:
+            frame = await self.outbox.get()
+            if isinstance(frame, str):
+                await self.websocket.send_text(frame)
+            else:
+                await self.websocket.send_text(json.dumps(frame, ensure_ascii=False))
+
+    async def _shutdown(self, sender: asyncio.Task):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)